@@ -6,12 +6,18 @@ Contains all the functions implementing CALFEM standard functionality
 """
 
 from scipy.sparse.linalg import dsolve
-from scipy.linalg import eig, lu
+import scipy.sparse as sp
+from scipy.sparse.linalg import splu, spilu, eigsh
+from scipy.linalg import eig, lu_factor, lu_solve
 import numpy as np
 
 import logging as cflog
+import os
 import sys
 import traceback
+import warnings
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 __prev_exception_hook = sys.excepthook
 
@@ -923,7 +929,7 @@ def bar3s(ex, ey, ez, ep, ed, eq=None, nep=None):
         return es
     else:
         return es, edi, eci
- 
+
 
 def beam1e(ex, ep, eq=None):
     """
@@ -1072,7 +1078,7 @@ def beam1s(ex, ep, ed, eq=None, nep=None):
         return es
     else:
         return es, edi, eci
- 
+
 
 def beam1we(ex, ep, eq=None):
     """
@@ -1245,7 +1251,7 @@ def beam1ws(ex, ep, ed, eq=None, nep=None):
         return es
     else:
         return es, edi, eci
- 
+
 
 def beam2e(ex, ey, ep, eq=None):
     """
@@ -1455,7 +1461,7 @@ def beam2s(ex, ey, ep, ed, eq=None, nep=None):
         return es
     else:
         return es, edi, eci
-  
+
 
 def beam2we(ex, ey, ep, eq=None):
     """
@@ -1697,7 +1703,7 @@ def beam2ws(ex, ey, ep, ed, eq=None, nep=None):
         return es
     else:
         return es, edi, eci
-  
+
 
 def beam2ge(ex, ey, ep, QX, eq=None):
     """
@@ -2312,7 +2318,7 @@ def beam2te(ex, ey, ep, eq=None):
         return Ke
     else:
         return Ke, fe
-    
+
 
 def beam2ts(ex, ey, ep, ed, eq=None, nep=None):
     """
@@ -2453,7 +2459,7 @@ def beam2ts(ex, ey, ep, ed, eq=None, nep=None):
         return es
     else:
         return es, edi, eci
-  
+
 
 def beam2de(ex, ey, ep):
     """
@@ -2976,7 +2982,7 @@ def beam3s(ex, ey, ez, eo, ep, ed, eq=None, nep=None):
         return es
     else:
         return es, edi, eci
- 
+
 
 def flw2te(ex, ey, ep, D, eq=None):
     """
@@ -4845,13 +4851,275 @@ def plani4e(ex, ey, ep, D, eq=None):
                 N2[1, index] = N[i, counter]
                 counter = counter+1
 #
-            Ke1 = Ke1 + B.T * Dm * B * detJ * np.asscalar(wp[i]) * t
-            fe1 = fe1+N2.T*q*detJ*np.asscalar(wp[i])*t
+            Ke1 = Ke1 + B.T * Dm * B * detJ * wp[i].item() * t
+            fe1 = fe1+N2.T*q*detJ*wp[i].item()*t
         return Ke1, fe1
     else:
         info("Error ! Check first argument, ptype=1 or 2 allowed")
 
 
+def _plan_dm(ptype, D):
+    """
+    Reduce constitutive matrix D to the 3 x 3 in-plane matrix used by
+    the plane stress (ptype=1) or plane strain (ptype=2) elements.
+    """
+    D = np.asarray(D)
+
+    if ptype == 1:
+        if D.shape[1] > 3:
+            Cm = np.linalg.inv(D)
+            return np.linalg.inv(Cm[np.ix_((0, 1, 3), (0, 1, 3))])
+        return D
+    elif ptype == 2:
+        if D.shape[1] > 3:
+            return D[np.ix_((0, 1, 3), (0, 1, 3))]
+        return D
+    else:
+        raise ValueError("Check first argument, ptype=1 or 2 allowed")
+
+
+def _batch_eq(eq, nel, ncomp):
+    """
+    Return body forces as a nel x ncomp array. A single body force
+    vector is used for all elements.
+    """
+    eq = np.asarray(eq, dtype=float)
+    if eq.size == ncomp:
+        eq = eq.reshape(1, ncomp)
+    return np.broadcast_to(eq.reshape(-1, ncomp), (nel, ncomp))
+
+
+def plante_batch(ex, ey, ep, D, eq=None):
+    """
+    Calculate the stiffness matrices for a set of triangular plane stress
+    or plane strain elements. Batched version of plante.
+
+    Parameters:
+
+        ex = [[x1,x2,x3],       element coordinates, one row per element
+              [..........]]     dim(ex) = dim(ey) = nel x 3
+        ey = [[y1,y2,y3],
+              [..........]]
+
+        ep = [ptype,t]          ptype: analysis type
+                                t: thickness
+
+        D                       constitutive matrix
+
+        eq = [bx, by]           bx: body force x-dir
+                                by: body force y-dir
+                                or one row per element, dim(eq) = nel x 2
+
+    Returns:
+
+        Ke                      element stiffness matrices (nel x 6 x 6)
+        fe                      equivalent nodal forces (nel x 6)
+                                (if eq is given)
+
+    """
+
+    ptype, t = ep
+
+    ex = np.atleast_2d(np.asarray(ex, dtype=float))
+    ey = np.atleast_2d(np.asarray(ey, dtype=float))
+    nel = ex.shape[0]
+
+    Dm = _plan_dm(ptype, D)
+
+    # Closed form of B = [...]*inv(C), using signed area as in plante
+
+    A2 = (ex[:, 1]-ex[:, 0])*(ey[:, 2]-ey[:, 0]) - \
+        (ex[:, 2]-ex[:, 0])*(ey[:, 1]-ey[:, 0])
+    A = 0.5*A2
+
+    dNx = (np.roll(ey, -1, axis=1) - np.roll(ey, -2, axis=1))/A2[:, None]
+    dNy = (np.roll(ex, -2, axis=1) - np.roll(ex, -1, axis=1))/A2[:, None]
+
+    B = np.zeros((nel, 3, 6))
+    B[:, 0, 0::2] = dNx
+    B[:, 1, 1::2] = dNy
+    B[:, 2, 0::2] = dNy
+    B[:, 2, 1::2] = dNx
+
+    Ke = np.einsum('eji,jk,ekl,e->eil', B, Dm, B, A*t, optimize=True)
+
+    if eq is None:
+        return Ke
+
+    b = _batch_eq(eq, nel, 2)
+    fe = np.tile(b, (1, 3))*(A*t/3)[:, None]
+
+    return Ke, fe
+
+
+def planqe_batch(ex, ey, ep, D, eq=None):
+    """
+    Calculate the stiffness matrices for a set of quadrilateral plane
+    stress or plane strain elements. Batched version of planqe.
+
+    Parameters:
+
+        ex = [[x1,x2,x3,x4],    element coordinates, one row per element
+              [.............]]  dim(ex) = dim(ey) = nel x 4
+        ey = [[y1,y2,y3,y4],
+              [.............]]
+
+        ep = [ptype, t]         ptype: analysis type
+                                t: element thickness
+
+        D                       constitutive matrix
+
+        eq = [bx, by]           bx: body force in x direction
+                                by: body force in y direction
+                                or one row per element, dim(eq) = nel x 2
+
+    Returns:
+
+        Ke                      element stiffness matrices (nel x 8 x 8)
+        fe                      equivalent nodal forces (nel x 8)
+                                (if eq is given)
+    """
+
+    ex = np.atleast_2d(np.asarray(ex, dtype=float))
+    ey = np.atleast_2d(np.asarray(ey, dtype=float))
+    nel = ex.shape[0]
+
+    xm = ex.mean(axis=1)
+    ym = ey.mean(axis=1)
+
+    b1 = np.zeros(2) if eq is None else eq
+    b1 = _batch_eq(b1, nel, 2)
+
+    # Same four sub-triangles and topology as planqe
+
+    tri_nodes = ((0, 1), (1, 2), (2, 3), (3, 0))
+    tri_edof = np.array([
+        [0, 1, 2, 3, 8, 9],
+        [2, 3, 4, 5, 8, 9],
+        [4, 5, 6, 7, 8, 9],
+        [6, 7, 0, 1, 8, 9]])
+
+    K = np.zeros((nel, 10, 10))
+    f = np.zeros((nel, 10))
+
+    for (n0, n1), idx in zip(tri_nodes, tri_edof):
+        ke, fe = plante_batch(
+            np.column_stack((ex[:, n0], ex[:, n1], xm)),
+            np.column_stack((ey[:, n0], ey[:, n1], ym)), ep, D, b1)
+        K[:, idx[:, None], idx[None, :]] += ke
+        f[:, idx] += fe
+
+    # Condense the centre node dofs 9 and 10 as statcon does
+
+    Kaa = K[:, :8, :8]
+    Kab = K[:, :8, 8:]
+    Kbb = K[:, 8:, 8:]
+
+    X = np.linalg.solve(Kbb, np.concatenate(
+        (np.swapaxes(Kab, 1, 2), f[:, 8:, None]), axis=2))
+
+    Ke = Kaa - Kab@X[:, :, :8]
+
+    if eq is None:
+        return Ke
+
+    fe = f[:, :8] - (Kab@X[:, :, 8:])[:, :, 0]
+
+    return Ke, fe
+
+
+def plani4e_batch(ex, ey, ep, D, eq=None):
+    """
+    Calculate the stiffness matrices for a set of 4 node isoparametric
+    elements in plane strain or plane stress. Batched version of plani4e.
+
+    Parameters:
+        ex = [[x1 ...   x4],    element coordinates, one row per element
+              [...........]]    dim(ex) = dim(ey) = nel x 4
+        ey = [[y1 ...   y4],
+              [...........]]
+
+        ep =[ptype, t, ir]      ptype: analysis type
+                                t : thickness
+                                ir: integration rule
+
+        D                       constitutive matrix
+
+        eq = [bx, by]           bx: body force in x direction
+                                by: body force in y direction
+                                or one row per element, dim(eq) = nel x 2
+
+    Returns:
+        Ke : element stiffness matrices (nel x 8 x 8)
+        fe : equivalent nodal forces (nel x 8)
+    """
+    ptype = ep[0]
+    t = ep[1]
+    ir = ep[2]
+
+    ex = np.atleast_2d(np.asarray(ex, dtype=float))
+    ey = np.atleast_2d(np.asarray(ey, dtype=float))
+    nel = ex.shape[0]
+
+    q = _batch_eq(np.zeros(2) if eq is None else eq, nel, 2)
+
+    Dm = _plan_dm(ptype, D)
+
+    #--------- gauss points (same ordering as plani4e) ------------
+    if ir == 1:
+        g = np.array([0.0])
+        wg = np.array([2.0])
+    elif ir == 2:
+        g = np.array([-0.577350269189626, 0.577350269189626])
+        wg = np.array([1.0, 1.0])
+    elif ir == 3:
+        g = np.array([-0.774596669241483, 0., 0.774596669241483])
+        wg = np.array([0.555555555555555, 0.888888888888888,
+                       0.555555555555555])
+    else:
+        raise ValueError("Used number of integration points not implemented")
+
+    xsi = np.tile(g, ir)
+    eta = np.repeat(g, ir)
+    wp = np.tile(wg, ir)*np.repeat(wg, ir)
+
+    N = np.column_stack((
+        (1-xsi)*(1-eta), (1+xsi)*(1-eta),
+        (1+xsi)*(1+eta), (1-xsi)*(1+eta)))/4.
+
+    dNr = np.stack((
+        np.column_stack((-(1-eta), (1-eta), (1+eta), -(1+eta))),
+        np.column_stack((-(1-xsi), -(1+xsi), (1+xsi), (1-xsi)))),
+        axis=1)/4.
+
+    # JT: nel x ngp x 2 x 2
+
+    JT = np.stack((np.einsum('gin,en->egi', dNr, ex),
+                   np.einsum('gin,en->egi', dNr, ey)), axis=3)
+
+    detJ = np.linalg.det(JT)
+    if np.any(detJ < 10*np.finfo(float).eps):
+        info("Jacobi determinant equal or less than zero!")
+
+    dNx = np.linalg.solve(JT, np.broadcast_to(dNr, JT.shape[:2] + (2, 4)))
+
+    B = np.zeros(JT.shape[:2] + (3, 8))
+    B[:, :, 0, 0::2] = dNx[:, :, 0, :]
+    B[:, :, 1, 1::2] = dNx[:, :, 1, :]
+    B[:, :, 2, 0::2] = dNx[:, :, 1, :]
+    B[:, :, 2, 1::2] = dNx[:, :, 0, :]
+
+    dV = detJ*wp*t
+
+    Ke = np.einsum('egji,jk,egkl,eg->eil', B, Dm, B, dV, optimize=True)
+
+    fe = np.zeros((nel, 8))
+    fe[:, 0::2] = np.einsum('gn,eg,e->en', N, dV, q[:, 0])
+    fe[:, 1::2] = np.einsum('gn,eg,e->en', N, dV, q[:, 1])
+
+    return Ke, fe
+
+
 def soli8e(ex, ey, ez, ep, D, eqp=None):
     """
     Ke=soli8e(ex,ey,ez,ep,D)
@@ -5036,7 +5304,7 @@ def soli8e(ex, ey, ez, ep, D, eqp=None):
         Ke = Ke + (np.transpose(B)@D@B)*detJ*wp[i]
         fe = fe + (np.transpose(N2)@eq)*detJ*wp[i]
 
-    if eqp != None:
+    if eqp is not None:
         return Ke, fe
     else:
         return Ke
@@ -5239,6 +5507,215 @@ def soli8s(ex, ey, ez, ep, D, ed):
     return et, es, eci
 
 
+_soli8_tables = {}
+
+
+def _soli8_ref_tables(ir):
+    """
+    Return the reference element tables N (ngp x 8), dNr (ngp x 3 x 8)
+    and integration weights wp (ngp) for the 8 node brick element.
+    The Gauss point ordering is the same as in soli8e/soli8s. Tables
+    are computed once per integration rule and cached.
+    """
+    if ir in _soli8_tables:
+        return _soli8_tables[ir]
+
+    if ir == 1:
+        xsi = eta = zet = np.array([0.0])
+        wp = np.array([8.0])
+    elif ir == 2:
+        g1 = 0.577350269189626
+        xsi = np.array([-1, 1, 1, -1, -1, 1, 1, -1])*g1
+        eta = np.array([-1, -1, 1, 1, -1, -1, 1, 1])*g1
+        zet = np.array([-1, -1, -1, -1, 1, 1, 1, 1])*g1
+        wp = np.ones(8)
+    elif ir == 3:
+        g = np.array([-0.774596669241483, 0.0, 0.774596669241483])
+        w = np.array([0.555555555555555, 0.888888888888888,
+                      0.555555555555555])
+        xsi = np.tile(g, 9)
+        eta = np.tile(np.repeat(g, 3), 3)
+        zet = np.repeat(g, 9)
+        wp = np.tile(w, 9)*np.tile(np.repeat(w, 3), 3)*np.repeat(w, 9)
+    else:
+        raise ValueError("Used number of integration points not implemented")
+
+    sx = np.array([-1, 1, 1, -1, -1, 1, 1, -1])
+    sy = np.array([-1, -1, 1, 1, -1, -1, 1, 1])
+    sz = np.array([-1, -1, -1, -1, 1, 1, 1, 1])
+
+    fx = 1+np.outer(xsi, sx)
+    fy = 1+np.outer(eta, sy)
+    fz = 1+np.outer(zet, sz)
+
+    N = fx*fy*fz/8
+
+    dNr = np.stack((sx*fy*fz, fx*sy*fz, fx*fy*sz), axis=1)/8.0
+
+    for a in (N, dNr, wp):
+        a.setflags(write=False)
+
+    _soli8_tables[ir] = (N, dNr, wp)
+
+    return _soli8_tables[ir]
+
+
+def _soli8_dnx(ex, ey, ez, dNr):
+    """
+    Return Jacobian determinants (nel x ngp) and global shape function
+    derivatives dNx (nel x ngp x 3 x 8) for a set of brick elements.
+    """
+    X = np.stack((ex, ey, ez), axis=2)
+    JT = np.einsum('gin,enj->egij', dNr, X)
+
+    detJ = np.linalg.det(JT)
+    if np.any(detJ < 10*np.finfo(float).eps):
+        info("Jacobi determinant equal or less than zero!")
+
+    dNx = np.linalg.solve(JT, np.broadcast_to(dNr, JT.shape[:2] + (3, 8)))
+
+    return detJ, dNx
+
+
+def _soli8_b(dNx):
+    """Strain-displacement matrices B (... x 6 x 24) from dNx."""
+    B = np.zeros(dNx.shape[:-2] + (6, 24))
+    B[..., 0, 0::3] = dNx[..., 0, :]
+    B[..., 1, 1::3] = dNx[..., 1, :]
+    B[..., 2, 2::3] = dNx[..., 2, :]
+    B[..., 3, 0::3] = dNx[..., 1, :]
+    B[..., 3, 1::3] = dNx[..., 0, :]
+    B[..., 4, 0::3] = dNx[..., 2, :]
+    B[..., 4, 2::3] = dNx[..., 0, :]
+    B[..., 5, 1::3] = dNx[..., 2, :]
+    B[..., 5, 2::3] = dNx[..., 1, :]
+    return B
+
+
+_soli8_chunk_size = 4096
+
+
+def soli8e_batch(ex, ey, ez, ep, D, eq=None):
+    """
+    Calculate the stiffness matrices for a set of 8 node (brick)
+    isoparametric elements. Batched version of soli8e.
+
+    Parameters:
+
+        ex = [[x1 x2 x3 ... x8],    element coordinates, one row per
+              [.................]]  element, dim(ex) = nel x 8
+        ey = [[y1 y2 y3 ... y8],
+              [.................]]
+        ez = [[z1 z2 z3 ... z8],
+              [.................]]
+
+        ep = [ir]                   ir integration rule
+
+        D                           constitutive matrix
+
+        eq = [bx, by, bz]           bx: body force in x direction
+                                    by: body force in y direction
+                                    bz: body force in z direction
+                                    or one row per element,
+                                    dim(eq) = nel x 3
+
+    Returns:
+
+        Ke                          element stiffness matrices
+                                    (nel x 24 x 24)
+        fe                          equivalent nodal forces (nel x 24)
+                                    (if eq is given)
+    """
+    ex = np.atleast_2d(np.asarray(ex, dtype=float))
+    ey = np.atleast_2d(np.asarray(ey, dtype=float))
+    ez = np.atleast_2d(np.asarray(ez, dtype=float))
+    nel = ex.shape[0]
+
+    N, dNr, wp = _soli8_ref_tables(ep[0])
+    D = np.asarray(D, dtype=float)
+
+    Ke = np.empty((nel, 24, 24))
+    dV = np.empty((nel, N.shape[0]))
+
+    # Elements are processed in chunks to bound the size of the B stack
+
+    for i0 in range(0, nel, _soli8_chunk_size):
+        i1 = min(i0+_soli8_chunk_size, nel)
+        detJ, dNx = _soli8_dnx(ex[i0:i1], ey[i0:i1], ez[i0:i1], dNr)
+        B = _soli8_b(dNx)
+        dV[i0:i1] = detJ*wp
+        Ke[i0:i1] = np.einsum('egji,jk,egkl,eg->eil', B,
+                              D, B, dV[i0:i1], optimize=True)
+
+    if eq is None:
+        return Ke
+
+    q = _batch_eq(eq, nel, 3)
+    NdV = dV@N
+
+    fe = np.empty((nel, 24))
+    fe[:, 0::3] = NdV*q[:, 0:1]
+    fe[:, 1::3] = NdV*q[:, 1:2]
+    fe[:, 2::3] = NdV*q[:, 2:3]
+
+    return Ke, fe
+
+
+def soli8s_batch(ex, ey, ez, ep, D, ed):
+    """
+    Calculate element normal and shear stress for a set of 8 node
+    (brick) isoparametric elements. Batched version of soli8s.
+
+    Parameters:
+
+        ex = [[x1 x2 x3 ... x8],    element coordinates, one row per
+              [.................]]  element, dim(ex) = nel x 8
+        ey = [[y1 y2 y3 ... y8],
+              [.................]]
+        ez = [[z1 z2 z3 ... z8],
+              [.................]]
+
+        ep = [ir]                   ir: integration rule
+
+        D                           constitutive matrix
+
+        ed = [[u1 u2 ..u24],        element displacements, one row per
+              [.............]]      element, dim(ed) = nel x 24
+
+    Returns:
+
+        et                          element strains, one row for each
+                                    integration point,
+                                    dim(et) = nel x ngp x 6
+        es                          element stresses,
+                                    dim(es) = nel x ngp x 6
+        eci                         integration point coordinates,
+                                    dim(eci) = nel x ngp x 3
+    """
+    ex = np.atleast_2d(np.asarray(ex, dtype=float))
+    ey = np.atleast_2d(np.asarray(ey, dtype=float))
+    ez = np.atleast_2d(np.asarray(ez, dtype=float))
+    ed = np.asarray(ed, dtype=float).reshape(-1, 24)
+    nel = ex.shape[0]
+
+    N, dNr, wp = _soli8_ref_tables(ep[0])
+    ngp = N.shape[0]
+    D = np.asarray(D, dtype=float)
+
+    eci = np.einsum('gn,enj->egj', N, np.stack((ex, ey, ez), axis=2))
+
+    et = np.empty((nel, ngp, 6))
+
+    for i0 in range(0, nel, _soli8_chunk_size):
+        i1 = min(i0+_soli8_chunk_size, nel)
+        _, dNx = _soli8_dnx(ex[i0:i1], ey[i0:i1], ez[i0:i1], dNr)
+        et[i0:i1] = np.einsum('egij,ej->egi', _soli8_b(dNx), ed[i0:i1])
+
+    es = et@D.T
+
+    return et, es, eci
+
+
 def assem(edof, K, Ke, f=None, fe=None):
     """
     Assemble element matrices Ke ( and fe ) into the global
@@ -5279,91 +5756,495 @@ def assem(edof, K, Ke, f=None, fe=None):
         return K, f
 
 
-def solveq(K, f, bcPrescr=None, bcVal=None):
+def spassem(edof, Ke, nDofs=None, f=None, fe=None):
     """
-    Solve static FE-equations considering boundary conditions.
-    
+    Assemble all element matrices Ke ( and fe ) into a sparse global
+    stiffness matrix K ( and the global force vector f ) in a single
+    vectorized pass according to the topology matrix edof.
+
     Parameters:
-    
-        K           global stiffness matrix, dim(K)= nd x nd
-        f           global load vector, dim(f)= nd x 1
-    
-        bcPrescr    1-dim integer array containing prescribed dofs.
-        bcVal       1-dim float array containing prescribed values.
-                    If not given all prescribed dofs are assumed 0.
-        
+
+        edof        dof topology array, dim(edof) = nel x nedof
+        Ke          stacked element stiffness matrices,
+                    dim(Ke) = nel x nedof x nedof. A single element
+                    matrix, dim(Ke) = nedof x nedof, is used for
+                    all elements.
+        nDofs       number of dofs in the global system. If not given
+                    the largest dof number in edof is used.
+        f           the global force vector
+        fe          stacked element force vectors, dim(fe) = nel x nedof
+                    or a single element force vector used for all
+                    elements
+
     Returns:
-    
-        a           solution including boundary values
-        Q           reaction force vector
-                    dim(a)=dim(Q)= nd x 1, nd : number of dof's
-    
+
+        K           the global stiffness matrix (scipy.sparse CSR)
+        f           the new global force vector (if f and fe are given)
+
     """
 
-    nDofs = K.shape[0]
-    nPdofs = bcPrescr.shape[0]
+    edof = np.atleast_2d(np.asarray(edof))
+    nel, nedof = edof.shape
 
-    if bcVal is None:
-        bcVal = np.zeros([nPdofs], 'd')
+    if nDofs is None:
+        nDofs = int(edof.max())
 
-    if bcPrescr is None:
-        return np.asmatrix(np.linalg.solve(K, f))
+    Ke = np.asarray(Ke, dtype=float)
+    if Ke.ndim == 2:
+        Ke = np.broadcast_to(Ke, (nel, nedof, nedof))
 
-    bc = np.ones(nDofs, 'bool')
-    bcDofs = np.arange(nDofs)
+    if Ke.shape != (nel, nedof, nedof):
+        raise ValueError(
+            "Ke must be nedof x nedof or nel x nedof x nedof (spassem)")
 
-    bc[np.ix_(bcPrescr-1)] = False
-    bcDofs = bcDofs[bc]
+    idx = edof-1
+    rows = np.broadcast_to(idx[:, :, None], (nel, nedof, nedof)).ravel()
+    cols = np.broadcast_to(idx[:, None, :], (nel, nedof, nedof)).ravel()
 
-    fsys = f[bcDofs]-K[np.ix_((bcDofs), (bcPrescr-1))] * \
-        np.asmatrix(bcVal).reshape(nPdofs, 1)
-    asys = np.linalg.solve(K[np.ix_((bcDofs), (bcDofs))], fsys)
+    # Duplicate (row, col) entries are summed by the COO -> CSR conversion
 
-    a = np.zeros([nDofs, 1])
-    a[np.ix_(bcPrescr-1)] = np.asmatrix(bcVal).reshape(nPdofs, 1)
-    a[np.ix_(bcDofs)] = asys
+    K = sp.coo_matrix((Ke.ravel(), (rows, cols)),
+                      shape=(nDofs, nDofs)).tocsr()
 
-    Q = K*np.asmatrix(a)-f
+    if (f is None) or (fe is None):
+        return K
 
-    return (np.asmatrix(a), Q)
+    fe = np.asarray(fe, dtype=float).reshape(-1, nedof)
+    fe = np.broadcast_to(fe, (nel, nedof))
 
+    fv = np.bincount(idx.ravel(), weights=fe.ravel(), minlength=nDofs)
+    f[:] = f + fv.reshape(np.shape(f))
 
-def spsolveq(K, f, bcPrescr, bcVal=None):
+    return K, f
+
+
+class SparsityPattern:
     """
-    Solve static FE-equations considering boundary conditions.
-    
+    Symbolic assembly of a sparse global matrix for a fixed topology.
+
+    The CSR pattern of K and a scatter map from the entries of the
+    stacked element matrices to K.data are computed once from edof.
+    Each assembly is then one vectorized summation into the data array
+    of the matrix, without sorting or reallocating the pattern, which
+    suits iterative schemes that rebuild K many times.
+
     Parameters:
-    
-        K           global stiffness matrix, dim(K)= nd x nd
-        f           global load vector, dim(f)= nd x 1
-    
-        bcPrescr    1-dim integer array containing prescribed dofs.
-        bcVal       1-dim float array containing prescribed values.
-                    If not given all prescribed dofs are assumed 0.
-        
-    Returns:
-    
-        a           solution including boundary values
-        Q           reaction force vector
-                    dim(a)=dim(Q)= nd x 1, nd : number of dof's
-    
-    """
 
-    nDofs = K.shape[0]
-    nPdofs = bcPrescr.shape[0]
+        edof        dof topology array, dim(edof) = nel x nedof
+        nDofs       number of dofs in the global system. If not given
+                    the largest dof number in edof is used.
 
-    if bcVal is None:
-        bcVal = np.zeros([nPdofs], 'd')
+    Attributes:
 
-    bc = np.ones(nDofs, 'bool')
-    bcDofs = np.arange(nDofs)
+        n_dofs      number of dofs, nd
+        indptr      CSR row pointers of the pattern
+        indices     CSR column indices of the pattern
+        scatter     position in K.data of each entry of the stacked
+                    element matrices, dim(scatter) = nel*nedof*nedof
+    """
 
-    bc[np.ix_(bcPrescr-1)] = False
-    bcDofs = bcDofs[bc]
+    def __init__(self, edof, nDofs=None):
+        self.edof = np.atleast_2d(np.asarray(edof))
+        nel, nedof = self.edof.shape
 
-    bcVal_m = np.asmatrix(bcVal).reshape(nPdofs, 1)
+        if nDofs is None:
+            nDofs = int(self.edof.max())
+        self.n_dofs = nDofs
 
-    info("Preparing system matrix...")
+        idx = (self.edof-1).astype(np.int64)
+        rows = np.broadcast_to(idx[:, :, None], (nel, nedof, nedof)).ravel()
+        cols = np.broadcast_to(idx[:, None, :], (nel, nedof, nedof)).ravel()
+
+        # Row-major keys sort in CSR order
+
+        keys, self.scatter = np.unique(rows*nDofs+cols, return_inverse=True)
+        self.scatter = self.scatter.ravel()
+
+        self.indices = (keys % nDofs).astype(np.int32)
+        self.indptr = np.zeros(nDofs+1, dtype=np.int32)
+        np.cumsum(np.bincount(keys//nDofs, minlength=nDofs), out=self.indptr[1:])
+
+    def assem(self, Ke, K=None, f=None, fe=None):
+        """
+        Assemble the stacked element matrices Ke ( and fe ).
+
+        Parameters:
+
+            Ke          stacked element matrices, dim(Ke) = nel x nedof x nedof,
+                        or a single element matrix used for all elements
+            K           a matrix from a previous call, whose data is
+                        overwritten in place. If not given a new CSR
+                        matrix sharing the pattern arrays is returned.
+            f           the global force vector
+            fe          stacked element force vectors, dim(fe) = nel x nedof
+
+        Returns:
+
+            K           the global stiffness matrix (scipy.sparse CSR)
+            f           the new global force vector (if f and fe are given)
+        """
+        nel, nedof = self.edof.shape
+
+        Ke = np.asarray(Ke, dtype=float)
+        if Ke.ndim == 2:
+            Ke = np.broadcast_to(Ke, (nel, nedof, nedof))
+
+        data = np.bincount(self.scatter, weights=Ke.ravel(),
+                           minlength=self.indices.shape[0])
+
+        if K is None:
+            K = sp.csr_matrix((data, self.indices, self.indptr),
+                              shape=(self.n_dofs, self.n_dofs))
+        else:
+            K.data[...] = data
+
+        if f is None or fe is None:
+            return K
+
+        fe = np.asarray(fe, dtype=float)
+        if fe.ndim == 1:
+            fe = np.broadcast_to(fe, (nel, nedof))
+
+        fv = np.bincount(self.edof.ravel()-1, weights=fe.ravel(),
+                         minlength=self.n_dofs)
+        f[:] = f + fv.reshape(np.shape(f))
+
+        return K, f
+
+
+def spassem_parallel(edof, kernel, ex, ey=None, ez=None, args=(), nDofs=None,
+                     workers=None, chunk_size=None, executor='process'):
+    """
+    Compute the element matrices with an element routine in parallel
+    and assemble them into a sparse global stiffness matrix.
+
+    The elements are split into chunks. Each worker evaluates the element
+    routine for the elements of a chunk and returns COO triplets, which
+    are merged into one CSR matrix. With the process executor, edof and
+    the element coordinates are placed in shared memory so they are not
+    copied to every task.
+
+    Parameters:
+
+        edof        dof topology array, dim(edof) = nel x nedof
+        kernel      element routine called as kernel(ex[i], ey[i], ez[i], *args)
+                    (ey and ez only if given) returning Ke, e.g. plante,
+                    planqe, flw2i4e or soli8e. For the process executor
+                    it must be picklable, e.g. a module level function.
+        ex, ey, ez  element coordinates, dim = nel x nen
+        args        additional arguments to kernel, e.g. (ep, D)
+        nDofs       number of dofs in the global system. If not given
+                    the largest dof number in edof is used.
+        workers     number of workers, default os.cpu_count()
+        chunk_size  number of elements per task, default gives about
+                    four tasks per worker
+        executor    'process' (default) or 'thread'
+
+    Returns:
+
+        K           the global stiffness matrix (scipy.sparse CSR)
+    """
+    edof = np.atleast_2d(np.asarray(edof))
+    nel = edof.shape[0]
+
+    if nDofs is None:
+        nDofs = int(edof.max())
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    if chunk_size is None:
+        chunk_size = max(1, -(-nel//(4*workers)))
+
+    arrays = [edof]+[np.asarray(c, dtype=float)
+                     for c in (ex, ey, ez) if c is not None]
+    chunks = [(start, min(start+chunk_size, nel))
+              for start in range(0, nel, chunk_size)]
+
+    if executor == 'thread':
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            parts = list(pool.map(
+                lambda chunk: _assem_chunk(kernel, arrays, chunk[0], chunk[1], args),
+                chunks))
+    elif executor == 'process':
+        blocks = []
+        specs = []
+        try:
+            for array in arrays:
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks.append(block)
+                np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+                specs.append((block.name, array.shape, array.dtype.str))
+
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(_assem_shared_chunk, kernel, specs, start, stop, args)
+                           for start, stop in chunks]
+                parts = [future.result() for future in futures]
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+    else:
+        raise ValueError("Unknown executor %s." % executor)
+
+    rows, cols, data = (np.concatenate(part) for part in zip(*parts))
+
+    return sp.coo_matrix((data, (rows, cols)), shape=(nDofs, nDofs)).tocsr()
+
+
+def _assem_chunk(kernel, arrays, start, stop, args):
+    """COO triplets of the element matrices of elements start:stop."""
+    idx = arrays[0][start:stop]-1
+    coords = [array[start:stop] for array in arrays[1:]]
+
+    Ke = np.array([np.asarray(kernel(*[c[i] for c in coords], *args), dtype=float)
+                   for i in range(stop-start)])
+
+    nedof = idx.shape[1]
+    rows = np.repeat(idx, nedof, axis=1).ravel()
+    cols = np.tile(idx, (1, nedof)).ravel()
+
+    return rows, cols, Ke.ravel()
+
+
+def _assem_shared_chunk(kernel, specs, start, stop, args):
+    """_assem_chunk on arrays in shared memory, run in a worker process."""
+    blocks = [shared_memory.SharedMemory(name=name) for name, _, _ in specs]
+    try:
+        arrays = [np.ndarray(shape, dtype, buffer=block.buf)
+                  for block, (_, shape, dtype) in zip(blocks, specs)]
+        result = _assem_chunk(kernel, arrays, start, stop, args)
+        del arrays
+    finally:
+        for block in blocks:
+            block.close()
+    return result
+
+
+class BoundaryConditions:
+    """
+    Prescribed dofs and values collected incrementally.
+
+    Boundary conditions are stored in arrays preallocated for all dofs,
+    so adding a condition is a single indexed assignment. The free and
+    prescribed partition is computed once, when first requested, and
+    reused until more conditions are added. A BoundaryConditions object
+    can be passed as bcPrescr to solveq, spsolveq and PreparedSystem.
+
+    A value given for a dof that is already prescribed replaces the
+    previous value.
+
+    Parameters:
+
+        n_dofs          number of dofs, nd
+        dofs_per_node   number of dofs per node, used to select dofs
+                        by dimension
+
+    Attributes:
+
+        bc_prescr       1-dim integer array containing prescribed dofs.
+        bc_val          1-dim float array containing prescribed values.
+        prescr_dofs     0-based indices of the prescribed dofs
+        free_dofs       0-based indices of the free dofs
+    """
+
+    def __init__(self, n_dofs, dofs_per_node=1):
+        self.n_dofs = n_dofs
+        self.dofs_per_node = dofs_per_node
+
+        self._prescribed = np.zeros(n_dofs, dtype=bool)
+        self._values = np.zeros(n_dofs)
+        self._partition = None
+
+    def add_dofs(self, dofs, value=0.0):
+        """
+        Prescribe dofs (1-based) to value. value is a scalar or an
+        array with one value for each dof.
+        """
+        idx = np.asarray(dofs, dtype=int).ravel()-1
+        self._prescribed[idx] = True
+        self._values[idx] = value
+        self._partition = None
+
+    def add_marker(self, boundaryDofs, marker, value=0.0, dimension=0):
+        """
+        Prescribe the dofs of a boundary marker.
+
+        Parameters:
+
+            boundaryDofs    Dictionary with boundary dofs.
+            marker          Boundary marker to assign boundary condition.
+            value           Value to assign boundary condition.
+            dimension       dimension to apply bc. 0 - all, 1 - x, 2 - y,
+                            3 - z
+        """
+        if marker not in boundaryDofs:
+            raise KeyError("Boundary marker %s does not exist." % marker)
+
+        self.add_dofs(self._select(boundaryDofs[marker], dimension), value)
+
+    def add_node(self, nodeIdx, dofs, value=0.0, dimension=0):
+        """
+        Prescribe the dofs of node(s) nodeIdx (0-based rows of dofs).
+        """
+        nodeDofs = np.asarray(dofs)[np.atleast_1d(nodeIdx)]
+        self.add_dofs(self._select(nodeDofs.ravel(), dimension), value)
+
+    def _select(self, dofs, dimension):
+        dofs = np.asarray(dofs, dtype=int).ravel()
+        if dimension == 0:
+            return dofs
+        if not 1 <= dimension <= self.dofs_per_node:
+            raise ValueError("Wrong dimension %d." % dimension)
+        return dofs[dimension-1::self.dofs_per_node]
+
+    def partition(self):
+        """
+        Return (prescr_dofs, free_dofs), 0-based and sorted.
+        """
+        if self._partition is None:
+            self._partition = (np.flatnonzero(self._prescribed),
+                               np.flatnonzero(~self._prescribed))
+        return self._partition
+
+    @property
+    def prescr_dofs(self):
+        return self.partition()[0]
+
+    @property
+    def free_dofs(self):
+        return self.partition()[1]
+
+    @property
+    def bc_prescr(self):
+        return self.prescr_dofs+1
+
+    @property
+    def bc_val(self):
+        return self._values[self.prescr_dofs]
+
+
+def _bc_partition(nDofs, bcPrescr, bcVal):
+    """
+    Return prescribed and free dofs (0-based) and prescribed values
+    for bcPrescr given as an array or a BoundaryConditions object.
+    """
+    if isinstance(bcPrescr, BoundaryConditions):
+        prescrDofs, freeDofs = bcPrescr.partition()
+        if bcVal is None:
+            bcVal = bcPrescr.bc_val
+        return prescrDofs, freeDofs, bcVal
+
+    prescrDofs = np.asarray(bcPrescr, dtype=int).ravel()-1
+
+    free = np.ones(nDofs, dtype=bool)
+    free[prescrDofs] = False
+
+    if bcVal is None:
+        bcVal = np.zeros([prescrDofs.shape[0]], 'd')
+
+    return prescrDofs, np.flatnonzero(free), bcVal
+
+
+def solveq(K, f, bcPrescr=None, bcVal=None):
+    """
+    Solve static FE-equations considering boundary conditions.
+    
+    Parameters:
+    
+        K           global stiffness matrix, dim(K)= nd x nd
+        f           global load vector, dim(f)= nd x 1
+    
+        bcPrescr    1-dim integer array containing prescribed dofs,
+                    or a BoundaryConditions object.
+        bcVal       1-dim float array containing prescribed values.
+                    If not given all prescribed dofs are assumed 0,
+                    or taken from bcPrescr if it is a BoundaryConditions.
+        
+    Returns:
+    
+        a           solution including boundary values
+        Q           reaction force vector
+                    dim(a)=dim(Q)= nd x 1, nd : number of dof's
+
+    See also PreparedSystem.
+    
+    """
+
+    if bcPrescr is None:
+        return np.asmatrix(np.linalg.solve(K, f))
+
+    nDofs = K.shape[0]
+    prescrDofs, bcDofs, bcVal = _bc_partition(nDofs, bcPrescr, bcVal)
+    nPdofs = prescrDofs.shape[0]
+
+    fsys = f[bcDofs]-K[np.ix_((bcDofs), (prescrDofs))] * \
+        np.asmatrix(bcVal).reshape(nPdofs, 1)
+    asys = np.linalg.solve(K[np.ix_((bcDofs), (bcDofs))], fsys)
+
+    a = np.zeros([nDofs, 1])
+    a[np.ix_(prescrDofs)] = np.asmatrix(bcVal).reshape(nPdofs, 1)
+    a[np.ix_(bcDofs)] = asys
+
+    Q = K*np.asmatrix(a)-f
+
+    return (np.asmatrix(a), Q)
+
+
+def spsolveq(K, f, bcPrescr, bcVal=None, method='direct', precond='jacobi',
+             tol=1e-8, maxiter=None, a0=None, dofs_per_node=1, residuals=None):
+    """
+    Solve static FE-equations considering boundary conditions.
+    
+    Parameters:
+    
+        K           global stiffness matrix, dim(K)= nd x nd
+        f           global load vector, dim(f)= nd x 1
+    
+        bcPrescr    1-dim integer array containing prescribed dofs,
+                    or a BoundaryConditions object.
+        bcVal       1-dim float array containing prescribed values.
+                    If not given all prescribed dofs are assumed 0,
+                    or taken from bcPrescr if it is a BoundaryConditions.
+
+        method      'direct' (sparse LU, default) or 'pcg', the
+                    preconditioned conjugate gradient method for
+                    symmetric positive definite K.
+        precond     preconditioner for 'pcg': 'jacobi' (default),
+                    'block-jacobi' (blocks of dofs_per_node dofs per
+                    node), 'ilu' (incomplete LU factorization, spilu), 'amg'
+                    (smoothed aggregation multigrid, see
+                    AMGPreconditioner) or a function z = precond(r)
+                    acting on the free dofs, e.g. an AMGPreconditioner
+                    set up once and reused for several load cases.
+        tol         relative residual tolerance for 'pcg'
+        maxiter     maximum number of iterations for 'pcg',
+                    default 10*nd
+        a0          initial guess for 'pcg', e.g. a previous solution,
+                    dim(a0) = nd x 1
+        dofs_per_node  number of dofs per node for 'block-jacobi'. The
+                    dofs of node i are assumed to be numbered
+                    i*dofs_per_node+1, ..., (i+1)*dofs_per_node.
+        residuals   optional list, the relative residual norm of each
+                    'pcg' iteration is appended to it
+        
+    Returns:
+    
+        a           solution including boundary values
+        Q           reaction force vector
+                    dim(a)=dim(Q)= nd x 1, nd : number of dof's
+
+    See also PreparedSystem.
+    
+    """
+
+    nDofs = K.shape[0]
+    prescrDofs, bcDofs, bcVal = _bc_partition(nDofs, bcPrescr, bcVal)
+    nPdofs = prescrDofs.shape[0]
+
+    bcVal_m = np.asmatrix(bcVal).reshape(nPdofs, 1)
+
+    info("Preparing system matrix...")
 
     mask = np.ones(K.shape[0], dtype=bool)
     mask[bcDofs] = False
@@ -5373,7 +6254,7 @@ def spsolveq(K, f, bcPrescr, bcVal=None):
     info("step 2... Kt")
     #Kt1 = K[bcDofs]
     #Kt = Kt1[:,bcPrescr]
-    Kt = K[np.ix_((bcDofs), (bcPrescr-1))]
+    Kt = K[np.ix_((bcDofs), (prescrDofs))]
     info("step 3... fsys")
     fsys = f[bcDofs]-Kt*bcVal_m
     info("step 4... Ksys")
@@ -5383,11 +6264,22 @@ def spsolveq(K, f, bcPrescr, bcVal=None):
     info("done...")
 
     info("Solving system...")
-    asys = dsolve.spsolve(Ksys, fsys)
+    if method == 'direct':
+        asys = dsolve.spsolve(Ksys, fsys)
+    elif method == 'pcg':
+        if not callable(precond):
+            precond = _preconditioner(Ksys, precond, bcDofs, dofs_per_node)
+        x0 = None
+        if a0 is not None:
+            x0 = np.asarray(a0, dtype=float).ravel()[bcDofs]
+        asys = _pcg(Ksys, np.asarray(fsys, dtype=float).ravel(), precond,
+                    x0, tol, maxiter, residuals)
+    else:
+        raise ValueError("Unknown method %s." % method)
 
     info("Reconstructing full a...")
     a = np.zeros([nDofs, 1])
-    a[np.ix_(bcPrescr-1)] = bcVal_m
+    a[np.ix_(prescrDofs)] = bcVal_m
     a[np.ix_(bcDofs)] = np.asmatrix(asys).transpose()
 
     a_m = np.asmatrix(a)
@@ -5396,7 +6288,658 @@ def spsolveq(K, f, bcPrescr, bcVal=None):
     return (a_m, Q)
 
 
-def eigen(K,M,b=None):
+class PreparedSystem:
+    """
+    Static FE-equations K a = f prepared for repeated solution with
+    the same system matrix and the same prescribed dofs.
+
+    The free/prescribed partition of K is computed and the free part
+    Kff is factorized once (sparse LU for scipy.sparse K, dense LU
+    otherwise). Each call to solve() then only performs triangular
+    solves, for any number of load cases at once.
+
+    Parameters:
+
+        K           global stiffness matrix, dim(K)= nd x nd,
+                    dense or scipy.sparse
+        bcPrescr    1-dim integer array containing prescribed dofs,
+                    or a BoundaryConditions object.
+
+    Attributes:
+
+        n_dofs      number of dofs, nd
+        free_dofs   0-based indices of the free dofs
+        prescr_dofs 0-based indices of the prescribed dofs
+    """
+
+    def __init__(self, K, bcPrescr=None):
+        self.sparse = sp.issparse(K)
+
+        if self.sparse:
+            self.K = K.tocsr()
+        else:
+            self.K = np.asarray(K, dtype=float)
+
+        self.n_dofs = self.K.shape[0]
+
+        if bcPrescr is None:
+            bcPrescr = np.array([], dtype=int)
+
+        self.prescr_dofs, self.free_dofs, self.bc_val = _bc_partition(
+            self.n_dofs, bcPrescr, None)
+
+        info("Preparing system matrix...")
+
+        if self.sparse:
+            Kf = self.K[self.free_dofs]
+            self.Kfp = Kf[:, self.prescr_dofs]
+            self.factor = splu(Kf[:, self.free_dofs].tocsc())
+        else:
+            self.Kfp = self.K[np.ix_(self.free_dofs, self.prescr_dofs)]
+            self.factor = lu_factor(
+                self.K[np.ix_(self.free_dofs, self.free_dofs)])
+
+        info("done...")
+
+    def _solve_free(self, rhs):
+        if self.sparse:
+            return self.factor.solve(rhs)
+        else:
+            return lu_solve(self.factor, rhs)
+
+    def solve(self, f, bcVal=None):
+        """
+        Solve the prepared system for one or more load cases.
+
+        Parameters:
+
+            f           global load vectors, dim(f)= nd x nrhs
+                        (or nd for a single load case)
+            bcVal       prescribed values, dim(bcVal) = npd x nrhs, or
+                        npd for the same values in all load cases.
+                        If not given the values of the BoundaryConditions
+                        object are used, otherwise all prescribed dofs are
+                        assumed 0.
+
+        Returns:
+
+            a           solutions including boundary values
+            Q           reaction force vectors
+                        dim(a)=dim(Q)= nd x nrhs
+        """
+        f = np.asarray(f, dtype=float).reshape(self.n_dofs, -1)
+        nPdofs = self.prescr_dofs.shape[0]
+
+        if bcVal is None:
+            bcVal = self.bc_val
+        if nPdofs == 0:
+            bcVal = np.zeros((0, 1))
+        else:
+            bcVal = np.asarray(bcVal, dtype=float).reshape(nPdofs, -1)
+
+        nrhs = max(f.shape[1], bcVal.shape[1])
+
+        a = np.zeros((self.n_dofs, nrhs))
+        a[self.prescr_dofs] = bcVal
+
+        fsys = f[self.free_dofs] - self.Kfp@bcVal
+        a[self.free_dofs] = self._solve_free(
+            np.broadcast_to(fsys, (self.free_dofs.shape[0], nrhs)))
+
+        Q = self.K@a - f
+
+        return a, Q
+
+
+def _preconditioner(A, precond, freeDofs, dofs_per_node=1):
+    """
+    Set up a preconditioner for the free part A of a system matrix and
+    return it as a function z = M^-1 r. freeDofs are the (0-based)
+    global dofs of the rows of A.
+    """
+    A = sp.csr_matrix(A)
+
+    if precond == 'jacobi':
+        dinv = 1.0/A.diagonal()
+        return lambda r: dinv*r
+    elif precond == 'block-jacobi':
+        # Keep the couplings between dofs of the same node. The node
+        # blocks are inverted at once, dofs missing in a block (prescribed
+        # dofs) are padded with the identity.
+        freeDofs = np.asarray(freeDofs)
+        nodes, blk = np.unique(freeDofs//dofs_per_node, return_inverse=True)
+        blk = blk.ravel()
+        loc = freeDofs % dofs_per_node
+        B = np.zeros((nodes.shape[0], dofs_per_node, dofs_per_node))
+        B[:, np.arange(dofs_per_node), np.arange(dofs_per_node)] = 1.0
+        Acoo = A.tocoo()
+        inBlock = blk[Acoo.row] == blk[Acoo.col]
+        B[blk[Acoo.row[inBlock]], loc[Acoo.row[inBlock]],
+          loc[Acoo.col[inBlock]]] = Acoo.data[inBlock]
+        Binv = np.linalg.inv(B)
+        pos = blk*dofs_per_node+loc
+
+        def block_solve(r):
+            rb = np.zeros(B.shape[:2])
+            rb.ravel()[pos] = r
+            return np.einsum('nij,nj->ni', Binv, rb).ravel()[pos]
+        return block_solve
+    elif precond == 'ilu':
+        # Threshold incomplete LU with a symmetric fill-reducing ordering
+        # and no pivoting. A larger drop_tol saves little fill but the
+        # iteration count grows quickly for stiff elasticity problems.
+        ilu = spilu(A.tocsc(), drop_tol=1e-5, fill_factor=20,
+                    permc_spec='MMD_AT_PLUS_A', diag_pivot_thresh=0,
+                    options=dict(Equil=False, SymmetricMode=True))
+        return ilu.solve
+    elif precond == 'amg':
+        return AMGPreconditioner(A, dofs_per_node=dofs_per_node,
+                                 node=np.asarray(freeDofs)//dofs_per_node)
+    else:
+        raise ValueError("Unknown preconditioner %s." % precond)
+
+
+def _pcg(A, b, precond, x0=None, tol=1e-8, maxiter=None, residuals=None):
+    """
+    Preconditioned conjugate gradient solution of A x = b, for
+    symmetric positive definite A, to a relative residual of tol.
+    """
+    n = b.shape[0]
+
+    if maxiter is None:
+        maxiter = 10*n
+
+    if x0 is None:
+        x = np.zeros(n)
+        r = b.copy()
+    else:
+        x = np.array(x0, dtype=float)
+        r = b-A@x
+
+    bnorm = np.linalg.norm(b)
+    if bnorm == 0.0:
+        return np.zeros(n)
+
+    z = precond(r)
+    p = z.copy()
+    rz = r@z
+
+    for iteration in range(maxiter):
+        resnorm = np.linalg.norm(r)/bnorm
+        if residuals is not None:
+            residuals.append(resnorm)
+        if resnorm <= tol:
+            info("PCG converged in %d iterations." % iteration)
+            return x
+
+        Ap = A@p
+        alpha = rz/(p@Ap)
+        x += alpha*p
+        r -= alpha*Ap
+
+        z = precond(r)
+        rzNew = r@z
+        p = z+(rzNew/rz)*p
+        rz = rzNew
+
+    warnings.warn("PCG did not converge in %d iterations (residual %g)." % (
+        maxiter, np.linalg.norm(r)/bnorm), RuntimeWarning)
+
+    return x
+
+
+class AMGPreconditioner:
+    """
+    Smoothed aggregation algebraic multigrid preconditioner for the free
+    part of a symmetric positive definite system matrix, for use with
+    spsolveq(..., method='pcg', precond=M).
+
+    The multigrid hierarchy is set up once. Each call applies one
+    V-cycle with damped Jacobi smoothing, so the preconditioner can be
+    reused for any number of load cases with the same K and bcPrescr.
+
+    The near-nullspace is built from the mesh: rigid-body modes for
+    elasticity (dofs_per_node equal to the number of coordinates, or 3
+    dofs per node in 2D for beams), otherwise one constant mode per
+    dof of a node.
+
+    Parameters:
+
+        K               global stiffness matrix, dim(K) = nd x nd, sparse
+        bcPrescr        1-dim integer array containing prescribed dofs,
+                        or a BoundaryConditions object
+        coords          node coordinates, dim(coords) = nnodes x ndims
+        dofs            node dofs, dim(dofs) = nnodes x dofs_per_node
+        dofs_per_node   number of dofs per node, if dofs is not given
+        theta           strength of connection threshold
+        max_coarse      size below which the coarsest level is solved
+                        directly
+        max_levels      maximum number of levels
+        sweeps          number of pre- and post-smoothing sweeps
+        node            (internal) node index of each row of K, used
+                        instead of dofs and dofs_per_node
+
+    Attributes:
+
+        levels          list of (A, P, w) for each level: the level matrix,
+                        the prolongator and the Jacobi smoother weights
+    """
+
+    def __init__(self, K, bcPrescr=None, coords=None, dofs=None,
+                 dofs_per_node=1, theta=0.08, max_coarse=500, max_levels=10,
+                 sweeps=1, node=None):
+        K = sp.csr_matrix(K)
+        nd = K.shape[0]
+
+        if dofs is not None:
+            dofs = np.asarray(dofs, dtype=int)
+            dofs_per_node = dofs.shape[1]
+
+        if node is None:
+            node = _dof_nodes(nd, dofs, dofs_per_node)
+
+        B = _near_nullspace(nd, coords, dofs, dofs_per_node)
+
+        if bcPrescr is not None:
+            _, freeDofs, _ = _bc_partition(nd, bcPrescr, None)
+            K = K[freeDofs][:, freeDofs]
+            node = node[freeDofs]
+            B = B[freeDofs]
+
+        self.n_dofs = K.shape[0]
+        self.sweeps = sweeps
+        self.levels = []
+
+        A = K
+        while A.shape[0] > max_coarse and len(self.levels) < max_levels-1:
+            aggregates = _sa_aggregate(A, node, theta)
+            T, B, node = _sa_tentative(aggregates, B)
+
+            Dinv = sp.diags(1.0/A.diagonal())
+            DinvA = (Dinv@A).tocsr()
+            omega = 4.0/(3.0*_spectral_radius(DinvA))
+
+            P = (T-omega*(DinvA@T)).tocsr()
+            self.levels.append((A, P, omega*Dinv.diagonal()))
+
+            Ac = (P.T@A@P).tocsr()
+            if Ac.shape[0] >= A.shape[0]:
+                break
+            A = Ac
+
+        info("AMG: %d levels, coarse size %d." % (len(self.levels)+1, A.shape[0]))
+
+        self._coarse_solve = _factorized(sp.csc_matrix(A))
+
+    def _vcycle(self, level, b):
+        if level == len(self.levels):
+            return self._coarse_solve(b)
+
+        A, P, w = self.levels[level]
+
+        x = w*b
+        for sweep in range(self.sweeps-1):
+            x += w*(b-A@x)
+
+        x += P@self._vcycle(level+1, P.T@(b-A@x))
+
+        for sweep in range(self.sweeps):
+            x += w*(b-A@x)
+
+        return x
+
+    def __call__(self, r):
+        return self._vcycle(0, r)
+
+
+def _dof_nodes(nd, dofs=None, dofs_per_node=1):
+    """Node index (0-based) of each dof."""
+    if dofs is None:
+        return np.arange(nd)//dofs_per_node
+
+    node = np.zeros(nd, dtype=int)
+    node[dofs.ravel()-1] = np.repeat(np.arange(dofs.shape[0]), dofs.shape[1])
+    return node
+
+
+def _near_nullspace(nd, coords=None, dofs=None, dofs_per_node=1):
+    """
+    Near-nullspace vectors, dim = nd x nb: rigid-body modes if coords
+    and dofs allow it, otherwise one constant mode per dof of a node.
+    """
+    if dofs is None:
+        dofs = np.arange(nd).reshape(-1, dofs_per_node)+1
+    dpn = dofs.shape[1]
+
+    if coords is not None:
+        coords = np.asarray(coords, dtype=float)
+        x = coords[:, 0]
+        y = coords[:, 1] if coords.shape[1] > 1 else np.zeros_like(x)
+        z = coords[:, 2] if coords.shape[1] > 2 else np.zeros_like(x)
+        one = np.ones_like(x)
+        zero = np.zeros_like(x)
+        ndims = coords.shape[1]
+
+        if ndims == 3 and dpn == 3 and np.any(z != 0.0):
+            modes = [(one, zero, zero), (zero, one, zero), (zero, zero, one),
+                     (zero, -z, y), (z, zero, -x), (-y, x, zero)]
+        elif dpn == 2:
+            modes = [(one, zero), (zero, one), (-y, x)]
+        elif dpn == 3 and ndims == 2:
+            modes = [(one, zero, zero), (zero, one, zero), (-y, x, one)]
+        else:
+            modes = None
+
+        if modes is not None:
+            B = np.zeros((nd, len(modes)))
+            for i, mode in enumerate(modes):
+                for d in range(dpn):
+                    B[dofs[:, d]-1, i] = mode[d]
+            return B
+
+    B = np.zeros((nd, dpn))
+    for d in range(dpn):
+        B[dofs[:, d]-1, d] = 1.0
+    return B
+
+
+def _sa_aggregate(A, node, theta):
+    """
+    Aggregate the nodes of A around roots chosen as a distance-2
+    independent set of the strongly connected nodes, using sparse
+    matrix operations. Returns the aggregate index of each row.
+    """
+    nn = node.max()+1
+    Pn = sp.csr_matrix((np.ones(node.shape[0]), (np.arange(node.shape[0]), node)),
+                       shape=(node.shape[0], nn))
+    An = (Pn.T@abs(A)@Pn).tocoo()
+
+    d = np.zeros(nn)
+    onDiag = An.row == An.col
+    d[An.row[onDiag]] = An.data[onDiag]
+
+    strong = (~onDiag) & (An.data >= theta*np.sqrt(d[An.row]*d[An.col]))
+    S = sp.csr_matrix((np.ones(strong.sum()), (An.row[strong], An.col[strong])),
+                      shape=(nn, nn))
+
+    # Roots form a distance-2 maximal independent set of the strength
+    # graph and their neighbours join their aggregates. This is repeated
+    # on the nodes left over, which then join a neighbouring aggregate.
+
+    S = (S+sp.identity(nn, format='csr')).tocsr()
+    priority = np.random.default_rng(0).permutation(nn)+1
+    aggregate = np.full(nn, -1)
+    count = 0
+
+    for sweep in range(2):
+        state = np.where(aggregate == -1, 0, -1)
+        while np.any(state == 0):
+            w = np.where(state == 0, priority, 0)
+            roots = (state == 0) & (w == _sa_rowmax(S, _sa_rowmax(S, w)))
+            state[roots] = 1
+            near = (S@(S@roots.astype(float))) > 0
+            state[near & (state == 0)] = -1
+
+        rootIdx = np.flatnonzero(state == 1)
+        aggregate[rootIdx] = count+np.arange(rootIdx.shape[0])
+        count += rootIdx.shape[0]
+
+        isRoot = np.where(state == 1, aggregate, -1)
+        candidate = _sa_rowmax(S, isRoot)
+        free = aggregate == -1
+        aggregate[free] = candidate[free]
+
+    candidate = _sa_rowmax(S, aggregate)
+    free = aggregate == -1
+    aggregate[free] = candidate[free]
+
+    # Number the aggregates of the nodes present in A consecutively
+
+    return np.unique(aggregate[node], return_inverse=True)[1].ravel()
+
+
+def _sa_rowmax(S, v):
+    """Maximum of v over the columns of each row of S (no empty rows)."""
+    return np.maximum.reduceat(v[S.indices], S.indptr[:-1])
+
+
+def _sa_tentative(aggregates, B):
+    """
+    Tentative prolongator T with orthonormal columns from a QR
+    factorization of B on each aggregate. Returns T, the coarse
+    near-nullspace and the aggregate (coarse node) of each coarse dof.
+    Aggregates of equal size are factorized together.
+    """
+    n, nb = B.shape
+    order = np.argsort(aggregates, kind='stable')
+    starts = np.searchsorted(aggregates[order], np.arange(aggregates.max()+2))
+    sizes = np.diff(starts)
+
+    # Number of coarse dofs of each aggregate and their offsets
+
+    ncols = np.minimum(sizes, nb)
+    offsets = np.concatenate(([0], np.cumsum(ncols)))
+
+    rows = []
+    cols = []
+    values = []
+    Bc = np.zeros((offsets[-1], nb))
+
+    for size in np.unique(sizes):
+        aggs = np.flatnonzero(sizes == size)
+        k = min(size, nb)
+        dofs = order[starts[aggs][:, np.newaxis]+np.arange(size)]
+        Q, R = np.linalg.qr(B[dofs])
+        colIdx = offsets[aggs][:, np.newaxis]+np.arange(k)
+        rows.append(np.repeat(dofs, k, axis=1).ravel())
+        cols.append(np.tile(colIdx, (1, size)).ravel())
+        values.append(Q.ravel())
+        Bc[colIdx.ravel()] = R.reshape(-1, nb)
+
+    T = sp.csr_matrix((np.concatenate(values), (np.concatenate(rows),
+                      np.concatenate(cols))), shape=(n, offsets[-1]))
+
+    return T, Bc, np.repeat(np.arange(sizes.shape[0]), ncols)
+
+
+def _spectral_radius(A, iterations=20):
+    """Power iteration estimate of the spectral radius of A."""
+    x = np.random.default_rng(0).random(A.shape[0])
+    rho = 1.0
+    for i in range(iterations):
+        y = A@x
+        rho = np.linalg.norm(y)/np.linalg.norm(x)
+        x = y/np.linalg.norm(y)
+    return rho
+
+
+_nl_elements = {
+    'bar2g': (bar2ge, bar2gs),
+    'beam2g': (beam2ge, beam2gs),
+    'beam2gx': (beam2gxe, beam2gxs),
+}
+
+
+def nlsolveq(edof, ex, ey, ep, f, bcPrescr, bcVal=None, element='bar2g',
+             eq=None, nsteps=1, method='newton', tol=1e-8, maxiter=30,
+             line_search=True, history=None):
+    """
+    Solve geometrically nonlinear (second order theory) FE-equations for
+    plane bars and beams by incremental-iterative Newton-Raphson.
+
+    The load f ( and eq ) and the prescribed values are applied in
+    nsteps equal increments. In each increment the axial forces QX are
+    computed from the displacements with the element section force
+    function, and the out of balance forces are removed with the
+    tangent stiffness matrix, including the change of the element
+    stiffness with QX.
+
+    Parameters:
+
+        edof        dof topology array, dim(edof) = nel x nedof
+        ex, ey      element node coordinates, dim(ex) = dim(ey) = nel x 2
+        ep          element properties [E, A] for 'bar2g' and [E, A, I]
+                    for 'beam2g' and 'beam2gx', one row per element or
+                    one row for all elements
+        f           global load vector, dim(f) = nd x 1
+
+        bcPrescr    1-dim integer array containing prescribed dofs,
+                    or a BoundaryConditions object.
+        bcVal       1-dim float array containing prescribed values.
+                    If not given all prescribed dofs are assumed 0,
+                    or taken from bcPrescr if it is a BoundaryConditions.
+
+        element     'bar2g' (bar2ge/bar2gs), 'beam2g' (beam2ge/beam2gs)
+                    or 'beam2gx' (beam2gxe/beam2gxs)
+        eq          distributed transverse load qY for beams, one value
+                    per element or one value for all elements
+        nsteps      number of load increments
+        method      'newton' refactorizes the tangent stiffness matrix
+                    every iteration, 'modified' factorizes it once per
+                    load increment and reuses the factorization
+        tol         tolerance of the norm of the out of balance forces
+                    relative to the norm of the internal forces
+        maxiter     maximum number of iterations per load increment
+        line_search scale the Newton step by backtracking until the out
+                    of balance forces decrease
+        history     optional list, (step, iteration, residual) is
+                    appended to it for each iteration
+
+    Returns:
+
+        a           solution including boundary values
+        Q           reaction force vector
+                    dim(a)=dim(Q)= nd x 1, nd : number of dof's
+        QX          axial forces, dim(QX) = nel
+
+    """
+    if element not in _nl_elements:
+        raise ValueError("Unknown element %s." % element)
+    if method not in ('newton', 'modified'):
+        raise ValueError("Unknown method %s." % method)
+
+    elemFunc, secFunc = _nl_elements[element]
+
+    edof = np.atleast_2d(np.asarray(edof))
+    ex = np.atleast_2d(np.asarray(ex, dtype=float))
+    ey = np.atleast_2d(np.asarray(ey, dtype=float))
+    nel, nedof = edof.shape
+
+    ep = np.asarray(ep, dtype=float)
+    if ep.ndim == 1:
+        ep = np.broadcast_to(ep, (nel, ep.shape[0]))
+    if eq is not None:
+        eq = np.broadcast_to(np.asarray(eq, dtype=float).ravel(), (nel,))
+
+    fext = np.asarray(f, dtype=float).ravel()
+    nDofs = fext.shape[0]
+    prescrDofs, freeDofs, bcVal = _bc_partition(nDofs, bcPrescr, bcVal)
+    bcVal = np.asarray(bcVal, dtype=float).ravel()
+
+    pattern = SparsityPattern(edof, nDofs)
+    idx = edof-1
+
+    # Derivative of QX with respect to the element dofs (global directions)
+
+    dx = ex[:, 1]-ex[:, 0]
+    dy = ey[:, 1]-ey[:, 0]
+    L = np.sqrt(dx*dx+dy*dy)
+    cs = np.stack((-dx, -dy, dx, dy), axis=1)*(ep[:, 0]*ep[:, 1]/L**2)[:, None]
+    if nedof == 4:
+        dQX = cs
+    else:
+        dQX = np.insert(np.insert(cs, 4, 0.0, axis=1), 2, 0.0, axis=1)
+
+    QX = np.zeros(nel)
+
+    def evaluate(a, lam, tangent):
+        """Internal forces, axial forces and (tangent) stiffness at a."""
+        ed = a[idx]
+        qx = np.empty(nel)
+        fint = np.empty((nel, nedof))
+        Kt = np.empty((nel, nedof, nedof)) if tangent else None
+
+        for i in range(nel):
+            if element == 'bar2g':
+                qx[i] = np.ravel(secFunc(ex[i], ey[i], ep[i], ed[i])[1])[0]
+            else:
+                qx[i] = secFunc(ex[i], ey[i], ep[i], ed[i], QX[i])[1]
+            Ke, fe = _nl_element(elemFunc, ex[i], ey[i], ep[i], qx[i], eq, i)
+            fint[i] = Ke@ed[i]-lam*fe
+            if tangent:
+                h = 1e-6*max(abs(qx[i]), 1e-3*ep[i, 0]*ep[i, 1])
+                Keh, feh = _nl_element(elemFunc, ex[i], ey[i], ep[i],
+                                       qx[i]+h, eq, i)
+                dfint = ((Keh-Ke)@ed[i]-lam*(feh-fe))/h
+                Kt[i] = Ke+np.outer(dfint, dQX[i])
+
+        fint = np.bincount(idx.ravel(), weights=fint.ravel(),
+                           minlength=nDofs)
+        return fint, qx, Kt
+
+    a = np.zeros(nDofs)
+    K = None
+    solve = None
+    rnorm = 0.0
+
+    for step in range(1, nsteps+1):
+        lam = step/nsteps
+        a[prescrDofs] = lam*bcVal
+
+        fint, qx, Kt = evaluate(a, lam, True)
+        QX = qx
+
+        for iteration in range(maxiter+1):
+            res = lam*fext-fint
+            rnorm = np.linalg.norm(res[freeDofs])
+            scale = max(np.linalg.norm(fint), np.linalg.norm(lam*fext))
+            rel = rnorm/scale if scale > 0.0 else 0.0
+            if history is not None:
+                history.append((step, iteration, rel))
+            if rel <= tol or iteration == maxiter:
+                break
+
+            if solve is None or method == 'newton' or iteration == 0:
+                K = pattern.assem(Kt, K)
+                solve = _factorized(K[freeDofs][:, freeDofs])
+
+            da = np.zeros(nDofs)
+            da[freeDofs] = solve(res[freeDofs])
+
+            s = 1.0
+            while True:
+                aTrial = a+s*da
+                fint, qx, Kt = evaluate(aTrial, lam, method == 'newton')
+                trial = np.linalg.norm((lam*fext-fint)[freeDofs])
+                if not line_search or trial <= (1.0-1e-4*s)*rnorm or s < 0.05:
+                    break
+                s *= 0.5
+
+            a = aTrial
+            QX = qx
+
+        if rel > tol:
+            error("Load step %d did not converge in %d iterations "
+                  "(residual %g)." % (step, maxiter, rel))
+            break
+
+        info("Load step %d converged in %d iterations." % (step, iteration))
+
+    Q = fint-lam*fext
+
+    return a.reshape(nDofs, 1), Q.reshape(nDofs, 1), QX
+
+
+def _nl_element(elemFunc, ex, ey, ep, QX, eq, i):
+    """Element stiffness matrix and load vector for axial force QX."""
+    if eq is None:
+        Ke = elemFunc(ex, ey, ep, QX)
+        return Ke, np.zeros(Ke.shape[0])
+    Ke, fe = elemFunc(ex, ey, ep, QX, [eq[i]])
+    return Ke, fe.ravel()
+
+
+def eigen(K, M, b=None, nev=None, window=None, shift=None):
     """
     Solve the generalized eigenvalue problem
     |K-LM|X = 0, considering boundary conditions
@@ -5406,41 +6949,126 @@ def eigen(K,M,b=None):
         K           global stiffness matrix, dim(K) = ndof x ndof
         M           global mass matrix, dim(M) = ndof x ndof
         b           boundary condition vector, dim(b) = nbc x 1
+        nev         number of eigenvalues to compute (sparse mode)
+        window      [Lmin, Lmax] eigenvalue window, L = omega^2, from
+                    which all eigenvalues are returned (sparse mode)
+        shift       shift used in the shift-invert transformation, the
+                    computed eigenvalues are those closest to the
+                    shift. K-shift*M must be nonsingular. Default is
+                    Lmin if window is given and Lmin > 0, else a small
+                    negative value, which also allows a singular K.
+
+    If nev or window is given, the lowest eigenpairs (or all eigenpairs
+    in the window) are computed with the symmetric shift-invert Lanczos
+    method, scipy.sparse.linalg.eigsh. K and M may then be sparse.
+    Otherwise the full dense problem is solved.
 
     Returns:
 
         L           eigenvalue vector, dim(L) = (ndof-nbc) x 1
+                    or nev x 1 in sparse mode
         X           eigenvectors, dim(X) = ndof x (ndof-nbc)
+                    or ndof x nev in sparse mode
     """
     nd, _ = K.shape
+
     if b is not None:
-        fdof = np.setdiff1d(np.arange(nd), b-1)
-        D, X1 = eig(K[np.ix_(fdof,fdof)], M[np.ix_(fdof,fdof)])
-        D = np.real(D)
-        nfdof, _ = X1.shape
-        for j in range(nfdof):
-            mnorm = np.sqrt(X1[:,j].T@M[np.ix_(fdof,fdof)]@X1[:,j])
-            X1[:,j] /= mnorm
-        s_order = np.argsort(D)
-        L = np.sort(D)
-        X2 = np.zeros(X1.shape)
-        for ind,j in enumerate(s_order):
-            X2[:,ind] = X1[:,j]
-        X = np.zeros((nd,nfdof))
-        X[fdof,:] = X2
-        return L, X
+        fdof = np.setdiff1d(np.arange(nd), np.asarray(b).ravel()-1)
+    else:
+        fdof = np.arange(nd)
+
+    if nev is None and window is None:
+        if sp.issparse(K):
+            K = K.toarray()
+        if sp.issparse(M):
+            M = M.toarray()
+        Kff = np.asarray(K)[np.ix_(fdof, fdof)]
+        Mff = np.asarray(M)[np.ix_(fdof, fdof)]
+        D, X1 = _eigen_dense(Kff, Mff)
     else:
-        D, X1 = eig(K, M)
-        D = np.real(D)
-        for j in range(nd):
-            mnorm = np.sqrt(X1[:,j].T@M@X1[:,j])
-            X1[:,j] /= mnorm
-        s_order = np.argsort(D)
-        L = np.sort(D)
-        X = np.copy(X1)
-        for ind,j in enumerate(s_order):
-            X[:,ind] = X1[:,j]
-        return L, X
+        if sp.issparse(K):
+            K = K.tocsr()
+            Kff = K[fdof][:, fdof].tocsc()
+        else:
+            Kff = np.asarray(K)[np.ix_(fdof, fdof)]
+
+        if sp.issparse(M):
+            M = M.tocsr()
+            Mff = M[fdof][:, fdof].tocsc()
+        else:
+            Mff = np.asarray(M)[np.ix_(fdof, fdof)]
+
+        D, X1 = _eigen_shift_invert(Kff, Mff, nev, window, shift)
+
+    # M-normalize and sort all eigenvectors at once
+
+    mnorm = np.sqrt(np.einsum('ij,ij->j', X1, Mff@X1))
+    X1 = X1/mnorm
+
+    s_order = np.argsort(D)
+    L = D[s_order]
+
+    X = np.zeros((nd, X1.shape[1]), dtype=X1.dtype)
+    X[fdof, :] = X1[:, s_order]
+
+    return L, X
+
+
+def _eigen_shift_invert(Kff, Mff, nev, window, shift):
+    """
+    Lowest nev eigenpairs, or all eigenpairs in window, of the reduced
+    problem using shift-invert Lanczos. The Lanczos iteration is
+    restarted with more requested modes until the upper end of the
+    window is passed.
+    """
+    nfdof = Kff.shape[0]
+
+    if shift is None:
+        if window is not None and window[0] > 0.0:
+            shift = window[0]
+        else:
+            # Slightly below zero, so that K-shift*M can be factorized
+            # also when K is singular (rigid-body modes)
+            Kd = abs(Kff.diagonal()).max()
+            Md = abs(Mff.diagonal()).max()
+            shift = -1e-8*Kd/Md if Md > 0.0 else -1e-8*Kd
+
+    k = nev if nev is not None else 20
+
+    while True:
+        if k >= nfdof-1:
+            # Lanczos computes at most nfdof-2 eigenpairs, solve the
+            # full problem instead
+            D, X1 = _eigen_dense(Kff, Mff)
+            if nev is not None and window is None:
+                nearest = np.argsort(abs(D-shift), kind='stable')[:nev]
+                D = D[nearest]
+                X1 = X1[:, nearest]
+            break
+
+        D, X1 = eigsh(Kff, k=k, M=Mff, sigma=shift, which='LM')
+
+        if window is None or D.max() > window[1]:
+            break
+
+        k = 2*k
+
+    if window is not None:
+        inside = (D >= window[0]) & (D <= window[1])
+        D = D[inside]
+        X1 = X1[:, inside]
+
+    return D, X1
+
+
+def _eigen_dense(Kff, Mff):
+    """All eigenpairs of the reduced problem with the dense solver."""
+    if sp.issparse(Kff):
+        Kff = Kff.toarray()
+    if sp.issparse(Mff):
+        Mff = Mff.toarray()
+    D, X1 = eig(np.asarray(Kff), np.asarray(Mff))
+    return np.real(D), np.real(X1)
 
 
 def gfunc(G,dt):
@@ -5464,7 +7092,7 @@ def gfunc(G,dt):
     return ti, g1
 
 
-def step1(K,C,f,a0,bc,ip,times,dofs):
+def step1(K,C,f,a0,bc,ip,times,dofs,out=None,every=1):
     """
     Algorithm for dynamic solution of first-order
     FE equations considering boundary conditions.
@@ -5473,6 +7101,8 @@ def step1(K,C,f,a0,bc,ip,times,dofs):
 
         K           conductivity matrix, dim(K) = ndof x ndof
         C           capacity matrix, dim(C) = ndof x ndof
+                    K and C may be dense or scipy.sparse. Keff is
+                    factorized once, using a sparse LU for sparse input.
         f           load vector, dim(f) = ndof x (nstep + 1),
                     If dim(f) = ndof x 1, the values are kept constant
                     during time integration
@@ -5494,16 +7124,25 @@ def step1(K,C,f,a0,bc,ip,times,dofs):
         times       array [t(i) ...] of times at which output should be written to a and da
         dofs        array [dof(i) ...] of degree of freedom numbers for which history output
                     should be written to ahist and dahist
+        out         optional output sink for modelhist. If not given, modelhist is
+                    kept in memory. A file name prefix writes each history to a
+                    memory-mapped .npy file, e.g. out + '_a.npy', and modelhist
+                    contains the memory maps. A callable is called as
+                    out(time, snapshot) at each output step, where snapshot is a
+                    dictionary with the same keys as modelhist; modelhist is then
+                    empty. The snapshot arrays are reused between calls.
+        every       write modelhist only at every k-th time step (when 'times'
+                    is not given). Default 1.
 
     Returns:
 
         modelhist   dictionary containing solution history for the whole model at following keys:
                     modelhist['a']          constains values of a at all timesteps,
                                             alternatively at times specified in 'times'
-                                            dim(modelhist['a']) = ndof x (nstep + 1) or ndof x ntimes
+                                            dim(modelhist['a']) = ndof x (nstep/every + 1) or ndof x ntimes
                     modelhist['da']         constains values of da at all timesteps,
                                             alternatively at times specified in 'times'
-                                            dim(modelhist['da']) = ndof x (nstep + 1) or ndof x ntimes
+                                            dim(modelhist['da']) = ndof x (nstep/every + 1) or ndof x ntimes
         dofhist     dictionary containing solution history for the degrees of freedom selected in 'dofs':
                     dofhist['a']        constains time history of a at the dofs specified in 'dofs'
                                             dim(dofhist['ahist']) = ndof x (nstep + 1)
@@ -5533,26 +7172,30 @@ def step1(K,C,f,a0,bc,ip,times,dofs):
     if (ns < nstep or nstep==1):
         nstep=ns
 
-    tf = np.zeros((ndof,nstep+1))
+    # Load vector at step j. A constant load is not expanded in time.
     if np.array(f).any():
+        f = np.asarray(f, dtype=float)
         if ncf==1:
-            tf = f[:,0].reshape(-1,1)@np.ones((1,nstep+1))
-        if ncf>1:
-            tf = np.copy(f)
+            load = lambda j: f[:,0]
+        else:
+            load = lambda j: f[:,j]
+    else:
+        zeroLoad = np.zeros(ndof)
+        load = lambda j: zeroLoad
 
-    modelhist = {}
     sa=0
+    nsave=0
     if not np.array(times).any():
         ntimes=0
         sa=1
-        modelhist['a'] = np.zeros((ndof,nstep+1))
-        modelhist['da'] = np.zeros((ndof,nstep+1))
+        nsave=nstep//every+1
     else:
         ntimes = len(times)
         if ntimes:
             sa=2
-            modelhist['a'] = np.zeros((ndof,ntimes))
-            modelhist['da'] = np.zeros((ndof,ntimes))
+            nsave=ntimes
+
+    history = _HistoryOutput(out, ('a', 'da'), ndof, nsave)
 
     dofhist = {}
     if np.array(dofs).all():
@@ -5563,28 +7206,36 @@ def step1(K,C,f,a0,bc,ip,times,dofs):
     else:
         ndofs=0
 
+    if sp.issparse(K) or sp.issparse(C):
+        K = sp.csr_matrix(K)
+        C = sp.csr_matrix(C)
+    else:
+        K = np.asarray(K, dtype=float)
+        C = np.asarray(C, dtype=float)
+
+    a0 = np.asarray(a0, dtype=float).ravel()
+
     itime = 0
 
-    # Calculate initial second time derivative d2a0
-    da0 = np.linalg.solve(C,tf[:,0].reshape(-1,1) - K@a0)
+    # Calculate initial time derivative da0
+    da0 = _factorized(C)(load(0) - K@a0)
     # Save initial values
     if sa==1:
-        modelhist['a'][:,0] = a0.ravel()
-        modelhist['da'][:,0] = da0.ravel()
+        history.save(0, 0.0, (a0, da0))
     elif sa==2:
         if times[itime]==0:
-            modelhist['a'][:,itime] = a0.ravel()
-            modelhist['da'][:,itime] = da0.ravel()
+            history.save(itime, 0.0, (a0, da0))
             itime += 1
 
     if ndofs:
-        dofhist['a'][:,0] = a0[np.ix_(dofs-1)].ravel()
-        dofhist['da'][:,0] = da0[np.ix_(dofs-1)].ravel()
-
-    # Reduce matrices due to bcs
-    tempa = np.zeros((ndof,1))
-    tempda = np.zeros((ndof,1))
-    fdof=np.arange(1,ndof+1).astype(int)
+        dofhist['a'][:,0] = a0[dofs-1]
+        dofhist['da'][:,0] = da0[dofs-1]
+
+    # Reduce matrices due to bcs. The partitioned blocks and the
+    # factorization of Keff are computed once, before the time loop.
+    tempa = np.zeros(ndof)
+    tempda = np.zeros(ndof)
+    fdof=np.arange(ndof)
     if bound:
         nrb, ncb = bc.shape
         if ncb==2:
@@ -5595,55 +7246,111 @@ def step1(K,C,f,a0,bc,ip,times,dofs):
             pda1 = (pa[:,1]-pa[:,0])/dt
             pdarest = (pa[:,1:] - pa[:,0:-1])/dt
             pda = np.hstack((pda1.reshape(-1,1),pdarest))
-        pdof = np.copy(bc[:,0]).astype(int)
-        fdof = np.setdiff1d(fdof,pdof).astype(int) - 1
-        pdof -= 1 #adjusting for indexing starting from 0
-        Keff = C[np.ix_(fdof,fdof)] + a2*K[np.ix_(fdof,fdof)]
+        pdof = np.copy(bc[:,0]).astype(int) - 1 #adjusting for indexing starting from 0
+        fdof = np.setdiff1d(fdof,pdof)
+        Kff, Kfp = _partition_blocks(K, fdof, pdof)
+        Cff, Cfp = _partition_blocks(C, fdof, pdof)
     else:
-        fdof -= 1 #adjusting for indexing starting from 0
-        Keff = C + a2*K
+        Kff = K
+        Cff = C
 
-    L, U = lu(Keff,permute_l=True)
-    anew = a0[np.ix_(fdof)]
-    danew = da0[np.ix_(fdof)]
+    solve = _factorized(Cff + a2*Kff)
+    anew = a0[fdof]
+    danew = da0[fdof]
 
     # Iterate over time steps
     for j in range(1,nstep+1):
         time = dt*j
-        aold = np.copy(anew)
-        daold = np.copy(danew)
-        apred = aold + a1*daold
+        apred = anew + a1*danew
         if not bound:
-            reff = tf[:,j].reshape(-1,1) - K@apred
+            reff = load(j) - Kff@apred
         else:
-            pdeff = C[np.ix_(fdof,pdof)]@pda[:,j].reshape(-1,1) + K[np.ix_(fdof,pdof)]@pa[:,j].reshape(-1,1)
-            reff = tf[np.ix_(fdof),j].reshape(-1,1) - K[np.ix_(fdof,fdof)]@apred - pdeff
-        y = np.linalg.solve(L,reff)
-        danew = np.linalg.solve(U,y)
+            pdeff = Cfp@pda[:,j] + Kfp@pa[:,j]
+            reff = load(j)[fdof] - Kff@apred - pdeff
+        danew = solve(reff)
         anew = apred + a2*danew
         # Save to modelhist and dofhist
         if bound:
-            tempa[np.ix_(pdof)] = pa[:,j].reshape(-1,1)
-            tempda[np.ix_(pdof)] = pda[:,j].reshape(-1,1)
-        tempa[np.ix_(fdof)] = anew
-        tempda[np.ix_(fdof)] = danew
+            tempa[pdof] = pa[:,j]
+            tempda[pdof] = pda[:,j]
+        tempa[fdof] = anew
+        tempda[fdof] = danew
         if sa==1:
-            modelhist['a'][:,j] = tempa.ravel()
-            modelhist['da'][:,j] = tempda.ravel()
+            if j % every == 0:
+                history.save(j//every, time, (tempa, tempda))
         elif sa==2:
             if ntimes and itime < ntimes:
                 if time >= times[itime]:
-                    modelhist['a'][:,itime] = tempa.ravel()
-                    modelhist['da'][:,itime] = tempda.ravel()
+                    history.save(itime, time, (tempa, tempda))
                     itime += 1
-            if ndofs:
-                dofhist['a'][:,j] = tempa[np.ix_(dofs-1)].ravel()
-                dofhist['da'][:,j] = tempda[np.ix_(dofs-1)].ravel()
+        if ndofs:
+            dofhist['a'][:,j] = tempa[dofs-1]
+            dofhist['da'][:,j] = tempda[dofs-1]
 
-    return modelhist, dofhist
+    return history.close(), dofhist
+
+
+class _HistoryOutput:
+    """
+    Output sink for the model history of step1 and step2, kept in
+    memory, written to memory-mapped .npy files or passed to a callback.
+    See step1 for the meaning of out.
+    """
 
+    def __init__(self, out, keys, ndof, ncols):
+        self.out = out
+        self.keys = keys
+        self.modelhist = {}
 
-def step2(K,C,M,f,a0,da0,bc,ip,times,dofs):
+        if out is None:
+            for key in keys:
+                self.modelhist[key] = np.zeros((ndof, ncols))
+        elif not callable(out):
+            # Fortran order keeps each saved column contiguous on disk
+            for key in keys:
+                self.modelhist[key] = np.lib.format.open_memmap(
+                    "%s_%s.npy" % (out, key), mode="w+", dtype=float,
+                    shape=(ndof, ncols), fortran_order=True)
+
+    def save(self, col, time, values):
+        if callable(self.out):
+            self.out(time, dict(zip(self.keys, values)))
+        else:
+            for key, value in zip(self.keys, values):
+                self.modelhist[key][:, col] = value
+
+    def close(self):
+        for hist in self.modelhist.values():
+            if isinstance(hist, np.memmap):
+                hist.flush()
+        return self.modelhist
+
+
+def _partition_blocks(A, fdof, pdof):
+    """
+    Return the blocks A[fdof, fdof] and A[fdof, pdof] of a dense or
+    sparse (CSR) matrix.
+    """
+    if sp.issparse(A):
+        Af = A[fdof]
+        return Af[:, fdof], Af[:, pdof]
+    else:
+        return A[np.ix_(fdof, fdof)], A[np.ix_(fdof, pdof)]
+
+
+def _factorized(A):
+    """
+    Factorize A once (sparse LU for scipy.sparse A, dense LU otherwise)
+    and return a function solving A x = b for b.
+    """
+    if sp.issparse(A):
+        return splu(sp.csc_matrix(A)).solve
+    else:
+        factor = lu_factor(A)
+        return lambda b: lu_solve(factor, b)
+
+
+def step2(K,C,M,f,a0,da0,bc,ip,times,dofs,out=None,every=1):
     """
     Algorithm for dynamic solution of second-order
     FE equations considering boundary conditions.
@@ -5654,6 +7361,9 @@ def step2(K,C,M,f,a0,da0,bc,ip,times,dofs):
         C           global damping matrix, dim(C) = ndof x ndof
                     If there is no damping in the system, simply set C=[]
         M           global mass matrix, dim(M) = ndof x ndof
+                    K, C and M may be dense or scipy.sparse. The effective
+                    mass matrix is factorized once, using a sparse LU for
+                    sparse input.
         f           global load vector, dim(f) = ndof x (nstep + 1),
                     If dim(f) = ndof x 1, the values are kept constant
                     during time integration
@@ -5676,19 +7386,28 @@ def step2(K,C,M,f,a0,da0,bc,ip,times,dofs):
         times       array [t(i) ...] of times at which output should be written to a, da and d2a
         dofs        array [dof(i) ...] of degree of freedom numbers for which history output
                     should be written to ahist, dahist and d2ahist
+        out         optional output sink for modelhist. If not given, modelhist is
+                    kept in memory. A file name prefix writes each history to a
+                    memory-mapped .npy file, e.g. out + '_a.npy', and modelhist
+                    contains the memory maps. A callable is called as
+                    out(time, snapshot) at each output step, where snapshot is a
+                    dictionary with the same keys as modelhist; modelhist is then
+                    empty. The snapshot arrays are reused between calls.
+        every       write modelhist only at every k-th time step (when 'times'
+                    is not given). Default 1.
 
     Returns:
 
         modelhist   dictionary containing solution history for the whole model at following keys:
                     modelhist['a']          constains displacement values at all timesteps,
                                             alternatively at times specified in 'times'
-                                            dim(modelhist['a']) = ndof x (nstep + 1) or ndof x ntimes
+                                            dim(modelhist['a']) = ndof x (nstep/every + 1) or ndof x ntimes
                     modelhist['da']         constains velocity values at all timesteps,
                                             alternatively at times specified in 'times'
-                                            dim(modelhist['da']) = ndof x (nstep + 1) or ndof x ntimes
+                                            dim(modelhist['da']) = ndof x (nstep/every + 1) or ndof x ntimes
                     modelhist['d2a']        constains acceleration values at all timesteps,
                                             alternatively at times specified in 'times'
-                                            dim(modelhist['d2a']) = ndof x (nstep + 1) or ndof x ntimes
+                                            dim(modelhist['d2a']) = ndof x (nstep/every + 1) or ndof x ntimes
         dofhist     dictionary containing solution history for the degrees of freedom selected in 'dofs':
                     dofhist['a']        constains displacement time history at the dofs specified in 'dofs'
                                             dim(dofhist['ahist']) = ndof x (nstep + 1)
@@ -5698,8 +7417,10 @@ def step2(K,C,M,f,a0,da0,bc,ip,times,dofs):
                                             dim(dofhist['d2ahist']) = ndof x (nstep + 1)
     """
     ndof, _ = K.shape
-    if not np.array(C).any():
-        C = np.zeros((ndof,ndof))
+    if sp.issparse(C):
+        damped = C.nnz > 0
+    else:
+        damped = C is not None and np.array(C).any()
     dt, tottime, alpha, delta = ip
     b1 = dt*dt*0.5*(1-2*alpha)
     b2 = (1-delta)*dt
@@ -5724,28 +7445,30 @@ def step2(K,C,M,f,a0,da0,bc,ip,times,dofs):
     if (ns < nstep or nstep==1):
         nstep=ns
 
-    tf = np.zeros((ndof,nstep+1))
+    # Load vector at step j. A constant load is not expanded in time.
     if np.array(f).any():
+        f = np.asarray(f, dtype=float)
         if ncf==1:
-            tf = f[:,0].reshape(-1,1)@np.ones((1,nstep+1))
-        if ncf>1:
-            tf = np.copy(f)
+            load = lambda j: f[:,0]
+        else:
+            load = lambda j: f[:,j]
+    else:
+        zeroLoad = np.zeros(ndof)
+        load = lambda j: zeroLoad
 
-    modelhist = {}
     sa=0
+    nsave=0
     if not np.array(times).any():
         ntimes=0
         sa=1
-        modelhist['a'] = np.zeros((ndof,nstep+1))
-        modelhist['da'] = np.zeros((ndof,nstep+1))
-        modelhist['d2a'] = np.zeros((ndof,nstep+1))
+        nsave=nstep//every+1
     else:
         ntimes = len(times)
         if ntimes:
             sa=2
-            modelhist['a'] = np.zeros((ndof,ntimes))
-            modelhist['da'] = np.zeros((ndof,ntimes))
-            modelhist['d2a'] = np.zeros((ndof,ntimes))
+            nsave=ntimes
+
+    history = _HistoryOutput(out, ('a', 'da', 'd2a'), ndof, nsave)
 
     dofhist = {}
     if np.array(dofs).all():
@@ -5757,32 +7480,47 @@ def step2(K,C,M,f,a0,da0,bc,ip,times,dofs):
     else:
         ndofs=0
 
+    if sp.issparse(K) or sp.issparse(M) or (damped and sp.issparse(C)):
+        K = sp.csr_matrix(K)
+        M = sp.csr_matrix(M)
+        if damped:
+            C = sp.csr_matrix(C)
+    else:
+        K = np.asarray(K, dtype=float)
+        M = np.asarray(M, dtype=float)
+        if damped:
+            C = np.asarray(C, dtype=float)
+
+    a0 = np.asarray(a0, dtype=float).ravel()
+    da0 = np.asarray(da0, dtype=float).ravel()
+
     itime = 0
 
     # Calculate initial second time derivative d2a0
-    d2a0 = np.linalg.solve(M,tf[:,0].reshape(-1,1) - C@da0 - K@a0)
+    r0 = load(0) - K@a0
+    if damped:
+        r0 = r0 - C@da0
+    d2a0 = _factorized(M)(r0)
     # Save initial values
     if sa==1:
-        modelhist['a'][:,0] = a0.ravel()
-        modelhist['da'][:,0] = da0.ravel()
-        modelhist['d2a'][:,0] = d2a0.ravel()
+        history.save(0, 0.0, (a0, da0, d2a0))
     elif sa==2:
         if times[itime]==0:
-            modelhist['a'][:,itime] = a0.ravel()
-            modelhist['da'][:,itime] = da0.ravel()
-            modelhist['d2a'][:,itime] = d2a0.ravel()
+            history.save(itime, 0.0, (a0, da0, d2a0))
             itime += 1
 
     if ndofs:
-        dofhist['a'][:,0] = a0[np.ix_(dofs-1)].ravel()
-        dofhist['da'][:,0] = da0[np.ix_(dofs-1)].ravel()
-        dofhist['d2a'][:,0] = d2a0[np.ix_(dofs-1)].ravel()
-
-    # Reduce matrices due to bcs
-    tempa = np.zeros((ndof,1))
-    tempda = np.zeros((ndof,1))
-    tempd2a = np.zeros((ndof,1))
-    fdof=np.arange(1,ndof+1).astype(int)
+        dofhist['a'][:,0] = a0[dofs-1]
+        dofhist['da'][:,0] = da0[dofs-1]
+        dofhist['d2a'][:,0] = d2a0[dofs-1]
+
+    # Reduce matrices due to bcs. The partitioned blocks and the
+    # factorization of the effective mass matrix are computed once,
+    # before the time loop.
+    tempa = np.zeros(ndof)
+    tempda = np.zeros(ndof)
+    tempd2a = np.zeros(ndof)
+    fdof=np.arange(ndof)
     if bound:
         nrb, ncb = bc.shape
         if ncb==2:
@@ -5793,137 +7531,541 @@ def step2(K,C,M,f,a0,da0,bc,ip,times,dofs):
             pda1 = (pa[:,1]-pa[:,0])/dt
             pdarest = (pa[:,1:] - pa[:,0:-1])/dt
             pda = np.hstack((pda1.reshape(-1,1),pdarest))
-        pdof = np.copy(bc[:,0]).astype(int)
-        fdof = np.setdiff1d(fdof,pdof).astype(int) - 1
-        pdof -= 1 #adjusting for indexing starting from 0
-        Keff = M[np.ix_(fdof,fdof)] + b3*C[np.ix_(fdof,fdof)] +b4*K[np.ix_(fdof,fdof)]
+        pdof = np.copy(bc[:,0]).astype(int) - 1 #adjusting for indexing starting from 0
+        fdof = np.setdiff1d(fdof,pdof)
+        Kff, Kfp = _partition_blocks(K, fdof, pdof)
+        Mff, _ = _partition_blocks(M, fdof, pdof)
+        if damped:
+            Cff, Cfp = _partition_blocks(C, fdof, pdof)
     else:
-        fdof -= 1 #adjusting for indexing starting from 0
-        Keff = M + b3*C + b4*K
+        Kff = K
+        Mff = M
+        if damped:
+            Cff = C
+
+    Keff = Mff + b4*Kff
+    if damped:
+        Keff = Keff + b3*Cff
 
-    L, U = lu(Keff,permute_l=True)
-    anew = a0[np.ix_(fdof)]
-    danew = da0[np.ix_(fdof)]
-    d2anew = d2a0[np.ix_(fdof)]
+    solve = _factorized(Keff)
+    anew = a0[fdof]
+    danew = da0[fdof]
+    d2anew = d2a0[fdof]
 
     # Iterate over time steps
     for j in range(1,nstep+1):
         time = dt*j
-        aold = np.copy(anew)
-        daold = np.copy(danew)
-        d2aold = np.copy(d2anew)
-        apred = aold + dt*daold + b1*d2aold
-        dapred = daold + b2*d2aold
+        apred = anew + dt*danew + b1*d2anew
+        dapred = danew + b2*d2anew
         if not bound:
-            reff = tf[:,j].reshape(-1,1) - C@dapred - K@apred
+            reff = load(j) - Kff@apred
         else:
-            pdeff = C[np.ix_(fdof,pdof)]@pda[:,j].reshape(-1,1) + K[np.ix_(fdof,pdof)]@pa[:,j].reshape(-1,1)
-            reff = tf[np.ix_(fdof),j].reshape(-1,1) - C[np.ix_(fdof,fdof)]@dapred - K[np.ix_(fdof,fdof)]@apred - pdeff
-        y = np.linalg.solve(L,reff)
-        d2anew = np.linalg.solve(U,y)
+            reff = load(j)[fdof] - Kff@apred - Kfp@pa[:,j]
+            if damped:
+                reff -= Cfp@pda[:,j]
+        if damped:
+            reff -= Cff@dapred
+        d2anew = solve(reff)
         anew = apred + b4*d2anew
         danew = dapred + b3*d2anew
         # Save to modelhist and dofhist
         if bound:
-            tempa[np.ix_(pdof)] = pa[:,j].reshape(-1,1)
-            tempda[np.ix_(pdof)] = pda[:,j].reshape(-1,1)
-        tempa[np.ix_(fdof)] = anew
-        tempda[np.ix_(fdof)] = danew
-        tempd2a[np.ix_(fdof)] = d2anew
+            tempa[pdof] = pa[:,j]
+            tempda[pdof] = pda[:,j]
+        tempa[fdof] = anew
+        tempda[fdof] = danew
+        tempd2a[fdof] = d2anew
         if sa==1:
-            modelhist['a'][:,j] = tempa.ravel()
-            modelhist['da'][:,j] = tempda.ravel()
-            modelhist['d2a'][:,j] = tempd2a.ravel()
+            if j % every == 0:
+                history.save(j//every, time, (tempa, tempda, tempd2a))
         elif sa==2:
             if ntimes and itime < ntimes:
                 if time >= times[itime]:
-                    modelhist['a'][:,itime] = tempa.ravel()
-                    modelhist['da'][:,itime] = tempda.ravel()
-                    modelhist['d2a'][:,itime] = tempd2a.ravel()
+                    history.save(itime, time, (tempa, tempda, tempd2a))
                     itime += 1
-            if ndofs:
-                dofhist['a'][:,j] = tempa[np.ix_(dofs-1)].ravel()
-                dofhist['da'][:,j] = tempda[np.ix_(dofs-1)].ravel()
-                dofhist['d2a'][:,j] = tempd2a[np.ix_(dofs-1)].ravel()
+        if ndofs:
+            dofhist['a'][:,j] = tempa[dofs-1]
+            dofhist['da'][:,j] = tempda[dofs-1]
+            dofhist['d2a'][:,j] = tempd2a[dofs-1]
+
+    return history.close(), dofhist
+
+
+def step2_modal(K,M,f,a0,da0,b,ip,times,dofs,nmodes=None,zeta=None,rayleigh=None,modes=None):
+    """
+    Algorithm for dynamic solution of second-order FE equations by
+    modal superposition, using the lowest eigenmodes of K and M.
+
+    The equations are projected onto the M-normalized modes X, which
+    decouples them into one equation per mode
+
+        d2q + c*dq + omega^2*q = X^T f
+
+    These are integrated with the Newmark method for all modes at once,
+    and a = X q is only reconstructed at the requested times and dofs.
+
+    The initial accelerations follow from the modal equations, i.e. from
+    the constrained system. step2 computes them from the unconstrained
+    system, so with boundary conditions the results of the two differ
+    slightly even when all modes are used.
+
+    Parameters:
+
+        K           global stiffness matrix, dim(K) = ndof x ndof
+        M           global mass matrix, dim(M) = ndof x ndof
+                    K and M may be dense or scipy.sparse.
+        f           global load vector, dim(f) = ndof x (nstep + 1),
+                    If dim(f) = ndof x 1, the values are kept constant
+                    during time integration
+        a0          initial displacement vector a(0), dim(a0) = ndof x 1
+        da0         initial velocity vector v(0), dim(da0) = ndof x 1
+        b           boundary condition vector, dim(b) = nbc x 1, with the
+                    numbers of the dofs fixed to zero (as in eigen)
+        ip          array [dt, tottime, alpha, delta], where
+                    dt is the size of the time increment,
+                    tottime is the total time,
+                    alpha and delta are time integration constants (see step2)
+        times       array [t(i) ...] of times at which output should be written
+                    to modelhist. If empty, all time steps are written.
+        dofs        array [dof(i) ...] of degree of freedom numbers for which history output
+                    should be written to dofhist
+        nmodes      number of modes used. The lowest nmodes modes are computed
+                    with eigen in sparse mode. If not given, all modes are used.
+        zeta        modal damping ratios, scalar or dim(zeta) = nmodes
+        rayleigh    [a0, a1], Rayleigh damping C = a0*M + a1*K
+        modes       (L, X) from a previous call to eigen, used instead of
+                    computing the modes
+
+    Returns:
+
+        modelhist   dictionary with keys 'a', 'da' and 'd2a' as for step2
+                    dim(modelhist['a']) = ndof x (nstep + 1) or ndof x ntimes
+        dofhist     dictionary with keys 'a', 'da' and 'd2a' as for step2
+                    dim(dofhist['a']) = ndofs x (nstep + 1)
+    """
+    ndof, _ = K.shape
+    if not sp.issparse(K):
+        K = np.asarray(K)
+    if not sp.issparse(M):
+        M = np.asarray(M)
+    dt, tottime, alpha, delta = ip
+    b1 = dt*dt*0.5*(1-2*alpha)
+    b2 = (1-delta)*dt
+    b3 = delta*dt
+    b4 = alpha*dt*dt
+
+    if modes is None:
+        if b is not None and np.size(b) == 0:
+            b = None
+        L, X = eigen(K, M, b, nev=nmodes)
+    else:
+        L, X = modes
+    L = np.real(np.asarray(L)).ravel()
+    X = np.real(np.asarray(X))
+
+    omega = np.sqrt(np.maximum(L, 0.0))
+
+    # Modal damping coefficients, c = 2*zeta*omega + a0 + a1*omega^2
+
+    c = np.zeros(L.shape[0])
+    if zeta is not None:
+        c += 2*np.asarray(zeta, dtype=float)*omega
+    if rayleigh is not None:
+        c += rayleigh[0] + rayleigh[1]*L
+
+    nstep = int(tottime/dt)
+    if np.array(f).any():
+        _, ncf = f.shape
+        if ncf>1:
+            nstep = min(nstep, ncf-1)
+        p = X.T@np.asarray(f, dtype=float)
+        if ncf==1:
+            p = np.broadcast_to(p, (L.shape[0], nstep+1))
+    else:
+        p = np.zeros((L.shape[0], nstep+1))
+
+    # Project initial conditions onto the modes
+
+    q = X.T@(M@np.asarray(a0, dtype=float).ravel())
+    dq = X.T@(M@np.asarray(da0, dtype=float).ravel())
+    d2q = p[:,0] - c*dq - L*q
+
+    Q = np.zeros((3, L.shape[0], nstep+1))
+    Q[:,:,0] = q, dq, d2q
+
+    keff = 1.0 + b3*c + b4*L
+
+    # Integrate all modes at once
+
+    for j in range(1,nstep+1):
+        qpred = q + dt*dq + b1*d2q
+        dqpred = dq + b2*d2q
+        d2q = (p[:,j] - c*dqpred - L*qpred)/keff
+        q = qpred + b4*d2q
+        dq = dqpred + b3*d2q
+        Q[:,:,j] = q, dq, d2q
+
+    # Reconstruct at the output steps, selected as in step2
+
+    if not np.array(times).any():
+        cols = np.arange(nstep+1)
+        ncols = nstep+1
+    else:
+        ncols = len(times)
+        cols = []
+        if times[0]==0:
+            cols.append(0)
+        for j in range(1,nstep+1):
+            if len(cols) < ncols and dt*j >= times[len(cols)]:
+                cols.append(j)
+
+    modelhist = {}
+    dofhist = {}
+    for i, key in enumerate(('a', 'da', 'd2a')):
+        modelhist[key] = np.zeros((ndof, ncols))
+        modelhist[key][:,:len(cols)] = X@Q[i][:,cols]
+        if np.array(dofs).all() and len(dofs):
+            dofhist[key] = X[np.asarray(dofs)-1]@Q[i]
 
     return modelhist, dofhist
 
 
-def extract_eldisp(edof, a):
+def freqresp(K,M,f,freqs,C=None,b=None,dofs=None,method='direct',nmodes=None,zeta=None,modes=None,workers=None):
+    """
+    Steady-state harmonic response of the FE equations
+
+        (K + i*omega*C - omega^2*M) a = f,     omega = 2*pi*freq
+
+    for a sweep of frequencies, considering boundary conditions.
+
+    Parameters:
+
+        K           global stiffness matrix, dim(K) = ndof x ndof
+        M           global mass matrix, dim(M) = ndof x ndof
+        f           load amplitude vector, dim(f) = ndof x 1
+        freqs       array of frequencies [Hz], dim(freqs) = nfreq
+        C           global damping matrix, dim(C) = ndof x ndof (optional)
+                    K, M and C may be dense or scipy.sparse.
+        b           boundary condition vector, dim(b) = nbc x 1, with the
+                    numbers of the dofs fixed to zero
+        dofs        array [dof(i) ...] of degree of freedom numbers for which
+                    the response is returned. Default is all dofs.
+        method      'direct' solves the full system at each frequency (sparse
+                    LU for sparse input). 'modal' uses the modal basis from
+                    eigen, where C is approximated by its diagonal modal part.
+        nmodes      number of modes for the modal method. If not given, all
+                    modes are used.
+        zeta        modal damping ratios for the modal method, scalar or
+                    dim(zeta) = nmodes
+        modes       (L, X) from a previous call to eigen, used by the modal
+                    method instead of computing the modes
+        workers     number of threads solving frequencies in parallel in the
+                    direct method. Default is one.
+
+    Returns:
+
+        a           complex response amplitudes, dim(a) = ndofs x nfreq
+    """
+    ndof, _ = K.shape
+    omegas = 2*np.pi*np.asarray(freqs, dtype=float).ravel()
+    f = np.asarray(f, dtype=float).ravel()
+
+    if dofs is None:
+        outDofs = np.arange(ndof)
+    else:
+        outDofs = np.asarray(dofs, dtype=int).ravel()-1
+
+    if b is not None and np.size(b) == 0:
+        b = None
+
+    if sp.issparse(C):
+        damped = C.nnz > 0
+    else:
+        damped = C is not None and np.array(C).any()
+
+    if method == 'modal':
+        if modes is None:
+            L, X = eigen(K, M, b, nev=nmodes)
+        else:
+            L, X = modes
+        L = np.real(np.asarray(L)).ravel()
+        X = np.real(np.asarray(X))
+
+        c = np.zeros(L.shape[0])
+        if zeta is not None:
+            c += 2*np.asarray(zeta, dtype=float)*np.sqrt(np.maximum(L, 0.0))
+        if damped:
+            c += np.einsum('ij,ij->j', X, C@X)
+
+        # Modal transfer functions for all modes and frequencies at once
+
+        H = 1.0/(L[:, np.newaxis] - omegas**2 + 1j*omegas*c[:, np.newaxis])
+
+        return X[outDofs]@(H*(X.T@f)[:, np.newaxis])
+
+    if method != 'direct':
+        raise ValueError("Unknown method %s." % method)
+
+    sparse = sp.issparse(K) or sp.issparse(M) or (damped and sp.issparse(C))
+
+    if sparse:
+        K = sp.csr_matrix(K)
+        M = sp.csr_matrix(M)
+        if damped:
+            C = sp.csr_matrix(C)
+    else:
+        K = np.asarray(K, dtype=float)
+        M = np.asarray(M, dtype=float)
+        if damped:
+            C = np.asarray(C, dtype=float)
+
+    if b is not None:
+        pdof = np.asarray(b, dtype=int).ravel()-1
+        fdof = np.setdiff1d(np.arange(ndof), pdof)
+        Kff, _ = _partition_blocks(K, fdof, pdof)
+        Mff, _ = _partition_blocks(M, fdof, pdof)
+        if damped:
+            Cff, _ = _partition_blocks(C, fdof, pdof)
+    else:
+        fdof = np.arange(ndof)
+        Kff = K
+        Mff = M
+        if damped:
+            Cff = C
+
+    # Position of each output dof among the free dofs, prescribed
+    # dofs have zero response
+
+    position = np.full(ndof, -1)
+    position[fdof] = np.arange(fdof.shape[0])
+    outPos = position[outDofs]
+    outFree = outPos >= 0
+
+    ff = f[fdof].astype(complex)
+
+    def solveFrequency(omega):
+        Kd = Kff - omega**2*Mff
+        if damped:
+            Kd = Kd + 1j*omega*Cff
+        if sparse:
+            x = splu(sp.csc_matrix(Kd, dtype=complex)).solve(ff)
+        else:
+            x = np.linalg.solve(Kd.astype(complex), ff)
+        ai = np.zeros(outDofs.shape[0], dtype=complex)
+        ai[outFree] = x[outPos[outFree]]
+        return ai
+
+    if workers is not None and workers > 1:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            columns = list(executor.map(solveFrequency, omegas))
+    else:
+        columns = [solveFrequency(omega) for omega in omegas]
+
+    a = np.zeros((outDofs.shape[0], omegas.shape[0]), dtype=complex)
+    for i, ai in enumerate(columns):
+        a[:, i] = ai
+
+    return a
+
+
+def extract_eldisp(edof, a, out=None):
     """
     Extract element displacements from the global displacement
     vector according to the topology matrix edof.
     
     Parameters:
     
-        a           the global displacement vector
+        a           the global displacement vector, dim(a) = ndof or
+                    ndof x 1. A displacement history, e.g. modelhist['a']
+                    from step1/step2, dim(a) = ndof x nsteps, is also
+                    accepted.
         edof        dof topology array
+        out         optional preallocated output array with the shape
+                    and dtype (float) of ed, reused between calls
     
     Returns:
     
-        ed:     element displacement array
+        ed:     element displacement array, dim(ed) = nel x nedof,
+                or nsteps x nel x nedof for a displacement history
     
     """
 
-    ed = None
+    idx = np.asarray(edof)-1
+    a = np.asarray(a, dtype=float)
 
-    if edof.ndim == 1:
-        nDofs = len(edof)
-        ed = np.zeros([nDofs])
-        idx = edof-1
-        ed[:] = a[np.ix_(idx)].T
-    else:
-        nElements = edof.shape[0]
-        nDofs = edof.shape[1]
-        ed = np.zeros([nElements, nDofs])
-        i = 0
-        for row in edof:
-            idx = row-1
-            ed[i, :] = a[np.ix_(idx)].T
-            i += 1
+    if a.ndim == 2 and a.shape[1] == 1:
+        a = a[:, 0]
 
-    return ed
+    if a.ndim == 1:
+        return np.take(a, idx, out=out)
+    else:
+        return np.take(a.T, idx, axis=1, out=out)
 
 
 extractEldisp = extract_eldisp
 extract_ed = extract_eldisp
 
 
-def statcon(K, f, cd):
+def statcon(K, f, cd, return_factor=False):
     """
     Condensation of static FE-equations according to the vector cd.
 
+    The condensed matrix is computed from one factorization of Kbb
+    (sparse LU for scipy.sparse K) and a multi-RHS solve, without
+    forming the inverse of Kbb.
+
     Parameters:
     
-        K                       global stiffness matrix, dim(K) = nd x nd
+        K                       global stiffness matrix, dim(K) = nd x nd,
+                                dense or scipy.sparse
         f                       global load vector, dim(f)= nd x 1
 
         cd                      vector containing dof's to be eliminated
                                 dim(cd)= nc x 1, nc: number of condensed dof's
+        return_factor           also return the factorization of Kbb
     Returns:
     
         K1                      condensed stiffness matrix,
                                 dim(K1)= (nd-nc) x (nd-nc)
         f1                      condensed load vector, dim(f1)= (nd-nc) x 1
+        solve_bb                (if return_factor) function solving
+                                Kbb x = rhs with the factorization of Kbb.
+                                The condensed dofs are recovered as
+                                ab = solve_bb(fb - Kba*aa)
     """
     nd, nd = np.shape(K)
-    cd = (cd-1).flatten()
+    cd = np.asarray(cd).ravel()-1
 
     aindx = np.arange(nd)
     aindx = np.delete(aindx, cd, 0)
     bindx = cd
 
-    Kaa = np.matrix(K[np.ix_(aindx, aindx)])
-    Kab = np.matrix(K[np.ix_(aindx, bindx)])
-    Kbb = np.matrix(K[np.ix_(bindx, bindx)])
+    if sp.issparse(K):
+        K = K.tocsr()
+        Kaa, Kab = _partition_blocks(K, aindx, bindx)
+        Kbb, Kba = _partition_blocks(K, bindx, aindx)
+        Kaa = Kaa.toarray()
+        Kba = Kba.toarray()
+    else:
+        K = np.asarray(K)
+        Kaa, Kab = _partition_blocks(K, aindx, bindx)
+        Kbb, Kba = _partition_blocks(K, bindx, aindx)
+
+    f = np.asarray(f, dtype=float).reshape(nd, -1)
+    fa = f[aindx]
+    fb = f[bindx]
+
+    # Solve Kbb [X y] = [Kba fb] with all right-hand sides at once
+
+    solve_bb = _factorized(Kbb)
+    Xy = solve_bb(np.hstack((Kba, fb)))
+
+    K1 = Kaa-Kab@Xy[:, :aindx.shape[0]]
+    f1 = fa-Kab@Xy[:, aindx.shape[0]:]
+
+    K1 = np.asmatrix(K1)
+    f1 = np.asmatrix(f1)
+
+    if return_factor:
+        return K1, f1, solve_bb
+    else:
+        return K1, f1
+
+
+class Superelement:
+    """
+    Component condensed to its boundary dofs with statcon, for repeated
+    use in a global model.
+
+    The component is condensed once. Its reduced stiffness and load are
+    assembled for every placement of the component through an edof
+    topology (one row per instance, giving the global dofs of the
+    boundary dofs in order), and the interior dofs of all instances are
+    recovered in one multi-RHS solve with the cached factorization.
+
+    Parameters:
+
+        K           component stiffness matrix, dim(K) = nd x nd,
+                    dense or scipy.sparse
+        f           component load vector, dim(f) = nd x 1, or None
+        cd          vector containing the interior dof's to be eliminated
+
+    Attributes:
+
+        Ke          condensed stiffness matrix, dim(Ke) = nb x nb
+        fe          condensed load vector, dim(fe) = nb x 1
+        boundary_dofs  component dofs kept in Ke, in order (1-based)
+        interior_dofs  condensed component dofs, in order (1-based)
+    """
+
+    def __init__(self, K, f=None, cd=None):
+        nd = K.shape[0]
+
+        if f is None:
+            f = np.zeros((nd, 1))
+        f = np.asarray(f, dtype=float).reshape(nd, -1)
 
-    fa = np.matrix(f[aindx])
-    fb = np.matrix(f[bindx])
+        self.interior_dofs = np.asarray(cd, dtype=int).ravel()
+        self.boundary_dofs = np.delete(np.arange(nd), self.interior_dofs-1)+1
 
-    K1 = Kaa-Kab*Kbb.I*Kab.T
-    f1 = fa-Kab*Kbb.I*fb
+        Ke, fe, self._solve_ii = statcon(K, f, self.interior_dofs, return_factor=True)
+        self.Ke = np.asarray(Ke)
+        self.fe = np.asarray(fe)
 
-    return K1, f1
+        if sp.issparse(K):
+            K = K.tocsr()
+        _, self._Kib = _partition_blocks(
+            K, self.interior_dofs-1, self.boundary_dofs-1)
+        self._fi = f[self.interior_dofs-1]
+
+    def assem(self, edof, K, f=None):
+        """
+        Assemble the condensed component for each row of edof.
+
+        Parameters:
+
+            edof        dof topology array, dim(edof) = ninst x nb
+            K           global stiffness matrix, dense or scipy.sparse
+            f           global load vector (optional)
+
+        Returns:
+
+            K           updated stiffness matrix (a new matrix if K is sparse)
+            f           updated load vector, if f is given
+        """
+        edof = np.atleast_2d(edof)
+        idx = edof-1
+
+        if sp.issparse(K):
+            K = K+spassem(edof, self.Ke, K.shape[0])
+        else:
+            np.add.at(K, (idx[:, :, np.newaxis], idx[:, np.newaxis, :]), self.Ke)
+
+        if f is None:
+            return K
+
+        np.add.at(f, idx.ravel(), np.tile(self.fe[:, 0], idx.shape[0]).reshape(
+            (-1,)+np.shape(f)[1:]))
+
+        return K, f
+
+    def recover(self, edof, a):
+        """
+        Recover the interior displacements of all instances.
+
+        Parameters:
+
+            edof        dof topology array, dim(edof) = ninst x nb
+            a           global displacement vector, dim(a) = nd x 1
+
+        Returns:
+
+            ai          interior displacements, dim(ai) = ninst x ni,
+                        in the order of interior_dofs
+        """
+        ab = extract_eldisp(np.atleast_2d(edof), a)
+
+        return self._solve_ii(self._fi-self._Kib@ab.T).T
 
 
 def c_mul(a, b):
@@ -5970,11 +8112,17 @@ def coordxtr(edof, coords, dofs, nen=-1):
         ex, ey, ez      if ndims = 3
     """
 
-    # Create dictionary with dof indices
+    dofs = np.asarray(dofs)
+    edof = np.asarray(edof)
+    coords = np.asarray(coords, dtype=float)
+
+    if np.any(dofs != np.round(dofs)) or np.any(edof != np.round(edof)):
+        raise ValueError("dofs and edof must hold whole numbers (coordxtr)")
+
+    dofs = dofs.astype(int)
+    edof = edof.astype(int)
 
-    dofDict = {}
     nDofs = np.size(dofs, 1)
-    nElements = np.size(edof, 0)
     n_element_dofs = np.size(edof, 1)
     nDimensions = np.size(coords, 1)
     nElementDofs = np.size(edof, 1)
@@ -5989,39 +8137,40 @@ def coordxtr(edof, coords, dofs, nen=-1):
         user_warning(
             "dofs/edof mismatch. Using %d dofs per node when indexing." % nDofs)
 
-    idx = 0
-    for dof in dofs:
-        #dofDict[dofHash(dof)] = idx
-        dofDict[hash(tuple(dof[0:nDofs]))] = idx
-        idx += 1
-
-    # Loop over edof and extract element coords
-
-    ex = np.zeros((nElements, nElementNodes))
-    ey = np.zeros((nElements, nElementNodes))
-    ez = np.zeros((nElements, nElementNodes))
-
-    elementIdx = 0
-    for etopo in edof:
-        for i in range(nElementNodes):
-            i0 = i*nDofs
-            i1 = i*nDofs+nDofs-1
-            dof = []
-            if i0 == i1:
-                dof = [etopo[i*nDofs]]
-            else:
-                dof = etopo[i*nDofs:(i*nDofs+nDofs)]
+    nCmp = min(nDofs, dofs.shape[1])
+    if (nElementNodes-1)*nDofs+nCmp > n_element_dofs:
+        raise ValueError(
+            "edof has %d columns, too few for %d nodes with %d dofs (coordxtr)" % (
+                n_element_dofs, nElementNodes, nDofs))
+
+    # Inverse lookup from the first dof of each node to the node index
+
+    maxDof = dofs[:, 0].max()
+    dof_to_node = np.full(maxDof+1, -1, dtype=int)
+    dof_to_node[dofs[:, 0]] = np.arange(dofs.shape[0])
+
+    first_dofs = edof[:, 0:nElementNodes*nDofs:nDofs]
+    inRange = (first_dofs >= 0) & (first_dofs <= maxDof)
+    nodes = np.where(inRange, dof_to_node[np.where(inRange, first_dofs, 0)], -1)
+
+    # The element dofs of each node must equal its full row in dofs
+
+    cols = np.arange(nElementNodes)[:, np.newaxis]*nDofs+np.arange(nCmp)
+    found = (nodes >= 0) & np.all(dofs[nodes, :nCmp] == edof[:, cols], axis=2)
+
+    if not np.all(found):
+        element = np.flatnonzero(~np.all(found, axis=1))[0]
+        raise KeyError("edof row %d contains dofs not found in dofs (coordxtr)" % element)
+
+    # Gather element coords
 
-            nodeCoord = coords[dofDict[hash(tuple(dof[0:nDofs]))]]
+    ex = coords[nodes, 0]
 
-            if nDimensions >= 1:
-                ex[elementIdx, i] = nodeCoord[0]
-            if nDimensions >= 2:
-                ey[elementIdx, i] = nodeCoord[1]
-            if nDimensions >= 3:
-                ez[elementIdx, i] = nodeCoord[2]
+    if nDimensions >= 2:
+        ey = coords[nodes, 1]
 
-        elementIdx += 1
+    if nDimensions >= 3:
+        ez = coords[nodes, 2]
 
     if nDimensions == 1:
         return ex
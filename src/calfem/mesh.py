@@ -7,11 +7,15 @@ Contains functions and classes for generating meshes from geometries.
 
 import os
 import sys
+import json
+import hashlib
 import tempfile
 import shutil
 import subprocess
 
 import numpy as np
+import scipy.sparse as sp
+from scipy.sparse.csgraph import reverse_cuthill_mckee
 
 from calfem.core import createdofs
 from calfem.utils import which
@@ -93,14 +97,182 @@ def _insertBoundaryElement(boundaryElements, elementType, marker, nodes):
         {'elm-type': elementType, 'node-number-list': nodes})
 
 
+def _mshBlock(content, section):
+    """
+    Return (count line, data) of a $Section ... $EndSection block
+    of a .msh file given as bytes.
+    """
+    start = content.index(section + b'\n') + len(section) + 1
+    end = content.index(b'$End' + section[1:], start)
+    countLine, data = content[start:end].split(b'\n', 1)
+    return countLine, data
+
+
+def _mshElements(data):
+    """
+    Parse the $Elements block of a .msh file (version 2.2) in one pass.
+
+    Returns element types, markers (first tag), geometric entity IDs
+    (second tag) and a tuple (tokens, nodeStart, nodeCount) describing
+    where the node numbers of each element are found in tokens.
+    """
+    tokens = np.array(data.split(), dtype=np.int64)
+
+    # Count the tokens on each line from the raw bytes. This gives the
+    # offset of each element in tokens.
+
+    buf = np.frombuffer(data, dtype=np.uint8)
+    isSpace = np.isin(buf, np.frombuffer(b' \t\r\n', dtype=np.uint8))
+    isTokenStart = ~isSpace
+    isTokenStart[1:] &= isSpace[:-1]
+    lineIdx = np.cumsum(buf == ord('\n')) - (buf == ord('\n'))
+
+    lineLengths = np.bincount(lineIdx[isTokenStart])
+    lineLengths = lineLengths[lineLengths > 0]
+
+    offsets = np.zeros(lineLengths.size, dtype=np.int64)
+    np.cumsum(lineLengths[:-1], out=offsets[1:])
+
+    elmTypes = tokens[offsets+1]
+    nbrTags = tokens[offsets+2]
+    markers = tokens[offsets+3]
+    entities = tokens[offsets+4]
+
+    nodeStart = offsets+3+nbrTags
+    nodeCount = lineLengths-3-nbrTags
+
+    return elmTypes, markers, entities, (tokens, nodeStart, nodeCount)
+
+
+def _mshNodesOf(elmNodes, idx):
+    """Node numbers of elements idx, which all have the same number of nodes."""
+    tokens, nodeStart, nodeCount = elmNodes
+    n = nodeCount[idx[0]]
+    return tokens[nodeStart[idx][:, None] + np.arange(n)]
+
+
+def _mshNodeLists(elmNodes, idx):
+    """List of node number arrays for the elements idx."""
+    tokens, nodeStart, nodeCount = elmNodes
+    return [tokens[s:s+n] for s, n in zip(nodeStart[idx], nodeCount[idx])]
+
+
+def _mshGroupBy(keys, idx):
+    """Yield (key, idx[keys == key]) for each unique key."""
+    order = np.argsort(keys, kind='stable')
+    uniqueKeys, starts = np.unique(keys[order], return_index=True)
+    for key, group in zip(uniqueKeys, np.split(idx[order], starts[1:])):
+        yield int(key), group
+
+
+def _mshNodesOnEntities(elmNodes, entities, idx):
+    """
+    Dictionary with 0-based entity ID as key and list of unique 0-based
+    node indices of the elements idx on that entity as value.
+    """
+    tokens, nodeStart, nodeCount = elmNodes
+
+    nodesOn = {}
+    if idx.size == 0:
+        return nodesOn
+
+    # All (entity, node) pairs of the elements, using a repeat-gather
+
+    counts = nodeCount[idx]
+    pos = np.repeat(nodeStart[idx] - np.cumsum(counts) + counts, counts) + \
+        np.arange(counts.sum())
+    nodes = tokens[pos]-1
+    ents = np.repeat(entities[idx]-1, counts)
+
+    nNodes = nodes.max()+1
+    pairs = np.unique(ents*nNodes + nodes)
+    ents = pairs // nNodes
+    nodes = pairs % nNodes
+
+    uniqueEnts, starts = np.unique(ents, return_index=True)
+    for ent, group in zip(uniqueEnts, np.split(nodes, starts[1:])):
+        nodesOn[int(ent)] = group.tolist()
+
+    return nodesOn
+
+
+def _rcmNodeOrder(topo, nNodes):
+    """
+    Reverse Cuthill-McKee order of the nodes of the element topology
+    topo (1-based node numbers). Returns the original index of each
+    node in the new order.
+    """
+    nel, nen = topo.shape
+    incidence = sp.csr_matrix(
+        (np.ones(nel*nen), (np.repeat(np.arange(nel), nen), topo.ravel() - 1)),
+        shape=(nel, nNodes))
+    graph = (incidence.T @ incidence).tocsr()
+
+    return reverse_cuthill_mckee(graph, symmetric_mode=True).astype(int)
+
+
+# Version of the mesh cache file layout. Part of the cache key.
+
+_meshCacheFormat = 2
+
+
+def _packDict(dictionary, name):
+    """
+    Pack a dictionary of integer lists into three flat arrays with
+    names prefixed by name: keys, offsets and values.
+    """
+    keys = list(dictionary.keys())
+    values = [np.asarray(dictionary[key], dtype=int).ravel() for key in keys]
+    return {
+        name + '_keys': np.array(keys, dtype=int),
+        name + '_offsets': np.cumsum([0] + [v.size for v in values]),
+        name + '_values': np.concatenate(values) if values else np.zeros(0, dtype=int)}
+
+
+def _unpackDict(arrays, name, asList=False):
+    """Inverse of _packDict. Values are arrays, or lists if asList is set."""
+    offsets = arrays[name + '_offsets']
+    values = arrays[name + '_values']
+    dictionary = {int(key): values[offsets[i]:offsets[i+1]]
+                  for i, key in enumerate(arrays[name + '_keys'])}
+    if asList:
+        dictionary = {key: value.tolist() for key, value in dictionary.items()}
+    return dictionary
+
+
+def _evictMeshCache(cacheDir, maxSize):
+    """
+    Remove least recently used (oldest modification time) mesh cache
+    files until the total size of the cache is at most maxSize bytes.
+    """
+    entries = []
+    for fileName in os.listdir(cacheDir):
+        if fileName.endswith('.npz') and not fileName.endswith('.tmp.npz'):
+            path = os.path.join(cacheDir, fileName)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+    totalSize = sum(size for _, size, _ in entries)
+
+    for _, size, path in sorted(entries):
+        if totalSize <= maxSize:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        totalSize -= size
+
+
 def createGmshMesh(geometry, el_type=2, el_size_factor=1, dofs_per_node=1,
                    gmsh_exec_path=None, clcurv=False,
                    min_size=None, max_size=None, meshing_algorithm=None,
-                   additional_options=''):
+                   additional_options='', renumber=None):
 
     meshGen = GmshMeshGenerator(geometry, el_type, el_size_factor, dofs_per_node,
                                 gmsh_exec_path, clcurv, min_size, max_size, meshing_algorithm,
                                 additional_options)
+    meshGen.renumber = renumber
 
     return meshGen.create()
 
@@ -179,6 +351,24 @@ class GmshMeshGenerator:
         # is implemented in pycalfem though, so it does not matter.
 
         self.use_gmsh_module = True
+        self.use_gmsh_api = True
+
+        # Opt-in on-disk mesh cache. Meshes are stored in mesh_cache_dir
+        # keyed by a hash of the geometry and all meshing options. The
+        # least recently used meshes are removed when the total size
+        # exceeds mesh_cache_max_size (bytes).
+
+        self.mesh_cache_dir = None
+        self.mesh_cache_max_size = 512*1024*1024
+
+        # Optional node renumbering after meshing to reduce the bandwidth
+        # and fill-in of the system matrices. 'rcm' for reverse
+        # Cuthill-McKee. The permutations are kept in node_permutation
+        # and dof_permutation.
+
+        self.renumber = None
+        self.node_permutation = None
+        self.dof_permutation = None
         self.remove_gmsh_signal_handler = True
         self.initialize_gmsh = True
 
@@ -210,8 +400,8 @@ class GmshMeshGenerator:
                             [         ...         ],
                             [nn_dof1, ..., nn_dofn]]
 
-            bdofs           Boundary dofs. Dictionary containing lists of dofs for
-                            each boundary marker. Dictionary key = marker id.
+            bdofs           Boundary dofs. Dictionary containing integer arrays of
+                            dofs for each boundary marker. Dictionary key = marker id.
 
             elementmarkers  List of integer markers. Row i contains the marker of
                             element i. Markers are similar to boundary markers and
@@ -234,18 +424,95 @@ class GmshMeshGenerator:
             nodesOnVolume   Dictionary containing lists of node-indices. Key is a
                             volume-ID and the value is a list of indices of the nodes
                             in that volume, including its surface. 
+
+            bnodes          Dictionary containing integer arrays of node-indices.
+                            Key is a boundary marker and the value is an array of
+                            the (0-based) indices of the nodes with that marker.
+
+            node_permutation  If self.renumber is set, original (0-based) index
+                            of each node, coords = originalCoords[node_permutation].
+            dof_permutation   If self.renumber is set, original (0-based) index
+                            of each dof. A solution a in the renumbered dofs is
+                            mapped back by aOriginal[dof_permutation] = a.
+        '''
+
+        if self.mesh_cache_dir is None:
+            result = self._createMesh(is3D, dim)
+        else:
+            cacheKey = self._meshCacheKey(is3D)
+
+            result = self._loadCachedMesh(cacheKey)
+            if result is None:
+                result = self._createMesh(is3D, dim)
+                self._storeCachedMesh(cacheKey, result)
+
+        if self.renumber is not None:
+            result = self._renumberMesh(result)
+
+        return result
+
+    def _renumberMesh(self, result):
         '''
-        # Nodes per element for different element types:
-        # (taken from Chapter 9, page 89 of the gmsh manual)
-        nodesPerElmDict = {1: 2,   2: 3,   3: 4,   4: 4,   5: 8,
-                           6: 6,   7: 5,   8: 3,   9: 6,  10: 9,
-                           11: 10, 12: 27, 13: 18, 14: 14, 15: 1,
-                           16: 8,  17: 20, 18: 15, 19: 13, 20: 9,
-                           21: 10, 22: 12, 23: 15, 24: 15, 25: 21,
-                           26: 4,  27: 5,  28: 6,  29: 20, 30: 35,
-                           31: 56, 92: 64, 93: 125}
-        nodesPerElement = nodesPerElmDict[self.el_type]
+        Renumber the nodes of a mesh to reduce the bandwidth of the system
+        matrices. Returns the mesh with coords, edof, bdofs, boundary
+        elements, topo, bnodes and nodesOnCurve/Surface/Volume permuted
+        consistently. Element order, and thus elementmarkers, is kept.
+        '''
+        if self.renumber != 'rcm':
+            raise ValueError("Unknown renumbering method %s." % self.renumber)
+
+        coords, edof, dofs, bdofs, elementmarkers = result[:5]
+        nNodes = np.size(coords, 0)
+
+        if self.dofs_per_node > 1:
+            topo = self.topo
+        else:
+            topo = edof
+
+        perm = _rcmNodeOrder(np.asarray(topo), nNodes)
+        inv = np.empty_like(perm)
+        inv[perm] = np.arange(nNodes)
 
+        # Node i of the renumbered mesh keeps the dofs dofs[i], so the dofs
+        # of the original node perm[i] move there.
+
+        dofPerm = dofs[perm].ravel() - 1
+        dofMap = np.empty_like(dofPerm)
+        dofMap[dofPerm] = np.arange(dofPerm.size) + 1
+
+        coords = coords[perm]
+        edof = dofMap[np.asarray(edof) - 1]
+
+        if self.dofs_per_node > 1:
+            self.topo = inv[np.asarray(self.topo) - 1] + 1
+
+        self.bnodes = {marker: np.sort(inv[nodes])
+                       for marker, nodes in self.bnodes.items()}
+        bdofs = {marker: dofs[nodes].ravel()
+                 for marker, nodes in self.bnodes.items()}
+
+        self.nodesOnCurve = {key: np.sort(inv[nodes]).tolist()
+                             for key, nodes in self.nodesOnCurve.items()}
+        self.nodesOnSurface = {key: np.sort(inv[nodes]).tolist()
+                               for key, nodes in self.nodesOnSurface.items()}
+        self.nodesOnVolume = {key: np.sort(inv[nodes]).tolist()
+                              for key, nodes in self.nodesOnVolume.items()}
+
+        self.node_permutation = perm
+        self.dof_permutation = dofPerm
+
+        if self.return_boundary_elements:
+            boundaryElements = result[5]
+            for elmList in boundaryElements.values():
+                for elm in elmList:
+                    elm['node-number-list'] = (
+                        inv[np.asarray(elm['node-number-list']) - 1] + 1).tolist()
+            return coords, edof, dofs, bdofs, elementmarkers, boundaryElements
+
+        return coords, edof, dofs, bdofs, elementmarkers
+
+    def _createMesh(self, is3D, dim):
+        '''Meshes the geometry with gmsh. See create().'''
         # Check for GMSH executable
         #
         # Consider using the gmsh_extension module
@@ -275,6 +542,13 @@ class GmshMeshGenerator:
         else:
             cflog.info(" GMSH -> Python-module")
 
+        # When meshing with the gmsh module, a Geometry object is transferred
+        # to gmsh and the mesh is read back through the gmsh API. No .geo
+        # or .msh files are written unless mesh_dir is given.
+
+        inMemory = self.use_gmsh_module and self.use_gmsh_api and \
+            type(self.geometry) is not str and self.mesh_dir == ""
+
         # Create a temporary directory for GMSH
 
         oldStyleTempDir = False
@@ -283,7 +557,7 @@ class GmshMeshGenerator:
             tempMeshDir = self.mesh_dir
             if not os.path.exists(tempMeshDir):
                 os.mkdir(tempMeshDir)
-        else:
+        elif not inMemory:
             tempMeshDir = tempfile.mkdtemp()
 
         # If geometry data is given as a .geo file we will just pass it on to gmsh later.
@@ -306,7 +580,9 @@ class GmshMeshGenerator:
 
             dim = 3 if self.geometry.is3D else 2
 
-            if oldStyleTempDir:
+            if inMemory:
+                pass
+            elif oldStyleTempDir:
                 if not os.path.exists("./gmshMeshTemp"):
                     os.mkdir("./gmshMeshTemp")
                 geoFilePath = os.path.normpath(os.path.join(
@@ -315,10 +591,13 @@ class GmshMeshGenerator:
                 geoFilePath = os.path.normpath(
                     os.path.join(tempMeshDir, 'tempGeometry.geo'))
 
-            with open(geoFilePath, "w") as self.geofile:
-                self._writeGeoFile()  # Write geoData to file
+            if not inMemory:
+                with open(geoFilePath, "w") as self.geofile:
+                    self._writeGeoFile()  # Write geoData to file
 
-        if oldStyleTempDir:
+        if inMemory:
+            mshFileName = None
+        elif oldStyleTempDir:
 
             # Filepath to the msh-file that will be generated.
 
@@ -362,9 +641,18 @@ class GmshMeshGenerator:
             if self.remove_gmsh_signal_handler:
                 gmsh.oldsig = None
 
-            # Load .geo file
+            if inMemory:
+
+                # Build the geometry directly in a new gmsh model
+
+                gmsh.model.add("calfem")
+                self._createGmshModel()
+            else:
+
+                # Load .geo file
+
+                gmsh.open(geoFilePath)
 
-            gmsh.open(geoFilePath)
             gmsh.model.geo.synchronize()
 
             # Set meshing options
@@ -394,9 +682,17 @@ class GmshMeshGenerator:
 
             gmsh.model.mesh.generate(dim)
 
-            # Write .msh file
+            if inMemory:
+
+                # Extract mesh arrays from the gmsh model
+
+                meshData = self._getGmshMeshData(dim)
+                gmsh.model.remove()
+            else:
 
-            gmsh.write(mshFileName)
+                # Write .msh file
+
+                gmsh.write(mshFileName)
 
             # Close extension module
 
@@ -410,148 +706,391 @@ class GmshMeshGenerator:
                 gmshExe, geoFilePath, options), shell=True, stdout=subprocess.PIPE).stdout.read()
 
         # Read generated msh file:
-        # print("Opening msh file " + mshFileName)#TEMP
-
-        with open(mshFileName, 'r') as mshFile:
 
+        if not inMemory:
             info(" Mesh file  : "+mshFileName)
+            meshData = self._readMshFile(mshFileName, dim)
 
-            # print("Reading msh file...")
+        allNodes = meshData[0]
+        elements, elementmarkers, bdofs, boundaryElements = self._processMeshElements(
+            *meshData[1:])
 
-            ln = mshFile.readline()
-            while(ln != '$Nodes\n'):  # Read until we find the nodes
-                ln = mshFile.readline()
-            nbrNodes = int(mshFile.readline())
-            allNodes = np.zeros([nbrNodes, dim], 'd')
-            for i in range(nbrNodes):
-                line = list(map(float, mshFile.readline().split()))
+        # Remove temporary mesh directory if not explicetly specified.
 
-                # Grab the coordinates (1:3 if 2D, 1:4 if 3D)
+        if self.mesh_dir == "" and not inMemory:
+            shutil.rmtree(tempMeshDir)
 
-                allNodes[i, :] = line[1:dim+1]
+        dofs = createdofs(np.size(allNodes, 0), self.dofs_per_node)
 
-            while(mshFile.readline() != '$Elements\n'):  # Read until we find the elements
-                pass
+        # Expand node topology and boundary nodes to dofs by indexing
+        # into the dofs array. Row i of dofs holds the dofs of node i+1.
+
+        self.bnodes = {marker: np.asarray(nodes, dtype=int) - 1
+                       for marker, nodes in bdofs.items()}
+
+        bdofs = {marker: dofs[nodes].ravel()
+                 for marker, nodes in self.bnodes.items()}
+
+        if self.dofs_per_node > 1:
+            self.topo = elements
+            elements = dofs[elements - 1].reshape(np.size(elements, 0), -1)
+
+        if self.return_boundary_elements:
+            return allNodes, elements, dofs, bdofs, elementmarkers, boundaryElements
+        return allNodes, elements, dofs, bdofs, elementmarkers
+
+    def _meshCacheKey(self, is3D):
+        """
+        Hash of the serialized geometry and all meshing options.
+        """
+        if type(self.geometry) is str:
+            with open(self.geometry, 'rb') as geoFile:
+                geometry = [hashlib.sha256(geoFile.read()).hexdigest(), is3D]
+        else:
+            g = self.geometry
+            geometry = [sorted(g.points.items()), sorted(g.curves.items()),
+                        sorted(g.surfaces.items()), sorted(g.volumes.items()),
+                        g.is3D]
+
+        options = [self.el_type, self.el_size_factor, self.dofs_per_node,
+                   self.min_size, self.max_size, self.clcurv,
+                   self.meshing_algorithm, self.additional_options,
+                   sorted(self.gmsh_options.items()),
+                   self.return_boundary_elements, gmsh.__version__,
+                   _meshCacheFormat]
+
+        serialized = json.dumps([geometry, options], default=str)
+
+        return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+    def _loadCachedMesh(self, cacheKey):
+        """
+        Return cached mesh for cacheKey, or None if it is not cached.
+        """
+        cacheFile = os.path.join(self.mesh_cache_dir, cacheKey + '.npz')
+
+        try:
+            with np.load(cacheFile) as data:
+                arrays = dict(data)
+        except (OSError, ValueError, KeyError):
+            return None
 
-            # The nbr of elements (including marker elements).
+        info(" Mesh cache : hit "+cacheKey)
 
-            nbrElements = int(mshFile.readline())
-            elements = []
-            elementmarkers = []
+        # Mark as recently used
 
-            # temp dictionary of sets. Key:MarkerID. Value:Set. The sets will be converted to lists.
+        os.utime(cacheFile)
 
-            bdofs = {}
+        self.nodesOnCurve = _unpackDict(arrays, 'nodesOnCurve', asList=True)
+        self.nodesOnSurface = _unpackDict(arrays, 'nodesOnSurface', asList=True)
+        self.nodesOnVolume = _unpackDict(arrays, 'nodesOnVolume', asList=True)
+        self.bnodes = _unpackDict(arrays, 'bnodes')
+
+        if 'topo' in arrays:
+            self.topo = arrays['topo']
+
+        result = [arrays['coords'], arrays['edof'], arrays['dofs'],
+                  _unpackDict(arrays, 'bdofs'),
+                  arrays['elementmarkers'].tolist()]
+
+        if self.return_boundary_elements:
             boundaryElements = {}
+            for elementType, marker, nodes in zip(
+                    arrays['be_types'], arrays['be_markers'],
+                    np.split(arrays['be_nodes'], arrays['be_offsets'][1:-1])):
+                _insertBoundaryElement(
+                    boundaryElements, int(elementType), int(marker), nodes.tolist())
+            result.append(boundaryElements)
+
+        return tuple(result)
+
+    def _storeCachedMesh(self, cacheKey, result):
+        """
+        Store mesh result in the cache and evict the least recently used
+        cache files if the cache exceeds mesh_cache_max_size.
+        """
+        if not os.path.exists(self.mesh_cache_dir):
+            os.makedirs(self.mesh_cache_dir)
+
+        coords, edof, dofs, bdofs, elementmarkers = result[:5]
+
+        arrays = {'coords': coords, 'edof': edof, 'dofs': dofs,
+                  'elementmarkers': np.asarray(elementmarkers, dtype=int)}
+
+        arrays.update(_packDict(bdofs, 'bdofs'))
+        arrays.update(_packDict(self.bnodes, 'bnodes'))
+        arrays.update(_packDict(self.nodesOnCurve, 'nodesOnCurve'))
+        arrays.update(_packDict(self.nodesOnSurface, 'nodesOnSurface'))
+        arrays.update(_packDict(self.nodesOnVolume, 'nodesOnVolume'))
+
+        if self.dofs_per_node > 1:
+            arrays['topo'] = self.topo
+
+        if self.return_boundary_elements:
+            elms = [(marker, elm) for marker, elmList in result[5].items()
+                    for elm in elmList]
+            nodeLists = [elm['node-number-list'] for _, elm in elms]
+            arrays['be_markers'] = np.array(
+                [marker for marker, _ in elms], dtype=int)
+            arrays['be_types'] = np.array(
+                [elm['elm-type'] for _, elm in elms], dtype=int)
+            arrays['be_offsets'] = np.cumsum(
+                [0] + [len(nodes) for nodes in nodeLists])
+            arrays['be_nodes'] = np.array(
+                [n for nodes in nodeLists for n in nodes], dtype=int)
+
+        # Write to a temporary file first, so that concurrent runs never
+        # see partially written cache files.
+
+        cacheFile = os.path.join(self.mesh_cache_dir, cacheKey + '.npz')
+        tempFile = cacheFile + '.%d.tmp.npz' % os.getpid()
+        np.savez_compressed(tempFile, **arrays)
+        os.replace(tempFile, cacheFile)
+
+        info(" Mesh cache : stored "+cacheKey)
+
+        _evictMeshCache(self.mesh_cache_dir, self.mesh_cache_max_size)
+
+    def _readMshFile(self, mshFileName, dim):
+        """
+        Read a gmsh 2.2 ASCII .msh file. The $Nodes and $Elements blocks
+        are parsed into NumPy arrays in one pass.
+
+        Returns:
+
+            allNodes          Node coordinates, [nNodes x dim]
+            elmTypes          gmsh type of each element
+            markers           Marker (physical tag) of each element
+            entities          Geometric entity ID of each element
+            elmNodes          (tokens, nodeStart, nodeCount), node numbers
+                              of element i are
+                              tokens[nodeStart[i]:nodeStart[i]+nodeCount[i]]
+        """
+
+        with open(mshFileName, 'rb') as mshFile:
+            content = mshFile.read()
+
+        # Universal newlines, as when reading in text mode
+
+        content = content.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
 
-            # nodeOnPoint = {}  #dictionary pointID : nodeNumber
+        # Nodes: "node-number x y z" on each line
 
-            self.nodesOnCurve = {}  # dictionary lineID  : set of [nodeNumber]
-            # dictionary surfID  : set of [nodeNumber]
-            self.nodesOnSurface = {}
-            self.nodesOnVolume = {}  # dictionary volID   : set of [nodeNumber]
+        nodeBlock = _mshBlock(content, b'$Nodes')
+        nbrNodes = int(nodeBlock[0])
+        nodeData = np.array(nodeBlock[1].split(), dtype=float)
+        allNodes = np.ascontiguousarray(
+            nodeData.reshape(nbrNodes, 4)[:, 1:dim+1])
 
-            # Read all elements (points, surfaces, etc):
+        # Elements: "elm-number elm-type number-of-tags <tags> node-number-list"
 
-            for i in range(nbrElements):
-                line = list(map(int, mshFile.readline().split()))
-                eType = line[1]  # second int is the element type.
-                # Third int is the nbr of tags on this element.
-                nbrTags = line[2]
-                marker = line[3]  # Fourth int (first tag) is the marker.
+        elementBlock = _mshBlock(content, b'$Elements')
+        elmTypes, markers, entities, elmNodes = _mshElements(elementBlock[1])
 
-                # Fifth int  is the ID of the geometric entity (points, curves, etc) that the element belongs to
+        return allNodes, elmTypes, markers, entities, elmNodes
 
-                entityID = line[4]
+    def _getGmshMeshData(self, dim):
+        """
+        Extract the mesh of the current gmsh model as arrays, in the same
+        form as returned by _readMshFile. Elements get the marker of their
+        geometric entity in self.geometry. As in a .msh file written by
+        gmsh, elements on points are only included if the point has a
+        non-zero marker.
+        """
 
-                # The rest after tags are node indices.
+        nodeTags, nodeCoords, _ = gmsh.model.mesh.getNodes()
+        nodeCoords = nodeCoords.reshape(-1, 3)
 
-                nodes = line[3+nbrTags: len(line)]
+        allNodes = np.zeros([int(nodeTags.max()), dim], 'd')
+        allNodes[nodeTags.astype(int)-1] = nodeCoords[:, :dim]
 
-                # If the element type is the kind of element we are looking for:
+        entityMarkers = [
+            {ID+1: point[2] for ID, point in self.geometry.points.items()},
+            {ID+1: curve[2] for ID, curve in self.geometry.curves.items()},
+            {ID+1: surf[4] for ID, surf in self.geometry.surfaces.items()},
+            {ID+1: vol[3] for ID, vol in self.geometry.volumes.items()}]
 
-                if(eType == self.el_type):
+        elmTypes = []
+        markers = []
+        entities = []
+        nodeLists = []
+        nodeCounts = []
 
-                    # Add the nodes of the elements to the list.
+        for entityDim, entity in gmsh.model.getEntities():
+            marker = entityMarkers[entityDim].get(entity, 0)
+            if entityDim == 0 and marker == 0:
+                continue
 
-                    elements.append(nodes)
+            types, _, typeNodes = gmsh.model.mesh.getElements(
+                entityDim, entity)
 
-                    # Add element marker. It is used for keeping track of elements (thickness, heat-production and such)
+            for elmType, nodes in zip(types, typeNodes):
+                nodesPerElement = gmsh.model.mesh.getElementProperties(elmType)[
+                    3]
+                nbrElements = nodes.size // nodesPerElement
+                elmTypes.append(np.full(nbrElements, elmType, dtype=np.int64))
+                markers.append(np.full(nbrElements, marker, dtype=np.int64))
+                entities.append(np.full(nbrElements, entity, dtype=np.int64))
+                nodeCounts.append(
+                    np.full(nbrElements, nodesPerElement, dtype=np.int64))
+                nodeLists.append(nodes.astype(np.int64))
 
-                    elementmarkers.append(marker)
-                else:  # If the element is not a "real" element we store its node at marker in bdof instead:
-                    _insertInSetDict(bdofs, marker, nodes)
+        def _concat(arrays):
+            return np.concatenate(arrays) if arrays else np.zeros(0, dtype=np.int64)
 
-                    # We also store the full information as 'boundary elements'
+        nodeCount = _concat(nodeCounts)
+        nodeStart = np.zeros(nodeCount.size, dtype=np.int64)
+        np.cumsum(nodeCount[:-1], out=nodeStart[1:])
 
-                    _insertBoundaryElement(
-                        boundaryElements, eType, marker, nodes)
+        tokens = _concat(nodeLists)
 
-                # if eType == 15: #If point. Commmented away because points only make elements if they have non-zero markers, so nodeOnPoint is not very useful.
-                #    nodeOnPoint[entityID-1] = nodes[0] #insert node into nodeOnPoint. (ID-1 because we want 0-based indices)
+        # Like gmsh does when writing a .msh file, only keep nodes that are
+        # used by the extracted elements (not e.g. spline control points)
+        # and number them consecutively.
 
-                if eType in [1, 8, 26, 27, 28]:  # If line
+        usedNodes = np.unique(tokens)
+        if usedNodes.size != allNodes.shape[0]:
+            allNodes = allNodes[usedNodes-1]
+            tokens = np.searchsorted(usedNodes, tokens)+1
 
-                    # insert nodes into nodesOnCurve
+        elmNodes = (tokens, nodeStart, nodeCount)
+
+        return allNodes, _concat(elmTypes), _concat(markers), _concat(entities), elmNodes
+
+    def _createGmshModel(self):
+        """
+        Create the geometry in self.geometry in the current gmsh model
+        through the gmsh API. Corresponds to the .geo file written by
+        _writeGeoFile, except that no physical groups are created.
+        Markers are instead assigned when the mesh is extracted.
+        """
+        geo = gmsh.model.geo
+
+        # POINTS:
+
+        for ID, [coords, elSize, marker] in self.geometry.points.items():
+            geo.addPoint(*coords, meshSize=elSize, tag=ID+1)
 
-                    _insertInSetDict(self.nodesOnCurve, entityID -
-                                     1, _offsetIndices(nodes, -1))
-                elif eType in [2, 3, 9, 10, 16, 20, 21, 22, 23, 24, 25]:  # If surfaceelement
+        # CURVES:
 
-                    # insert nodes into nodesOnSurface
+        for ID, [curveName, points, marker, elOnCurve, distributionString, distributionVal] in self.geometry.curves.items():
+            pointTags = _offsetIndices(points, 1)
+            if curveName == "Spline":
+                geo.addSpline(pointTags, ID+1)
+            elif curveName == "BSpline":
+                geo.addBSpline(pointTags, ID+1)
+            elif curveName == "Circle":
+                geo.addCircleArc(*pointTags, tag=ID+1)
+            elif curveName == "Ellipse":
+                geo.addEllipseArc(*pointTags, tag=ID+1)
 
-                    _insertInSetDict(self.nodesOnSurface, entityID -
-                                     1, _offsetIndices(nodes, -1))
+            if elOnCurve != None:
+                if distributionString == None:
+                    geo.mesh.setTransfiniteCurve(ID+1, elOnCurve+1)
                 else:
+                    geo.mesh.setTransfiniteCurve(
+                        ID+1, elOnCurve+1, distributionString, distributionVal)
 
-                    # if volume element.
+        # SURFACES:
 
-                    _insertInSetDict(self.nodesOnVolume, entityID -
-                                     1, _offsetIndices(nodes, -1))
+        for ID, [surfName, outerLoop, holes, ID, marker, isStructured] in self.geometry.surfaces.items():
+            loopTags = [geo.addCurveLoop(
+                self._lineLoopIndices(outerLoop, ID+1), ID+1)]
+            for hole, i in zip(holes, range(len(holes))):
+                holeID = 10000 * (ID+1) + 10 * i + 5
+                loopTags.append(geo.addCurveLoop(
+                    self._lineLoopIndices(hole, holeID), holeID))
 
-            elements = np.array(elements)
-            for key in bdofs.keys():  # Convert the sets of boundary nodes to lists.
-                bdofs[key] = list(bdofs[key])
-            for key in self.nodesOnCurve.keys():  # Convert set to list
-                self.nodesOnCurve[key] = list(self.nodesOnCurve[key])
-            for key in self.nodesOnSurface.keys():  # Convert set to list
-                self.nodesOnSurface[key] = list(self.nodesOnSurface[key])
-            for key in self.nodesOnVolume.keys():  # Convert set to list
-                self.nodesOnVolume[key] = list(self.nodesOnVolume[key])
+            if surfName == "Plane Surface":
+                geo.addPlaneSurface(loopTags, ID+1)
+            else:
+                geo.addSurfaceFilling(loopTags, ID+1)
 
-        # Remove temporary mesh directory if not explicetly specified.
+            if isStructured:
+                cornerPoints = set()
+                for c in outerLoop:
+                    curvePoints = self.geometry.curves[c][1]
+                    cornerPoints.add(curvePoints[0])
+                    cornerPoints.add(curvePoints[-1])
+                geo.mesh.setTransfiniteSurface(
+                    ID+1, cornerTags=_offsetIndices(list(cornerPoints), 1))
 
-        if self.mesh_dir == "":
-            shutil.rmtree(tempMeshDir)
+        # VOLUMES:
 
-        dofs = createdofs(np.size(allNodes, 0), self.dofs_per_node)
+        for ID, [outerLoop, holes, ID, marker, isStructured] in self.geometry.volumes.items():
+            loopTags = [geo.addSurfaceLoop(_offsetIndices(outerLoop, 1), ID+1)]
+            for hole, i in zip(holes, range(len(holes))):
+                holeID = 10000 * (ID+1) + 10 * i + 7
+                loopTags.append(geo.addSurfaceLoop(
+                    _offsetIndices(hole, 1), holeID))
 
-        if self.dofs_per_node > 1:  # This if-chunk copied from pycalfem_utils.py
-            self.topo = elements
-            expandedElements = np.zeros(
-                (np.size(elements, 0), nodesPerElement*self.dofs_per_node), 'i')
-            elIdx = 0
-            for elementTopo in elements:
-                for i in range(nodesPerElement):
-                    expandedElements[elIdx, i*self.dofs_per_node:(
-                        i*self.dofs_per_node+self.dofs_per_node)] = dofs[elementTopo[i]-1, :]
-                elIdx += 1
-
-            for keyID in bdofs.keys():
-                bVerts = bdofs[keyID]
-                bVertsNew = []
-                for i in range(len(bVerts)):
-                    for j in range(self.dofs_per_node):
-                        bVertsNew.append(dofs[bVerts[i]-1][j])
-                bdofs[keyID] = bVertsNew
-
-            if self.return_boundary_elements:
-                return allNodes, np.asarray(expandedElements), dofs, bdofs, elementmarkers, boundaryElements
-            return allNodes, np.asarray(expandedElements), dofs, bdofs, elementmarkers
+            geo.addVolume(loopTags, ID+1)
+
+            if isStructured:
+                geo.mesh.setTransfiniteVolume(ID+1)
+
+        if self.el_type in self._ElementsWithQuadFaces:
+            gmsh.option.setNumber("Mesh.RecombineAll", 1)
 
+        if self.el_type in self._2dOrderIncompleteElms:
+            gmsh.option.setNumber("Mesh.SecondOrderIncomplete", 1)
+
+    def _processMeshElements(self, elmTypes, markers, entities, elmNodes):
+        """
+        Split the elements of a mesh into elements of type self.el_type and
+        boundary elements using array operations. Also sets nodesOnCurve,
+        nodesOnSurface and nodesOnVolume.
+
+        Returns:
+
+            elements          Element node numbers (1-based) of the
+                              elements of type self.el_type
+            elementmarkers    Marker of each element
+            bdofs             Dictionary marker : list of nodes (1-based)
+                              of all other elements with that marker
+            boundaryElements  Dictionary marker : list of boundary elements
+        """
+
+        isElement = elmTypes == self.el_type
+
+        elementIdx = np.flatnonzero(isElement)
+        if elementIdx.size > 0:
+            elements = _mshNodesOf(elmNodes, elementIdx)
+        else:
+            elements = np.zeros((0, 0), dtype=int)
+        elementmarkers = markers[elementIdx].tolist()
+
+        # Nodes of all other elements are stored at their marker in bdofs
+
+        boundaryIdx = np.flatnonzero(~isElement)
+        bdofs = {}
+        for marker, idx in _mshGroupBy(markers[boundaryIdx], boundaryIdx):
+            bdofs[marker] = np.unique(
+                np.concatenate(_mshNodeLists(elmNodes, idx))).tolist()
+
+        # We also store the full information as 'boundary elements'
+
+        boundaryElements = {}
         if self.return_boundary_elements:
-            return allNodes, elements, dofs, bdofs, elementmarkers, boundaryElements
-        return allNodes, elements, dofs, bdofs, elementmarkers
+            for i, nodes in zip(boundaryIdx, _mshNodeLists(elmNodes, boundaryIdx)):
+                _insertBoundaryElement(
+                    boundaryElements, int(elmTypes[i]), int(markers[i]), nodes.tolist())
+
+        # Nodes (0-based) on each geometric curve, surface or volume
+
+        isCurve = np.isin(elmTypes, [1, 8, 26, 27, 28])
+        isSurface = np.isin(
+            elmTypes, [2, 3, 9, 10, 16, 20, 21, 22, 23, 24, 25])
+        isVolume = ~(isCurve | isSurface)
+
+        self.nodesOnCurve = _mshNodesOnEntities(
+            elmNodes, entities, np.flatnonzero(isCurve))
+        self.nodesOnSurface = _mshNodesOnEntities(
+            elmNodes, entities, np.flatnonzero(isSurface))
+        self.nodesOnVolume = _mshNodesOnEntities(
+            elmNodes, entities, np.flatnonzero(isVolume))
+
+        return elements, elementmarkers, bdofs, boundaryElements
 
     def _writeGeoFile(self):
 
@@ -705,6 +1244,12 @@ class GmshMeshGenerator:
             self.geofile.write("Mesh.SecondOrderIncomplete=1;\n")
 
     def _writeLineLoop(self, lineIndices, loopID):
+        self.geofile.write("Line Loop(%i) = {%s};\n" % (loopID, _formatList(
+            self._lineLoopIndices(lineIndices, loopID))))  # (lineIndices are alreay 1-based here)
+
+    def _lineLoopIndices(self, lineIndices, loopID):
+        '''Returns the 1-based, signed curve indices of a line loop, with curve
+        directions arranged the way Gmsh expects.'''
 
         # endPoints is used to keep track of at which points the curves start and end (i.e the direction of the curves)
 
@@ -759,8 +1304,7 @@ class GmshMeshGenerator:
         if not self.geometry.is3D:
             lineIndices = self._makeCounterClockwise(lineIndices)
 
-        self.geofile.write("Line Loop(%i) = {%s};\n" % (loopID, _formatList(
-            lineIndices)))  # (lineIndices are alreay 1-based here)
+        return lineIndices
 
     def _makeCounterClockwise(self, lineIndices):
         '''If the lineIndices describe a line loop that is not counterclockwise,
@@ -11,7 +11,6 @@ import calfem.utils as cfu
 import logging as cflog
 
 import numpy as np
-from scipy.sparse import lil_matrix
 
 def error(msg):
     cflog.error(" calfem.solver: "+msg)
@@ -30,9 +29,27 @@ class Solver:
         self.n_dofs = np.size(mesh.dofs)
         self.n_elements = np.size(self.mesh.edof,0)
 
-        self.bc = np.array([],'i')
-        self.bc_val = np.array([],'i')
+        self.bcs = cfc.BoundaryConditions(self.n_dofs, np.size(mesh.dofs, 1))
         self.f = np.zeros([self.n_dofs,1])
+        self.K = None
+
+        # Linear solver, see cfc.spsolveq. With method 'pcg' and
+        # precond 'amg' the multigrid preconditioner is set up with
+        # rigid-body modes from the mesh. execute assembles K every
+        # time, so changes to the mesh or material are picked up. The
+        # preconditioner is only rebuilt when K or the boundary
+        # conditions have changed since it was set up.
+
+        self.method = 'direct'
+        self.precond = 'jacobi'
+        self.amg = None
+        self._amg_dirty = True
+
+        # Number of worker processes for element matrix computation in
+        # assem, see cfc.spassem_parallel. None computes them serially,
+        # as do solvers without on_query_Ke_kernel.
+
+        self.workers = None
         
         self.results.el_forces = np.zeros([self.n_elements, self.on_query_el_force_size()])
         
@@ -44,7 +61,16 @@ class Solver:
         self.assem()
         
         info("Solving system...")        
-        self.results.a, self.results.r = cfc.spsolveq(self.K, self.f, self.bc, self.bc_val)
+        precond = self.precond
+        if self.method == 'pcg' and precond == 'amg':
+            if self.amg is None or self._amg_dirty:
+                self.amg = cfc.AMGPreconditioner(self.K, self.bcs, coords=self.mesh.coords, dofs=self.mesh.dofs)
+                self._amg_dirty = False
+            precond = self.amg
+
+        self.results.a, self.results.r = cfc.spsolveq(
+            self.K, self.f, self.bcs, method=self.method, precond=precond,
+            dofs_per_node=self.bcs.dofs_per_node)
         
         info("Extracting ed...")        
         self.results.ed = cfc.extractEldisp(self.mesh.edof, self.results.a)
@@ -55,13 +81,28 @@ class Solver:
         return self.results
         
     def assem(self):
-        self.K = lil_matrix((self.n_dofs, self.n_dofs))
-        for eltopo, elx, ely in zip(self.mesh.edof, self.mesh.ex, self.mesh.ey):
-            Ke = self.on_create_Ke(elx, ely, self.mesh.shape.element_type)                
-            cfc.assem(eltopo, self.K, Ke)
+        kernel = None
+        if self.workers is not None and self.workers > 1:
+            kernel = self.on_query_Ke_kernel()
+            if kernel is None:
+                info("No element kernel for parallel assembly, assembling serially.")
+
+        if kernel is not None:
+            K = cfc.spassem_parallel(
+                self.mesh.edof, kernel[0], self.mesh.ex, self.mesh.ey,
+                args=kernel[1], nDofs=self.n_dofs, workers=self.workers)
+        else:
+            Ke = np.array([self.on_create_Ke(elx, ely, self.mesh.shape.element_type)
+                           for elx, ely in zip(self.mesh.ex, self.mesh.ey)])
+            K = cfc.spassem(self.mesh.edof, Ke, self.n_dofs)
+
+        if self.K is None or K.shape != self.K.shape or (K != self.K).nnz > 0:
+            self._amg_dirty = True
+        self.K = K
             
     def addBC(self, marker, value=0.0, dimension=0):
-        self.bc, self.bc_val = cfu.applybc(self.mesh.bdofs, self.bc, self.bc_val, marker, value, dimension)
+        self.bcs.add_marker(self.mesh.bdofs, marker, value, dimension)
+        self._amg_dirty = True
         
     def addForceTotal(self, marker, value=0.0, dimension=0):
         cfu.applyforcetotal(self.mesh.bdofs, self.f, self.mesh.shape.top_id, value, dimension)
@@ -73,10 +114,14 @@ class Solver:
         cfu.applyforcenode(node, value, dimension)
         
     def addBCNode(self, node, value = 0.0, dimension = 0):
-        self.bc, self.bc_val = cfu.applybcnode(node, value, dimension)
+        self.bcs.add_node(node, self.mesh.dofs, value, dimension)
+        self._amg_dirty = True
 
     def applyBCs(self):
-        self.bc, self.bc_val = self.on_apply_bcs(self.mesh, self.bc, self.bcVal)
+        bcs = self.on_apply_bcs(self.mesh, self.bcs.bc_prescr, self.bcs.bc_val)
+        if bcs is not None:
+            self.bcs.add_dofs(*bcs)
+        self._amg_dirty = True
                 
     def calc_element_forces(self):
         for i in range(self.mesh.edof.shape[0]):
@@ -92,6 +137,12 @@ class Solver:
 
     def on_create_Ke(self, elx, ely, element_type):
         pass
+
+    def on_query_Ke_kernel(self):
+        # Module level element routine and its extra arguments, called as
+        # kernel(elx, ely, *args), for parallel assembly. It is sent to
+        # the worker processes, so it must not reference the solver.
+        return None
     
     def on_apply_bcs(self, mesh, bc, bcVal):        
         pass
@@ -109,14 +160,20 @@ class Plan2DSolver(Solver):
             Ke = cfc.planqe(elx, ely, self.mesh.shape.ep, self.mesh.shape.D)
             
         return Ke
+
+    def on_query_Ke_kernel(self):
+        if self.mesh.shape.element_type == 2:
+            return cfc.plante, (self.mesh.shape.ep, self.mesh.shape.D)
+        else:
+            return cfc.planqe, (self.mesh.shape.ep, self.mesh.shape.D)
                     
     def on_calc_el_force(self, ex, ey, ed, element_type):
         if element_type == 2: 
             es, et = cfc.plants(ex, ey, self.mesh.shape.ep, self.mesh.shape.D, ed)
-            elMises = np.math.sqrt( pow(es[0,0],2) - es[0,0]*es[0,1] + pow(es[0,1],2) + 3*pow(es[0,2],2) )
+            elMises = np.sqrt( pow(es[0,0],2) - es[0,0]*es[0,1] + pow(es[0,1],2) + 3*pow(es[0,2],2) )
         else:
             es, et = cfc.planqs(ex, ey, self.mesh.shape.ep, self.mesh.shape.D, ed)
-            elMises = np.math.sqrt( pow(es[0],2) - es[0]*es[1] + pow(es[1],2) + 3*pow(es[2],2) )
+            elMises = np.sqrt( pow(es[0],2) - es[0]*es[1] + pow(es[1],2) + 3*pow(es[2],2) )
         
         return elMises
 
@@ -130,6 +187,12 @@ class Flow2DSolver(Solver):
             Ke = cfc.flw2i4e(elx, ely, self.mesh.shape.ep, self.mesh.shape.D)
             
         return Ke
+
+    def on_query_Ke_kernel(self):
+        if self.mesh.shape.element_type == 2:
+            return cfc.flw2te, (self.mesh.shape.ep, self.mesh.shape.D)
+        else:
+            return cfc.flw2i4e, (self.mesh.shape.ep, self.mesh.shape.D)
                     
     def on_calc_el_force(self, ex, ey, ed, element_type):
         es = None
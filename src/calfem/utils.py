@@ -273,6 +273,9 @@ def apply_bc(boundaryDofs, bcPrescr, bcVal, marker, value=0.0, dimension=0):
         bcPresc             Updated 1-dim integer array containing prescribed dofs.
         bcVal               Updated 1-dim float array containing prescribed values.
                             
+    Each call copies bcPresc and bcVal, see also
+    calfem.core.BoundaryConditions.add_marker.
+
     """
 
     if marker in boundaryDofs:
@@ -317,6 +320,8 @@ def apply_bc_3d(boundaryDofs, bcPrescr, bcVal, marker, value=0.0, dimension=0):
         bcPresc             Updated 1-dim integer array containing prescribed dofs.
         bcVal               Updated 1-dim float array containing prescribed values.
                             
+    3D version of apply_bc.
+
     """
 
     if marker in boundaryDofs:
@@ -0,0 +1,593 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of the vectorized and sparse routines in calfem.core.
+"""
+
+import numpy as np
+import pytest
+
+import calfem.core as cfc
+
+
+def plane_grid(nx, ny, length=4.0, height=1.0):
+    """Structured quadrilateral mesh with 2 dofs per node."""
+    xs, ys = np.meshgrid(np.linspace(0.0, length, nx+1),
+                         np.linspace(0.0, height, ny+1))
+    coords = np.column_stack((xs.ravel(), ys.ravel()))
+    nid = np.arange(coords.shape[0]).reshape(ny+1, nx+1)
+    quads = np.column_stack((nid[:-1, :-1].ravel(), nid[:-1, 1:].ravel(),
+                             nid[1:, 1:].ravel(), nid[1:, :-1].ravel()))
+    dofs = np.arange(2*coords.shape[0]).reshape(-1, 2)+1
+    edof = dofs[quads].reshape(quads.shape[0], -1)
+    return coords, dofs, edof, quads, nid
+
+
+def plane_model(nx=6, ny=3):
+    """Element matrices and load vectors of a plani4e cantilever."""
+    coords, dofs, edof, quads, nid = plane_grid(nx, ny)
+    ex, ey = coords[quads, 0], coords[quads, 1]
+    D = cfc.hooke(1, 210e9, 0.3)
+    Ke, fe = cfc.plani4e_batch(ex, ey, [1, 0.01, 2], D, [1e3, -2e3])
+    return coords, dofs, edof, nid, Ke, fe
+
+
+def dense_assem(edof, Ke, fe, nDofs):
+    K = np.zeros((nDofs, nDofs))
+    f = np.zeros((nDofs, 1))
+    for i in range(edof.shape[0]):
+        cfc.assem(edof[i], K, Ke[i], f, fe[i].reshape(-1, 1))
+    return K, f
+
+
+def test_spassem_matches_assem():
+    coords, dofs, edof, nid, Ke, fe = plane_model()
+    K, f = dense_assem(edof, Ke, fe, dofs.size)
+
+    Ks, fs = cfc.spassem(edof, Ke, dofs.size, np.zeros((dofs.size, 1)), fe)
+    assert np.allclose(Ks.toarray(), K, rtol=0, atol=1e-12*abs(K).max())
+    assert np.allclose(fs, f)
+
+    # The same element matrix for all elements
+
+    Ks = cfc.spassem(edof, Ke[0], dofs.size)
+    K1, _ = dense_assem(edof, np.broadcast_to(Ke[0], Ke.shape), fe, dofs.size)
+    assert np.allclose(Ks.toarray(), K1, rtol=0, atol=1e-12*abs(K).max())
+
+
+def test_batched_plane_kernels_match_scalar():
+    rng = np.random.default_rng(0)
+    D = cfc.hooke(1, 210e9, 0.3)
+    ep = [1, 0.01]
+    eq = [1e3, -2e3]
+
+    ex = np.array([[0.0, 1.0, 0.2]])+rng.random((5, 3))*0.1
+    ey = np.array([[0.0, 0.1, 1.0]])+rng.random((5, 3))*0.1
+    Ke, fe = cfc.plante_batch(ex, ey, ep, D, eq)
+    for i in range(ex.shape[0]):
+        Kei, fei = cfc.plante(ex[i], ey[i], ep, D, eq)
+        assert np.allclose(Ke[i], Kei)
+        assert np.allclose(fe[i], np.ravel(fei))
+
+    ex = np.array([[0.0, 1.0, 1.1, 0.1]])+rng.random((5, 4))*0.1
+    ey = np.array([[0.0, 0.1, 1.0, 0.9]])+rng.random((5, 4))*0.1
+    Ke = cfc.planqe_batch(ex, ey, ep, D)
+    for i in range(ex.shape[0]):
+        assert np.allclose(Ke[i], cfc.planqe(ex[i], ey[i], ep, D))
+
+    ep = [1, 0.01, 2]
+    Ke, fe = cfc.plani4e_batch(ex, ey, ep, D, eq)
+    for i in range(ex.shape[0]):
+        Kei, fei = cfc.plani4e(ex[i], ey[i], ep, D, eq)
+        assert np.allclose(Ke[i], Kei)
+        assert np.allclose(fe[i], np.ravel(fei))
+
+
+def test_batched_soli8_matches_scalar():
+    rng = np.random.default_rng(1)
+    D = cfc.hooke(4, 210e9, 0.3)
+    ep = [2]
+
+    unit = np.array([[0, 1, 1, 0, 0, 1, 1, 0],
+                     [0, 0, 1, 1, 0, 0, 1, 1],
+                     [0, 0, 0, 0, 1, 1, 1, 1]], dtype=float)
+    ex = unit[0]+rng.random((3, 8))*0.1
+    ey = unit[1]+rng.random((3, 8))*0.1
+    ez = unit[2]+rng.random((3, 8))*0.1
+    ed = rng.random((3, 24))*1e-3
+
+    Ke = cfc.soli8e_batch(ex, ey, ez, ep, D)
+    et, es, eci = cfc.soli8s_batch(ex, ey, ez, ep, D, ed)
+    for i in range(ex.shape[0]):
+        assert np.allclose(Ke[i], cfc.soli8e(ex[i], ey[i], ez[i], ep, D))
+        eti, esi, ecii = cfc.soli8s(ex[i], ey[i], ez[i], ep, D, ed[i])
+        assert np.allclose(et[i], eti)
+        assert np.allclose(es[i], esi)
+        assert np.allclose(eci[i], ecii)
+
+
+def test_prepared_system_matches_solveq():
+    coords, dofs, edof, nid, Ke, fe = plane_model()
+    K, f = dense_assem(edof, Ke, fe, dofs.size)
+    bc = dofs[nid[:, 0]].ravel()
+    bcVal = np.linspace(0.0, 1e-4, bc.shape[0])
+
+    f2 = np.hstack((f, 2*f))
+    a_ref, Q_ref = cfc.solveq(K, f, bc, bcVal)
+
+    for Kp in (K, cfc.spassem(edof, Ke, dofs.size)):
+        system = cfc.PreparedSystem(Kp, bc)
+        a, Q = system.solve(f2, bcVal)
+        assert a.shape == (dofs.size, 2)
+        assert np.allclose(a[:, :1], a_ref)
+        assert np.allclose(Q[:, :1], Q_ref, atol=1e-6*abs(Q_ref).max())
+        a2, _ = cfc.solveq(K, 2*f, bc, bcVal)
+        assert np.allclose(a[:, 1:], a2)
+
+
+def test_prepared_system_without_prescribed_dofs():
+    K = np.array([[2.0, -1.0, 0.0], [-1.0, 2.0, -1.0], [0.0, -1.0, 2.0]])
+    f = np.ones((3, 1))
+    system = cfc.PreparedSystem(K)
+    for bcVal in (None, [], np.array([])):
+        a, Q = system.solve(f, bcVal)
+        assert np.allclose(a, np.linalg.solve(K, f))
+        assert np.allclose(Q, 0.0)
+
+
+def chain(n, fixed=True):
+    """Stiffness and mass matrices of a spring-mass chain."""
+    K = 2*np.eye(n)-np.eye(n, k=1)-np.eye(n, k=-1)
+    if not fixed:
+        K[0, 0] = K[-1, -1] = 1.0
+    return 1e6*K, 2.0*np.eye(n)
+
+
+def test_eigen_shift_invert_matches_dense():
+    import scipy.sparse as sp
+
+    K, M = chain(40)
+    b = np.array([1, 40])
+    L_ref, X_ref = cfc.eigen(K, M, b)
+
+    L, X = cfc.eigen(sp.csr_matrix(K), sp.csr_matrix(M), b, nev=6)
+    assert np.allclose(L, L_ref[:6])
+    assert np.allclose(abs(np.einsum('ij,ij->j', X, M@X_ref[:, :6])), 1.0)
+
+    window = [L_ref[2]*0.99, L_ref[7]*1.01]
+    L, X = cfc.eigen(sp.csr_matrix(K), sp.csr_matrix(M), b, window=window)
+    assert np.allclose(L, L_ref[2:8])
+
+
+def test_eigen_window_covering_all_modes():
+    K, M = chain(30)
+    b = np.array([1, 30])
+    L_ref, _ = cfc.eigen(K, M, b)
+    L, X = cfc.eigen(K, M, b, window=[0.0, 2*L_ref.max()])
+    assert L.shape[0] == 28
+    assert np.allclose(L, L_ref)
+
+
+def test_eigen_default_shift_singular_stiffness():
+    K, M = chain(20, fixed=False)
+    L, X = cfc.eigen(K, M, nev=3)
+    L_ref = np.linalg.eigvalsh(K/2.0)[:3]
+    assert abs(L[0]) < 1e-6*L_ref[1]
+    assert np.allclose(L[1:], L_ref[1:])
+
+
+def test_extract_eldisp_out_and_history():
+    edof = np.array([[1, 2, 5, 6], [3, 4, 5, 6]])
+    a = np.arange(1.0, 7.0).reshape(6, 1)
+
+    ed = cfc.extract_eldisp(edof, a)
+    assert np.array_equal(ed, [[1, 2, 5, 6], [3, 4, 5, 6]])
+
+    out = np.empty((2, 4))
+    assert cfc.extract_eldisp(edof, 2*a, out=out) is out
+    assert np.array_equal(out, 2*ed)
+
+    history = np.hstack((a, 2*a, 3*a))
+    edh = cfc.extract_eldisp(edof, history)
+    assert edh.shape == (3, 2, 4)
+    for step in range(3):
+        assert np.array_equal(edh[step], (step+1)*ed)
+
+
+def coordxtr_tuple(edof, coords, dofs):
+    """Element coordinates found through a dictionary of dof tuples."""
+    nDofs = dofs.shape[1]
+    nodeOf = {tuple(dof): i for i, dof in enumerate(dofs)}
+    nodes = [[nodeOf[tuple(row[i:i+nDofs])] for i in range(0, len(row), nDofs)]
+             for row in edof]
+    return coords[nodes, 0], coords[nodes, 1]
+
+
+def test_coordxtr_matches_tuple_lookup():
+    coords, dofs, edof, quads, nid = plane_grid(5, 2)
+
+    # Nodes in a different order than the dofs, as after renumbering
+
+    perm = np.random.default_rng(2).permutation(coords.shape[0])
+    coords, dofs = coords[perm], dofs[perm]
+    ex_ref, ey_ref = coordxtr_tuple(edof, coords, dofs)
+
+    for dtype in (int, float):
+        ex, ey = cfc.coordxtr(edof.astype(dtype), coords, dofs.astype(dtype))
+        assert np.array_equal(ex, ex_ref)
+        assert np.array_equal(ey, ey_ref)
+
+
+def test_coordxtr_unknown_dofs():
+    coords, dofs, edof, quads, nid = plane_grid(2, 1)
+
+    for bad in (dofs.max()+1, 0):
+        edof_bad = edof.copy()
+        edof_bad[1, 2] = bad
+        with pytest.raises(KeyError):
+            cfc.coordxtr(edof_bad, coords, dofs)
+
+    # First dof of a node with the wrong second dof
+
+    edof_bad = edof.copy()
+    edof_bad[0, 1] = edof_bad[0, 3]
+    with pytest.raises(KeyError):
+        cfc.coordxtr(edof_bad, coords, dofs)
+
+    with pytest.raises(ValueError):
+        cfc.coordxtr(edof+0.5, coords, dofs)
+
+
+def test_boundary_conditions_partition():
+    dofs = np.arange(1, 13).reshape(-1, 2)
+    bcs = cfc.BoundaryConditions(12, 2)
+    bcs.add_marker({5: [1, 2, 3, 4]}, 5, 0.5, dimension=2)
+    bcs.add_node([5], dofs, -1.0)
+    bcs.add_dofs([2, 12], [0.25, 2.0])
+
+    assert np.array_equal(bcs.bc_prescr, [2, 4, 11, 12])
+    assert np.array_equal(bcs.bc_val, [0.25, 0.5, -1.0, 2.0])
+    prescr, free = bcs.partition()
+    assert np.array_equal(prescr, bcs.bc_prescr-1)
+    assert np.array_equal(np.sort(np.hstack((prescr, free))), np.arange(12))
+
+    with pytest.raises(KeyError):
+        bcs.add_marker({5: [1, 2]}, 7)
+    with pytest.raises(ValueError):
+        bcs.add_marker({5: [1, 2]}, 5, dimension=3)
+
+    # Same solution as the equivalent arrays
+
+    K = 2*np.eye(12)-np.eye(12, k=1)-np.eye(12, k=-1)
+    f = np.ones((12, 1))
+    a, Q = cfc.solveq(K, f, bcs)
+    a_ref, Q_ref = cfc.solveq(K, f, bcs.bc_prescr, bcs.bc_val)
+    assert np.allclose(a, a_ref)
+    assert np.allclose(Q, Q_ref)
+
+
+def test_step1_sparse_matches_dense():
+    import scipy.sparse as sp
+
+    K, C = chain(20)
+    f = np.zeros((20, 1))
+    f[10] = 1e3
+    a0 = np.zeros((20, 1))
+    bc = np.array([[1, 0.0], [20, 1.0]])
+    ip = [0.01, 0.5, 0.5]
+
+    for dofs in ([], np.array([5, 11])):
+        mh_ref, dh_ref = cfc.step1(K, C, f, a0, bc, ip, [], dofs)
+        mh, dh = cfc.step1(sp.csr_matrix(K), sp.csr_matrix(C), f, a0, bc,
+                           ip, [], dofs)
+        for key in mh_ref:
+            assert np.allclose(mh[key], mh_ref[key])
+        for key in dh_ref:
+            assert np.allclose(dh[key], dh_ref[key])
+
+
+@pytest.mark.parametrize("damped", [False, True])
+def test_step2_sparse_matches_dense(damped):
+    import scipy.sparse as sp
+
+    K, M = chain(20)
+    C = 1e-3*K if damped else []
+    nstep = 40
+    f = np.zeros((20, nstep+1))
+    f[10] = 1e3*np.sin(np.linspace(0.0, 4.0, nstep+1))
+    a0 = np.zeros((20, 1))
+    da0 = np.zeros((20, 1))
+    bc = np.array([[1, 0.0], [20, 1e-4]])
+    ip = [1e-3, nstep*1e-3, 0.25, 0.5]
+    dofs = np.array([5, 11])
+
+    mh_ref, dh_ref = cfc.step2(K, C, M, f, a0, da0, bc, ip, [], dofs)
+    Cs = sp.csr_matrix(C) if damped else []
+    mh, dh = cfc.step2(sp.csr_matrix(K), Cs, sp.csr_matrix(M), f, a0, da0,
+                       bc, ip, [], dofs)
+    assert mh_ref['a'].shape == (20, nstep+1)
+    for key in mh_ref:
+        assert np.allclose(mh[key], mh_ref[key])
+        assert np.allclose(dh[key], dh_ref[key])
+
+
+def test_step2_history_output_sinks(tmp_path):
+    K, M = chain(12)
+    f = np.zeros((12, 1))
+    f[6] = 1e3
+    a0 = np.zeros((12, 1))
+    bc = np.array([[1, 0.0], [12, 0.0]])
+    ip = [1e-3, 0.03, 0.25, 0.5]
+
+    mh_ref, _ = cfc.step2(K, [], M, f, a0, a0, bc, ip, [], [])
+    every = mh_ref['a'][:, ::3]
+
+    # Memory-mapped files, every third step
+
+    prefix = str(tmp_path / "hist")
+    mh, _ = cfc.step2(K, [], M, f, a0, a0, bc, ip, [], [], out=prefix,
+                      every=3)
+    for key in ('a', 'da', 'd2a'):
+        assert isinstance(mh[key], np.memmap)
+        assert np.allclose(np.load(prefix+"_%s.npy" % key),
+                           mh_ref[key][:, ::3])
+    assert np.allclose(mh['a'], every)
+
+    # Callback with reused snapshot arrays
+
+    snapshots = []
+    mh, _ = cfc.step2(K, [], M, f, a0, a0, bc, ip, [], [], every=3,
+                      out=lambda t, s: snapshots.append((t, s['a'].copy())))
+    assert mh == {}
+    assert np.allclose([t for t, _ in snapshots], 3e-3*np.arange(11))
+    assert np.allclose(np.column_stack([a for _, a in snapshots]), every)
+
+    # step1 with the same sinks
+
+    mh_ref, _ = cfc.step1(K, M, f, a0, bc, [1e-3, 0.03, 0.5], [], [])
+    mh, _ = cfc.step1(K, M, f, a0, bc, [1e-3, 0.03, 0.5], [], [],
+                      out=prefix+"1")
+    assert np.allclose(np.load(prefix+"1_a.npy"), mh_ref['a'])
+
+
+def test_step2_modal_all_modes_matches_step2():
+    K, M = chain(16)
+    nstep = 50
+    f = np.zeros((16, nstep+1))
+    f[8] = 1e3*np.sin(np.linspace(0.0, 5.0, nstep+1))
+    a0 = np.zeros((16, 1))
+    b = np.array([1, 16])
+    bc = np.column_stack((b, np.zeros(2)))
+    ip = [1e-3, nstep*1e-3, 0.25, 0.5]
+    dofs = np.array([4, 9])
+    rayleigh = [2.0, 1e-4]
+
+    # The load starts at zero, so the initial accelerations agree
+
+    mh_ref, dh_ref = cfc.step2(K, rayleigh[0]*M+rayleigh[1]*K, M, f, a0, a0,
+                               bc, ip, [], dofs)
+    scale = abs(mh_ref['a']).max()
+
+    for Km, Mm in ((K, M), (np.matrix(K), np.matrix(M))):
+        mh, dh = cfc.step2_modal(Km, Mm, f, a0, a0, b, ip, [], dofs,
+                                 rayleigh=rayleigh)
+        assert np.allclose(mh['a'], mh_ref['a'], rtol=0, atol=1e-8*scale)
+        assert np.allclose(dh['a'], dh_ref['a'], rtol=0, atol=1e-8*scale)
+        assert np.allclose(mh['d2a'], mh_ref['d2a'], rtol=1e-6,
+                           atol=1e-6*abs(mh_ref['d2a']).max())
+
+
+def test_freqresp_modal_matches_direct():
+    import scipy.sparse as sp
+
+    K, M = chain(14)
+    C = 1.0*M+1e-4*K
+    f = np.zeros((14, 1))
+    f[5] = 1.0
+    b = np.array([1, 14])
+    freqs = np.linspace(10.0, 200.0, 9)
+    dofs = np.array([3, 6, 10])
+
+    # Explicit solve of the constrained system
+
+    free = np.setdiff1d(np.arange(14), b-1)
+    ref = np.zeros((14, freqs.shape[0]), dtype=complex)
+    for i, omega in enumerate(2*np.pi*freqs):
+        A = K-omega**2*M+1j*omega*C
+        ref[free, i] = np.linalg.solve(A[np.ix_(free, free)], f[free, 0])
+
+    a = cfc.freqresp(K, M, f, freqs, C=C, b=b)
+    assert np.allclose(a, ref)
+
+    a = cfc.freqresp(sp.csr_matrix(K), sp.csr_matrix(M), f, freqs,
+                     C=sp.csr_matrix(C), b=b, dofs=dofs, workers=2)
+    assert np.allclose(a, ref[dofs-1])
+
+    a = cfc.freqresp(K, M, f, freqs, C=C, b=b, dofs=dofs, method='modal')
+    assert np.allclose(a, ref[dofs-1], rtol=1e-8, atol=1e-12*abs(ref).max())
+
+
+def test_statcon_matches_explicit_condensation():
+    import scipy.sparse as sp
+
+    coords, dofs, edof, nid, Ke, fe = plane_model(4, 2)
+    K, f = dense_assem(edof, Ke, fe, dofs.size)
+    cd = dofs[nid[1, 1:-1]].ravel()
+
+    a_idx = np.setdiff1d(np.arange(dofs.size), cd-1)
+    b_idx = cd-1
+    Kbb_inv = np.linalg.inv(K[np.ix_(b_idx, b_idx)])
+    K1_ref = K[np.ix_(a_idx, a_idx)] - \
+        K[np.ix_(a_idx, b_idx)]@Kbb_inv@K[np.ix_(b_idx, a_idx)]
+    f1_ref = f[a_idx]-K[np.ix_(a_idx, b_idx)]@Kbb_inv@f[b_idx]
+    scale = abs(K).max()
+
+    for Kc in (K, sp.csr_matrix(K)):
+        K1, f1 = cfc.statcon(Kc, f, cd)
+        assert np.allclose(K1, K1_ref, rtol=0, atol=1e-10*scale)
+        assert np.allclose(f1, f1_ref)
+
+        # Recover the condensed dofs of the full solution
+
+        K1, f1, solve_bb = cfc.statcon(Kc, f, cd, return_factor=True)
+        bc = dofs[nid[:, 0]].ravel()
+        a, _ = cfc.solveq(K, f, bc)
+        aa = a[a_idx]
+        ab = solve_bb(f[b_idx]-K[np.ix_(b_idx, a_idx)]@aa)
+        assert np.allclose(ab, a[b_idx], rtol=0, atol=1e-8*abs(a).max())
+
+
+def test_superelement_matches_full_model():
+    import scipy.sparse as sp
+
+    D = cfc.hooke(1, 210e9, 0.3)
+    ep = [1, 0.01, 2]
+    eq = [1e3, -2e3]
+
+    def model(nx, length):
+        coords, dofs, edof, quads, nid = plane_grid(nx, 2, length)
+        Ke, fe = cfc.plani4e_batch(coords[quads, 0], coords[quads, 1], ep, D, eq)
+        K, f = dense_assem(edof, Ke, fe, dofs.size)
+        return K, f, dofs, nid
+
+    # Three components of 4 x 2 elements in a row
+
+    Kc, fc, dofs_c, nid_c = model(4, 4.0)
+    K, f, dofs, nid = model(12, 12.0)
+
+    boundary = dofs_c[nid_c[:, [0, 4]]].ravel()
+    cd = np.setdiff1d(dofs_c.ravel(), boundary)
+    se = cfc.Superelement(Kc, fc, cd)
+
+    # Global dof of each component dof, the component nodes are
+    # numbered row by row as in the global model
+
+    compToGlobal = np.array([dofs[nid[:, 4*k:4*k+5]].ravel()
+                             for k in range(3)])
+    globalEdof = compToGlobal[:, se.boundary_dofs-1]
+
+    # Reduced numbering of the global boundary dofs
+
+    kept = np.unique(globalEdof)
+    reduced = np.zeros(dofs.size+1, dtype=int)
+    reduced[kept] = np.arange(1, kept.size+1)
+    edof_r = reduced[globalEdof]
+
+    Kr, fr = se.assem(edof_r, np.zeros((kept.size, kept.size)),
+                      np.zeros((kept.size, 1)))
+    bc = reduced[dofs[nid[:, 0]].ravel()]
+    ar, _ = cfc.solveq(Kr, fr, bc)
+    Ks = se.assem(edof_r, sp.csr_matrix((kept.size, kept.size)))
+    assert np.allclose(Ks.toarray(), Kr)
+
+    a, _ = cfc.solveq(K, f, dofs[nid[:, 0]].ravel())
+    scale = abs(a).max()
+    assert np.allclose(ar, a[kept-1], rtol=0, atol=1e-8*scale)
+
+    ai = se.recover(edof_r, ar)
+    assert ai.shape == (3, cd.shape[0])
+    assert np.allclose(ai, a[compToGlobal[:, cd-1]-1, 0], rtol=0,
+                       atol=1e-8*scale)
+
+
+@pytest.mark.parametrize("precond, max_iter", [
+    ('jacobi', 400), ('block-jacobi', 400), ('ilu', 10), ('amg', 50)])
+def test_pcg_preconditioners_converge(precond, max_iter):
+    coords, dofs, edof, quads, nid = plane_grid(48, 12)
+    D = cfc.hooke(1, 210e9, 0.3)
+    Ke = cfc.planqe_batch(coords[quads, 0], coords[quads, 1], [1, 0.01], D)
+    K = cfc.spassem(edof, Ke, dofs.size)
+
+    f = np.zeros((dofs.size, 1))
+    f[dofs[nid[-1, -1], 1]-1] = -1e5
+    bc = dofs[nid[:, 0]].ravel()
+
+    a_direct, _ = cfc.spsolveq(K, f, bc)
+
+    residuals = []
+    a, Q = cfc.spsolveq(K, f, bc, method='pcg', precond=precond, tol=1e-10,
+                        dofs_per_node=2, residuals=residuals)
+
+    assert residuals[-1] <= 1e-10
+    assert len(residuals) <= max_iter
+    assert np.allclose(a, a_direct, rtol=0, atol=1e-7*abs(a_direct).max())
+
+
+def test_pcg_warns_without_convergence():
+    coords, dofs, edof, quads, nid = plane_grid(12, 3)
+    D = cfc.hooke(1, 210e9, 0.3)
+    Ke = cfc.planqe_batch(coords[quads, 0], coords[quads, 1], [1, 0.01], D)
+    K = cfc.spassem(edof, Ke, dofs.size)
+    f = np.ones((dofs.size, 1))
+
+    with pytest.warns(RuntimeWarning):
+        cfc.spsolveq(K, f, dofs[nid[:, 0]].ravel(), method='pcg', maxiter=3)
+
+
+@pytest.mark.parametrize("executor", ['thread', 'process'])
+def test_spassem_parallel_matches_spassem(executor):
+    coords, dofs, edof, quads, nid = plane_grid(8, 4)
+    ex, ey = coords[quads, 0], coords[quads, 1]
+    D = cfc.hooke(1, 210e9, 0.3)
+    K_ref = cfc.spassem(edof, cfc.planqe_batch(ex, ey, [1, 0.01], D),
+                        dofs.size)
+
+    K = cfc.spassem_parallel(edof, cfc.planqe, ex, ey, args=([1, 0.01], D),
+                             nDofs=dofs.size, workers=2, chunk_size=5,
+                             executor=executor)
+    assert K.shape == K_ref.shape
+    assert np.allclose(K.toarray(), K_ref.toarray(), rtol=0,
+                       atol=1e-12*abs(K_ref).max())
+
+
+def test_sparsity_pattern_matches_spassem():
+    coords, dofs, edof, nid, Ke, fe = plane_model()
+    K, f = dense_assem(edof, Ke, fe, dofs.size)
+
+    pattern = cfc.SparsityPattern(edof, dofs.size)
+    Kp, fp = pattern.assem(Ke, f=np.zeros((dofs.size, 1)), fe=fe)
+    assert np.allclose(Kp.toarray(), K, rtol=0, atol=1e-12*abs(K).max())
+    assert np.allclose(fp, f)
+    assert Kp.nnz == cfc.spassem(edof, Ke, dofs.size).nnz
+
+    # Reassembly overwrites the data of the same matrix
+
+    Kr = pattern.assem(2*Ke, Kp)
+    assert Kr is Kp
+    assert np.allclose(Kr.toarray(), 2*K, rtol=0, atol=1e-12*abs(K).max())
+
+
+def test_nlsolveq_matches_exn_bar2g():
+    edof = np.array([[1, 2, 5, 6], [3, 4, 5, 6]])
+    E = 10e9
+    ep = np.array([[E, 4e-2], [E, 1e-2]])
+    ex = np.array([[0.0, 1.6], [0.0, 1.6]])
+    ey = np.array([[0.0, 0.0], [1.2, 0.0]])
+    f = np.zeros((6, 1))
+    f[4] = -10e6
+    f[5] = -0.2e6
+    bc = np.array([1, 2, 3, 4])
+
+    # Fixed-point iteration on the axial forces as in exn_bar2g
+
+    QX = np.zeros(2)
+    for n in range(100):
+        K = np.zeros((6, 6))
+        for i in range(2):
+            cfc.assem(edof[i], K, cfc.bar2ge(ex[i], ey[i], ep[i], QX[i]))
+        a_ref, _ = cfc.solveq(K, f, bc)
+        ed = cfc.extract_ed(edof, a_ref)
+        QX_old = QX.copy()
+        QX = np.array([cfc.bar2gs(ex[i], ey[i], ep[i], ed[i])[1][0]
+                       for i in range(2)])
+        if np.all(abs(QX-QX_old) <= 1e-12*abs(QX).max()):
+            break
+
+    for method in ('newton', 'modified'):
+        history = []
+        a, r, QXn = cfc.nlsolveq(edof, ex, ey, ep, f, bc, method=method,
+                                 tol=1e-10, history=history)
+        assert history[-1][2] <= 1e-10
+        assert np.allclose(a, a_ref, rtol=1e-7)
+        assert np.allclose(QXn, QX, rtol=1e-7)
+        if method == 'newton':
+            assert len(history) <= 8
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+Regression tests of mesh generation and .msh parsing in calfem.mesh.
+"""
+
+import numpy as np
+import pytest
+
+import calfem.core as cfc
+
+try:
+    import calfem.mesh as cfm
+    import calfem.geometry as cfg
+except (ImportError, OSError):
+    pytest.skip("gmsh is not available", allow_module_level=True)
+
+
+MSH = """$MeshFormat
+2.2 0 8
+$EndMeshFormat
+$Nodes
+4
+1 0 0 0
+2 1 0 0
+3 1 1 0
+4 0 1 0
+$EndNodes
+$Elements
+4
+1 1 2 10 1 1 2
+2 1 2 20 2 2 3
+3 2 2 0 1 1 2 3
+4 2 2 0 1 1 3 4
+$EndElements
+"""
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"])
+def test_read_msh_file(tmp_path, newline):
+    mshFile = tmp_path / "square.msh"
+    mshFile.write_bytes(MSH.replace("\n", newline).encode())
+
+    generator = cfm.GmshMeshGenerator(None)
+    allNodes, elmTypes, markers, entities, elmNodes = generator._readMshFile(
+        str(mshFile), 2)
+
+    assert np.array_equal(allNodes, [[0, 0], [1, 0], [1, 1], [0, 1]])
+    assert list(elmTypes) == [1, 1, 2, 2]
+    assert list(markers) == [10, 20, 0, 0]
+    assert list(entities) == [1, 2, 1, 1]
+
+    tokens, nodeStart, nodeCount = elmNodes
+    nodes = [list(tokens[s:s+n]) for s, n in zip(nodeStart, nodeCount)]
+    assert nodes == [[1, 2], [2, 3], [1, 2, 3], [1, 3, 4]]
+
+
+def rectangle():
+    g = cfg.Geometry()
+    g.point([0.0, 0.0])
+    g.point([2.0, 0.0])
+    g.point([2.0, 1.0])
+    g.point([0.0, 1.0])
+    g.spline([0, 1], marker=10)
+    g.spline([1, 2], marker=20)
+    g.spline([2, 3], marker=30)
+    g.spline([3, 0], marker=40)
+    g.surface([0, 1, 2, 3])
+    return g
+
+
+def assert_same_mesh(mesh1, mesh2):
+    coords1, edof1, dofs1, bdofs1, markers1 = mesh1[:5]
+    coords2, edof2, dofs2, bdofs2, markers2 = mesh2[:5]
+    assert np.allclose(coords1, coords2)
+    assert np.array_equal(edof1, edof2)
+    assert np.array_equal(dofs1, dofs2)
+    assert bdofs1.keys() == bdofs2.keys()
+    for marker in bdofs1:
+        assert np.array_equal(np.sort(bdofs1[marker]), np.sort(bdofs2[marker]))
+    assert list(markers1) == list(markers2)
+
+
+def test_in_memory_mesh_matches_msh_file(tmp_path):
+    fromFile = cfm.GmshMeshGenerator(rectangle(), 2, 0.3, 2)
+    fromFile.mesh_dir = str(tmp_path)
+    inMemory = cfm.GmshMeshGenerator(rectangle(), 2, 0.3, 2)
+    assert_same_mesh(fromFile.create(), inMemory.create())
+    assert list(tmp_path.glob("*.msh"))
+
+
+def test_mesh_cache_hit_and_eviction(tmp_path, monkeypatch):
+    cacheDir = tmp_path / "cache"
+
+    generator = cfm.GmshMeshGenerator(rectangle(), 2, 0.3, 2,
+                                      return_boundary_elements=True)
+    generator.mesh_cache_dir = str(cacheDir)
+    mesh = generator.create()
+    assert len(list(cacheDir.glob("*.npz"))) == 1
+
+    # A second generator with the same options must not call gmsh
+
+    def no_meshing(self, is3D, dim):
+        raise AssertionError("mesh not taken from the cache")
+
+    monkeypatch.setattr(cfm.GmshMeshGenerator, "_createMesh", no_meshing)
+    cached = cfm.GmshMeshGenerator(rectangle(), 2, 0.3, 2,
+                                   return_boundary_elements=True)
+    cached.mesh_cache_dir = str(cacheDir)
+    cachedMesh = cached.create()
+    assert_same_mesh(mesh, cachedMesh)
+    assert cachedMesh[5].keys() == mesh[5].keys()
+    assert np.array_equal(cached.topo, generator.topo)
+    monkeypatch.undo()
+
+    # Other options give another entry, the oldest is evicted when the
+    # cache is too large
+
+    other = cfm.GmshMeshGenerator(rectangle(), 2, 0.5, 2)
+    other.mesh_cache_dir = str(cacheDir)
+    other.mesh_cache_max_size = 1
+    other.create()
+    assert len(list(cacheDir.glob("*.npz"))) <= 1
+
+
+@pytest.mark.parametrize("dofsPerNode", [2, 3])
+def test_expanded_topology_matches_node_loop(dofsPerNode):
+    generator = cfm.GmshMeshGenerator(rectangle(), 3, 0.4, dofsPerNode)
+    coords, edof, dofs, bdofs, elementmarkers = generator.create()
+    topo = np.asarray(generator.topo)
+
+    assert edof.shape == (topo.shape[0], topo.shape[1]*dofsPerNode)
+    for el in range(topo.shape[0]):
+        expected = [dof for node in topo[el] for dof in dofs[node-1]]
+        assert list(edof[el]) == expected
+
+    for marker, nodes in generator.bnodes.items():
+        assert np.array_equal(bdofs[marker], dofs[nodes].ravel())
+
+
+def test_rcm_renumbering_keeps_the_solution():
+    def solve(generator):
+        coords, edof, dofs, bdofs, elementmarkers = generator.create()
+        ex, ey = cfc.coordxtr(edof, coords, dofs)
+        Ke = cfc.plante_batch(ex, ey, [1, 0.1], cfc.hooke(1, 210e9, 0.3))
+        K = cfc.spassem(edof, Ke, dofs.size)
+        f = np.zeros((dofs.size, 1))
+        f[bdofs[20][1::2]-1] = -1e3
+        a, _ = cfc.spsolveq(K, f, bdofs[40])
+        bandwidth = (edof.max(axis=1)-edof.min(axis=1)).max()
+        return coords, ex, ey, a, bandwidth
+
+    coords, ex, ey, a, bandwidth = solve(
+        cfm.GmshMeshGenerator(rectangle(), 2, 0.1, 2))
+
+    generator = cfm.GmshMeshGenerator(rectangle(), 2, 0.1, 2)
+    generator.renumber = 'rcm'
+    coords_r, ex_r, ey_r, a_r, bandwidth_r = solve(generator)
+
+    assert bandwidth_r < bandwidth
+    assert np.allclose(coords_r, coords[generator.node_permutation])
+    assert np.allclose(ex_r, ex)
+    assert np.allclose(ey_r, ey)
+    assert np.allclose(a_r, a[generator.dof_permutation], rtol=0,
+                       atol=1e-10*abs(a).max())
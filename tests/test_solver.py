@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the experimental calfem.solver module on a structured mesh.
+"""
+
+import types
+
+import numpy as np
+
+import calfem.core as cfc
+import calfem.solver as cfs
+
+
+def triangle_mesh(nx=8, ny=2, length=4.0, height=1.0):
+    """Cantilever of plane triangles with the attributes Solver uses."""
+    xs, ys = np.meshgrid(np.linspace(0.0, length, nx+1),
+                         np.linspace(0.0, height, ny+1))
+    coords = np.column_stack((xs.ravel(), ys.ravel()))
+    nid = np.arange(coords.shape[0]).reshape(ny+1, nx+1)
+    a, b = nid[:-1, :-1].ravel(), nid[:-1, 1:].ravel()
+    c, d = nid[1:, 1:].ravel(), nid[1:, :-1].ravel()
+    tris = np.vstack((np.column_stack((a, b, c)), np.column_stack((a, c, d))))
+    dofs = np.arange(2*coords.shape[0]).reshape(-1, 2)+1
+
+    mesh = types.SimpleNamespace(
+        coords=coords, dofs=dofs, edof=dofs[tris].reshape(tris.shape[0], -1),
+        ex=coords[tris, 0], ey=coords[tris, 1],
+        bdofs={10: dofs[nid[:, 0]].ravel()})
+    mesh.shape = types.SimpleNamespace(
+        element_type=2, ep=[1, 0.1], D=cfc.hooke(1, 210e9, 0.3))
+    return mesh, nid
+
+
+def reference_solution(mesh, bc, f):
+    K = cfc.spassem(mesh.edof, cfc.plante_batch(
+        mesh.ex, mesh.ey, mesh.shape.ep, mesh.shape.D), mesh.dofs.size)
+    return cfc.spsolveq(K, f, bc)[0]
+
+
+def test_apply_bcs_default_and_override():
+    mesh, nid = triangle_mesh()
+    tip = mesh.dofs[nid[-1, -1], 1]-1
+
+    solver = cfs.Plan2DSolver(mesh)
+    solver.addBC(10)
+    solver.f[tip] = -1e3
+
+    # The default on_apply_bcs adds nothing
+
+    solver.applyBCs()
+    assert np.array_equal(solver.bcs.bc_prescr, mesh.bdofs[10])
+
+    a_ref = reference_solution(mesh, mesh.bdofs[10], solver.f)
+    assert np.allclose(solver.execute().a, a_ref)
+
+    class Prescribed(cfs.Plan2DSolver):
+        def on_apply_bcs(self, mesh, bc, bcVal):
+            return [mesh.dofs[nid[-1, -1], 0]], [1e-6]
+
+    solver = Prescribed(mesh)
+    solver.addBC(10)
+    solver.applyBCs()
+    assert solver.bcs.bc_prescr[-1] == mesh.dofs[nid[-1, -1], 0]
+    assert solver.bcs.bc_val[-1] == 1e-6
+    assert np.isclose(solver.execute().a[mesh.dofs[nid[-1, -1], 0]-1], 1e-6)
+
+
+def test_amg_preconditioner_reused_until_k_or_bcs_change():
+    mesh, nid = triangle_mesh(16, 4)
+    solver = cfs.Plan2DSolver(mesh)
+    solver.method = 'pcg'
+    solver.precond = 'amg'
+    solver.addBC(10)
+    solver.f[mesh.dofs[nid[-1, -1], 1]-1] = -1e3
+
+    a1 = solver.execute().a.copy()
+    amg = solver.amg
+    assert isinstance(amg, cfc.AMGPreconditioner)
+
+    a2 = solver.execute().a.copy()
+    assert solver.amg is amg
+    assert np.allclose(a2, a1)
+    assert np.allclose(a1, reference_solution(mesh, mesh.bdofs[10], solver.f),
+                       rtol=1e-6)
+
+    # Stiffer material gives a new K
+
+    mesh.shape.D = 2*mesh.shape.D
+    a3 = solver.execute().a
+    assert solver.amg is not amg
+    assert np.allclose(a3, a1/2, rtol=1e-6)
+
+    amg = solver.amg
+    solver.addBCNode(nid[0, -1], 0.0)
+    solver.execute()
+    assert solver.amg is not amg